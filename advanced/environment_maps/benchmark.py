@@ -0,0 +1,133 @@
+'''
+Compares drawing many copies of a model made with copy_to() (the old way
+the monkeys were made in main.py) with drawing them with one instanced draw
+(see instancing.py). No window is opened, run it from this directory:
+
+python benchmark.py [--counts 15 1000 50000] [--frames 100] [--software]
+
+For each count the models are put in a square grid, the camera looks at all of
+them, and for both ways the time to build the scene, the number of geoms
+(draw calls when all are in view), the mean cull and draw time per frame are reported.
+Use --software on machines without a GPU (the shaders are not run then
+and the draw times of the instanced models mean nothing, but the cull times
+and the time spent on the CPU are still there).
+'''
+import panda3d.core as p3d
+import numpy as np
+
+import argparse
+import math
+import time
+
+import instancing
+
+
+def make_base(software=False):
+    '''Returns a ShowBase rendering to an offscreen buffer'''
+    if software:
+        p3d.load_prc_file_data('', 'load-display p3tinydisplay')
+    p3d.load_prc_file_data('', 'sync-video 0')
+    from direct.showbase.ShowBase import ShowBase
+    base = ShowBase(windowType='offscreen')
+    base.disable_mouse()
+    return base
+
+
+def grid(count, spacing=3.0):
+    '''Returns (count, 3) positions in a square grid, centered at 0,0,0'''
+    side = math.ceil(math.sqrt(count))
+    i = np.arange(count)
+    pos = np.zeros((count, 3))
+    pos[:, 0] = (i % side - (side - 1) * 0.5) * spacing
+    pos[:, 1] = (i // side - (side - 1) * 0.5) * spacing
+    return pos
+
+
+def make_copies(model, pos, roughness, metallic, parent):
+    '''The old way - one copy of the model (and its own shader inputs) for each position'''
+    root = parent.attach_new_node('copies')
+    # the shader reads the transform from the instance texture, give all the copies
+    # one identity 'instance', the transform of each copy is on the node
+    model.set_shader_input('instance_tex', instancing.make_instance_texture(
+                               instancing.pack_instances(np.eye(4))))
+    for p, r, m in zip(pos, roughness, metallic):
+        copy = model.copy_to(root)
+        copy.set_pos(*p)
+        copy.set_shader_input('roughness', float(r))
+        copy.set_shader_input('metallic', float(m))
+    return root
+
+
+def make_instances(model, pos, roughness, metallic, parent):
+    '''The new way - one instanced model'''
+    return instancing.make_instanced_model(model, instancing.instance_matrices(pos), parent,
+                                           roughness=roughness, metallic=metallic)
+
+
+def measure(base, make, model, count, frames):
+    '''Builds the scene with make(), renders frames and returns a dict with the results'''
+    pos = grid(count)
+    rng = np.random.default_rng(0)
+    roughness = rng.uniform(0.0, 1.0, count)
+    metallic = rng.uniform(0.0, 1.0, count)
+    start = time.perf_counter()
+    root = make(model, pos, roughness, metallic, base.render)
+    build_time = time.perf_counter() - start
+    # look at all the models from above
+    extent = float(np.abs(pos).max()) + 3.0
+    base.camera.set_pos(0, -extent * 1.5, extent * 1.5)
+    base.camera.look_at(0, 0, 0)
+    base.camLens.set_near_far(1.0, extent * 5.0)
+
+    cull_times = []
+    draw_times = []
+    def timer(times):
+        def callback(cbdata):
+            start = time.perf_counter()
+            cbdata.upcall()
+            times.append(time.perf_counter() - start)
+        return p3d.PythonCallbackObject(callback)
+    display_region = base.cam.node().get_display_region(0)
+    display_region.set_cull_callback(timer(cull_times))
+    display_region.set_draw_callback(timer(draw_times))
+    # the first frames upload the textures and compile the shaders
+    for i in range(frames + 2):
+        base.graphics_engine.render_frame()
+    display_region.clear_cull_callback()
+    display_region.clear_draw_callback()
+
+    analyzer = p3d.SceneGraphAnalyzer()
+    analyzer.add_node(root.node())
+    root.remove_node()
+    return {'build': build_time * 1000.0,
+            'geoms': analyzer.get_num_geoms(),
+            'nodes': analyzer.get_num_nodes(),
+            'cull': np.mean(cull_times[2:]) * 1000.0,
+            'draw': np.mean(draw_times[2:]) * 1000.0}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[15, 100, 1000, 10000, 50000])
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--model', default='../../models/monkey')
+    parser.add_argument('--software', action='store_true', help='use the tinydisplay renderer')
+    args = parser.parse_args()
+
+    base = make_base(args.software)
+    model = base.loader.load_model(args.model)
+    model.set_shader(p3d.Shader.load(p3d.Shader.SLGLSL, 'shaders/ibl_v.glsl', 'shaders/ibl_f.glsl'), 1)
+    base.render.set_shader_input('camera', base.cam)
+    env_map = p3d.Texture('env_map')
+    env_map.setup_cube_map(1, p3d.Texture.T_unsigned_byte, p3d.Texture.F_rgb)
+    base.render.set_shader_input('env_map', env_map)
+
+    row = '{:>8} {:>10} {:>10} {:>8} {:>8} {:>10} {:>10}'
+    print(row.format('count', 'way', 'build ms', 'nodes', 'geoms', 'cull ms', 'draw ms'))
+    for count in args.counts:
+        for name, make in (('copy_to', make_copies), ('instanced', make_instances)):
+            result = measure(base, make, model, count, args.frames)
+            print(row.format(count, name, '{:.1f}'.format(result['build']), result['nodes'],
+                             result['geoms'], '{:.3f}'.format(result['cull']),
+                             '{:.3f}'.format(result['draw'])))
@@ -0,0 +1,124 @@
+'''
+Hardware instancing for models that are repeated many times.
+
+Instead of making a copy of the model for each instance (one draw call,
+one state and one cull test each), the model is drawn once with
+set_instance_count() and the shader reads the transform and material of each
+instance from a float texture (using gl_InstanceID).
+
+Each instance uses 5 texels of the texture:
+0-2: the rows of the (3x4) model matrix of the instance
+3: rgb - color, a - roughness
+4: r - metallic
+
+All the instances are one node, so they are culled as a whole, the bounds
+of the node (and of the GeomNodes under it) are set to fit all the instances.
+'''
+import panda3d.core as p3d
+import numpy as np
+
+TEXELS_PER_INSTANCE = 5
+
+
+def rotation_matrices(hpr):
+    '''Returns (n, 3, 3) rotation matrices for (n, 3) heading, pitch, roll
+    angles (in degrees), same as Panda3D uses (row vectors, z-up)'''
+    h, p, r = np.radians(np.asarray(hpr, dtype=np.float64)).T
+    def rotation(angle, a, b):
+        # rotation in the a-b plane (from axis a towards axis b)
+        m = np.zeros((len(angle), 3, 3))
+        m[:, range(3), range(3)] = 1.0
+        c, s = np.cos(angle), np.sin(angle)
+        m[:, a, a] = c
+        m[:, b, b] = c
+        m[:, a, b] = s
+        m[:, b, a] = -s
+        return m
+    # roll (y axis), then pitch (x axis), then heading (z axis)
+    return rotation(r, 2, 0) @ rotation(p, 1, 2) @ rotation(h, 0, 1)
+
+
+def instance_matrices(pos, hpr=None, scale=None):
+    '''Returns (n, 4, 4) matrices (Panda3D convention, like NodePath.get_mat())
+    for instances at pos (shape (n, 3)), with optional hpr (n, 3)
+    and scale (n,) or (n, 3)'''
+    pos = np.asarray(pos, dtype=np.float64).reshape(-1, 3)
+    count = len(pos)
+    mats = np.zeros((count, 4, 4))
+    mats[:, :3, :3] = np.eye(3)
+    if hpr is not None:
+        mats[:, :3, :3] = rotation_matrices(np.broadcast_to(hpr, (count, 3)))
+    if scale is not None:
+        scale = np.asarray(scale, dtype=np.float64)
+        if scale.ndim == 1 and scale.shape[0] == count:
+            scale = scale[:, None]
+        # scale first, then rotate - scaling the rows of the matrix
+        mats[:, :3, :3] *= np.broadcast_to(scale, (count, 3))[:, :, None]
+    mats[:, 3, :3] = pos
+    mats[:, 3, 3] = 1.0
+    return mats
+
+
+def pack_instances(matrices, color=(0.8, 0.8, 0.8), roughness=0.0, metallic=1.0):
+    '''Packs the matrices (n, 4, 4) and material values into a (n, 20) float32 array
+    (5 rgba texels per instance), color, roughness and metallic can be one value
+    for all, or one value for each instance'''
+    matrices = np.asarray(matrices, dtype=np.float32).reshape(-1, 4, 4)
+    count = len(matrices)
+    data = np.zeros((count, TEXELS_PER_INSTANCE, 4), dtype=np.float32)
+    # Panda3D uses row vectors, the shader multiplies column vectors by rows
+    data[:, :3] = matrices[:, :, :3].transpose(0, 2, 1)
+    data[:, 3, :3] = np.broadcast_to(color, (count, 3))
+    data[:, 3, 3] = np.broadcast_to(roughness, (count,))
+    data[:, 4, 0] = np.broadcast_to(metallic, (count,))
+    return data.reshape(count, -1)
+
+
+def make_instance_texture(data, instances_per_row=1024, name='instance_tex'):
+    '''Returns a 2D float texture with the data from pack_instances().
+    Instance i is at texel ((i % instances_per_row) * 5, i // instances_per_row)
+    the shader can find the instances_per_row from the size of the texture'''
+    data = np.ascontiguousarray(data, dtype=np.float32).reshape(-1)
+    count = data.size // (TEXELS_PER_INSTANCE * 4)
+    instances_per_row = max(1, min(count, instances_per_row))
+    rows = max(1, -(-count // instances_per_row))
+    instance_tex = p3d.Texture(name)
+    instance_tex.setup_2d_texture(instances_per_row * TEXELS_PER_INSTANCE, rows,
+                                  p3d.Texture.T_float, p3d.Texture.F_rgba32)
+    instance_tex.set_minfilter(p3d.SamplerState.FT_nearest)
+    instance_tex.set_magfilter(p3d.SamplerState.FT_nearest)
+    instance_tex.set_wrap_u(p3d.SamplerState.WM_clamp)
+    instance_tex.set_wrap_v(p3d.SamplerState.WM_clamp)
+    image = np.frombuffer(instance_tex.modify_ram_image(), dtype=np.float32)
+    image[:data.size] = data
+    return instance_tex
+
+
+def make_instanced_model(model, matrices, parent, color=(0.8, 0.8, 0.8),
+                         roughness=0.0, metallic=1.0):
+    '''Makes a copy of the model under parent, drawn once for each of the matrices
+    (see instance_matrices()), with per instance material values (see pack_instances()).
+    The model needs a shader that reads the instance_tex (like shaders/ibl_v.glsl).
+    Returns the NodePath of the instanced model'''
+    matrices = np.asarray(matrices, dtype=np.float64).reshape(-1, 4, 4)
+    instances = model.copy_to(parent)
+    instances.set_instance_count(len(matrices))
+    instances.set_shader_input('instance_tex', make_instance_texture(
+                                  pack_instances(matrices, color, roughness, metallic)))
+    # the bounds need to fit the model at each instance, at max scale and any rotation
+    lo, hi = model.get_tight_bounds()
+    center = (lo + hi) * 0.5
+    scale = np.linalg.norm(matrices[:, :3, :3], axis=2).max(initial=1.0)
+    pad = p3d.Vec3((hi - lo).length() * 0.5 * scale)
+    centers = matrices[:, 3, :3] + np.array(center) @ matrices[:, :3, :3]
+    bounds = p3d.BoundingBox(p3d.Point3(*centers.min(axis=0)) - pad,
+                             p3d.Point3(*centers.max(axis=0)) + pad)
+    instances.node().set_bounds(bounds)
+    # set_bounds() still adds the bounds of the children, and each Geom would be
+    # culled at its own place, so the GeomNodes need the bounds too (in their own space)
+    for geom_np in instances.find_all_matches('**/+GeomNode'):
+        geom_bounds = bounds.make_copy()
+        geom_bounds.xform(instances.get_transform(geom_np).get_mat())
+        geom_np.node().set_bounds(geom_bounds)
+    instances.node().set_final(True)
+    return instances
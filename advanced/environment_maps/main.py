@@ -11,16 +11,31 @@ applied to lower lods and are compressed using dxt1.
 You can check the 'utilities' folder to check the scpript used to make
 the cube maps.
 
+The cube maps are loaded in the background (see texture_cache.py), the maps
+before and after the current one are loaded ahead of time, so changing maps
+does not stall the game, the old map stays on until the new one is ready.
+
+All the monkeys are drawn with one instanced draw call (see instancing.py).
+
 Instructions:
 - Press *SPACE* to change the environment map
 - Default mouse diver for camera movement
 '''
 import os
+import sys
 import panda3d.core as p3d
 p3d.load_prc_file_data('', 'framebuffer-srgb 1')
 p3d.load_prc_file_data('', 'multisamples 1')
 from direct.showbase.ShowBase import ShowBase
 
+from texture_cache import TextureCache
+import instancing
+#the utilities are two levels up
+sys.path.append('../..')
+from utilities import assets
+from utilities import profiling
+from utilities import skybox
+
 FT_LINEAR = p3d.SamplerState.FT_linear
 FT_NEAREST = p3d.SamplerState.FT_nearest
 FT_MIPMAP = p3d.SamplerState.FT_linear_mipmap_linear
@@ -30,75 +45,73 @@ F_SRGB =p3d.Texture.F_srgb
 class App(ShowBase):
     def __init__(self):
         super().__init__(self)
+        #record the profiling times to a csv file, if asked to (see utilities/profiling.py)
+        profiling.enable()
         #move the cam back without breaking the default mouse driver
         self.trackball.node().set_pos(0, 20, 0)
         #MSAA just for making thinkgs look good
         self.render.set_antialias(p3d.AntialiasAttrib.M_multisample)
 
-        self.env_maps=[]
-        for filename in os.listdir('../../models/texture/cubemap'):
-            self.env_maps.append('../../models/texture/cubemap/'+filename)
+        self.env_maps=sorted('../../models/texture/cubemap/'+filename
+                             for filename in os.listdir('../../models/texture/cubemap')
+                             if filename.endswith('.txo'))
         self.curren_env_map=0
-        #the map_sky will be used for the skybox
-        #the other one, blurred and at a lower resolution as the environment map
-        self.map_env=self.loader.load_texture(self.env_maps[0])
-
-        #make sure it's sRGB
-        if  p3d.ConfigVariableBool('framebuffer-srgb').get_value():
-            self.map_env.set_format(F_SRGB)
-        #apply texture to render
-        self.render.set_shader_input('env_map', self.map_env)
+        #keep up to 256MB of cube maps around, loaded in a background thread
+        self.env_map_cache=TextureCache(self.taskMgr, 256*1024*1024, self.setup_env_map)
+        #the first map is needed right now, the next and previous are loaded in the background
+        with profiling.timer('Startup:load env map'):
+            self.set_env_map(0, self.env_map_cache.load(self.env_maps[0]))
+        self.prefetch_maps()
          #camera pos is needed by the shaders
         self.render.set_shader_input("camera", self.cam)
         #load a model and do some setup
-        model=self.loader.load_model('../../models/monkey')
+        model=assets.load_model('../../models/monkey')
         model.set_shader(p3d.Shader.load(GLSL, 'shaders/ibl_v.glsl', 'shaders/ibl_f.glsl'), 1)
-        model.set_shader_input('roughness', 0.0)
-        model.set_shader_input('metallic', 1.0)
-        model.set_shader_input('color', p3d.Vec3(0.8, 0.8, 0.8))
-        #copy it a few times
-        monkeys=[model.copy_to(render) for _ in range(15)]
-        #move and apply different values
-        for i, monkey in enumerate(monkeys[:5]):
-            monkey.set_pos((i*3)-6, 0, 0)
-            monkey.set_shader_input('roughness', i/4.0)
-        for i, monkey in enumerate(monkeys[5:10]):
-            monkey.set_pos((i*3)-6, 5, 0)
-            monkey.set_shader_input('roughness', i/4.0)
-            monkey.set_shader_input('metallic', 0.5)
-        for i, monkey in enumerate(monkeys[10:]):
-            monkey.set_pos((i*3)-6, 10, 0)
-            monkey.set_shader_input('roughness', i/4.0)
-            monkey.set_shader_input('metallic', 0.0)
-        #make skybox
-        self.sky_box=self.loader.load_model('../../models//box')
-        self.sky_box.reparent_to(self.render)
-        self.sky_box.set_scale(10)
-        self.sky_box.set_shader(p3d.Shader.load(GLSL, 'shaders/skybox_v.glsl', 'shaders/skybox_f.glsl'), 1)
-        self.sky_box.set_shader_input('blur', 0.0)
-        self.sky_box.set_bin('background', 100)
-        self.sky_box.set_depth_test(False)
-        self.sky_box.set_depth_write(False)
-        #add a task to update the skybox
-        self.taskMgr.add(self.update, 'update')
+        #draw the model 15 times, in 3 rows of 5, with one instanced draw call
+        #roughness goes up along each row, each row is less metallic
+        #the transform and material of each monkey is read by the shader (see instancing.py)
+        pos=[((i*3)-6, row*5, 0) for row in range(3) for i in range(5)]
+        roughness=[i/4.0 for row in range(3) for i in range(5)]
+        metallic=[m for m in (1.0, 0.5, 0.0) for i in range(5)]
+        with profiling.timer('Startup:pack instances'):
+            self.monkeys=instancing.make_instanced_model(model, instancing.instance_matrices(pos),
+                                                         self.render, color=(0.8, 0.8, 0.8),
+                                                         roughness=roughness, metallic=metallic)
+        #make skybox, it follows the camera on its own (see utilities/skybox.py)
+        #the cube map is the 'env_map' input already set on render
+        self.sky_box=skybox.make_skybox(self.render, self.cam)
 
         #press space to change the environment texture
         self.accept('space', self.cycle_map)
 
+    def setup_env_map(self, texture):
+        '''Called for each loaded cube map (in the loading thread)'''
+        #make sure it's sRGB
+        if  p3d.ConfigVariableBool('framebuffer-srgb').get_value():
+            texture.set_format(F_SRGB)
+
+    def set_env_map(self, index, texture):
+        '''Apply the cube map, unless another map was picked while this one was loading'''
+        if index == self.curren_env_map:
+            self.map_env=texture
+            self.render.set_shader_input('env_map', self.map_env)
+
+    def prefetch_maps(self):
+        '''Start loading the maps next to the current one, so they are ready when needed'''
+        nearby=[self.env_maps[(self.curren_env_map+i)%len(self.env_maps)] for i in (0, 1, -1)]
+        self.env_map_cache.pinned=set(nearby)
+        for path in nearby[1:]:
+            self.env_map_cache.request(path)
+
     def cycle_map(self):
         '''Change the environment map'''
         self.curren_env_map+=1
         if self.curren_env_map >= len(self.env_maps):
             self.curren_env_map=0
-        self.map_env=self.loader.load_texture(self.env_maps[self.curren_env_map])
-        if  p3d.ConfigVariableBool('framebuffer-srgb').get_value():
-            self.map_env.set_format(F_SRGB)
-        self.render.set_shader_input('env_map', self.map_env)
-
-    def update(self, task):
-        ''' Per frame update task'''
-        self.sky_box.set_pos(self.cam.get_pos(render))
-        return task.cont
+        #the old map stays on until the new one is loaded
+        self.env_map_cache.request(self.env_maps[self.curren_env_map],
+                                   self.set_env_map, [self.curren_env_map])
+        self.prefetch_maps()
 
 app=App()
 app.run()
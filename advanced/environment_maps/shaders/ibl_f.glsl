@@ -1,18 +1,21 @@
-#version 130
+#version 140
 //NOTE: This shader is *NOT* PBR!
 uniform samplerCube env_map;
-uniform float roughness;
-uniform float metallic;
-uniform vec3 color;
-
 
 in vec3 V;
 in vec3 N;
+//per instance material, see ibl_v.glsl
+flat in vec3 COLOR;
+flat in float ROUGHNESS;
+flat in float METALLIC;
 
 out vec4 final_color;
 
 void main()
 {
+    vec3 color=COLOR;
+    float roughness=ROUGHNESS;
+    float metallic=METALLIC;
     vec3 n=normalize(N);
     vec3 v=normalize(V);
     //uv for the reflection
@@ -1,5 +1,5 @@
 //GLSL
-#version 130
+#version 140
 in vec4 p3d_Vertex;
 in vec3 p3d_Normal;
 
@@ -8,14 +8,36 @@ uniform mat4 p3d_ModelMatrix;
 uniform mat4 p3d_ModelMatrixInverseTranspose;
 
 uniform vec3 wspos_camera;
+uniform sampler2D instance_tex;
 
 out vec3 V;
 out vec3 N;
+flat out vec3 COLOR;
+flat out float ROUGHNESS;
+flat out float METALLIC;
 
 void main()
     {
-    gl_Position = p3d_ModelViewProjectionMatrix * p3d_Vertex;
+    //per instance data read from the instance texture, see python code (instancing.py)
+    //each instance uses 5 texels:
+    //0-2: rows of the model matrix of the instance
+    //3: rgb - color, a - roughness
+    //4: r - metallic
+    int instances_per_row = textureSize(instance_tex, 0).x/5;
+    ivec2 uv = ivec2((gl_InstanceID % instances_per_row)*5, gl_InstanceID / instances_per_row);
+    mat4 instance_matrix = transpose(mat4(texelFetch(instance_tex, uv, 0),
+                                          texelFetch(instance_tex, uv+ivec2(1, 0), 0),
+                                          texelFetch(instance_tex, uv+ivec2(2, 0), 0),
+                                          vec4(0.0, 0.0, 0.0, 1.0)));
+    vec4 material = texelFetch(instance_tex, uv+ivec2(3, 0), 0);
+    COLOR = material.rgb;
+    ROUGHNESS = material.a;
+    METALLIC = texelFetch(instance_tex, uv+ivec2(4, 0), 0).r;
 
-    N=(p3d_ModelMatrixInverseTranspose* vec4(p3d_Normal, 1.0)).xyz;
-    V= vec3(p3d_ModelMatrix * p3d_Vertex - vec4(wspos_camera, 1.0)).xyz;
+    vec4 vert = instance_matrix * p3d_Vertex;
+    gl_Position = p3d_ModelViewProjectionMatrix * vert;
+    //this is only right for uniform scale, good enough here
+    vec3 normal = normalize(mat3(instance_matrix) * p3d_Normal);
+    N=(p3d_ModelMatrixInverseTranspose* vec4(normal, 0.0)).xyz;
+    V= vec3(p3d_ModelMatrix * vert - vec4(wspos_camera, 1.0)).xyz;
     }
@@ -0,0 +1,112 @@
+'''
+A cache for (big) textures that are loaded in the background.
+
+Textures are read on a threaded task chain, so loading them never blocks a frame,
+the textures that are loaded are kept in a LRU cache with a size limit in bytes
+(estimated video memory, see Texture.estimate_texture_memory()).
+The textures are not put in the TexturePool, so when a texture is dropped
+from the cache it's really gone (and released from the GPU).
+If a texture can't be loaded in the background a warning is logged,
+the callbacks are not called, and the texture can be requested again.
+'''
+import panda3d.core as p3d
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+from collections import OrderedDict
+
+class TextureCache:
+    notify = directNotify.newCategory('TextureCache')
+
+    def __init__(self, task_mgr, max_bytes=256*1024*1024, setup=None):
+        '''task_mgr - the task manager (eg. ShowBase.taskMgr)
+        max_bytes - how big can the cache get
+        setup - a function called with each texture after it's loaded (in the loading thread)'''
+        self.task_mgr = task_mgr
+        self.max_bytes = max_bytes
+        self.setup = setup
+        self.textures = OrderedDict()
+        self.size = 0
+        # textures we are waiting for, and the functions to call when they load
+        self.pending = {}
+        # textures that should not be dropped from the cache
+        self.pinned = set()
+        self.task_mgr.setupTaskChain('texture_cache', numThreads=1,
+                                     threadPriority=p3d.TP_low)
+
+    def get(self, path):
+        '''Returns the texture if it's in the cache, else None'''
+        if path in self.textures:
+            self.textures.move_to_end(path)
+            return self.textures[path]
+        return None
+
+    def load(self, path):
+        '''Loads the texture right now, in this thread, and returns it'''
+        texture = self.get(path)
+        if texture is None:
+            texture = self._read(path)
+            self._add(path, texture)
+        return texture
+
+    def request(self, path, callback=None, extra_args=[]):
+        '''Loads the texture in the background, when the texture is ready
+        callback(*extra_args, texture) is called (in the main thread).
+        If the texture is already in the cache the callback is called right away'''
+        texture = self.get(path)
+        if texture is not None:
+            if callback:
+                callback(*extra_args, texture)
+            return
+        if path not in self.pending:
+            self.pending[path] = []
+            self.task_mgr.add(self._load_task, 'texture_cache_load', extraArgs=[path],
+                              taskChain='texture_cache')
+        if callback:
+            self.pending[path].append((callback, extra_args))
+
+    def _read(self, path):
+        texture = p3d.Texture()
+        if not texture.read(path):
+            raise IOError('Could not load texture: '+path)
+        if self.setup:
+            self.setup(texture)
+        return texture
+
+    def _load_task(self, path):
+        # this runs in the 'texture_cache' thread
+        try:
+            texture = self._read(path)
+        except Exception as error:
+            # nothing would catch it in this thread, the main thread has to know it failed
+            self.notify.warning(str(error))
+            texture = None
+        # hand the texture over to the main thread
+        self.task_mgr.add(self._loaded_task, 'texture_cache_loaded', extraArgs=[path, texture])
+
+    def _loaded_task(self, path, texture):
+        callbacks = self.pending.pop(path, [])
+        if texture is None:
+            # failed, it's not pending anymore so it can be requested again
+            return
+        self._add(path, texture)
+        for callback, extra_args in callbacks:
+            callback(*extra_args, texture)
+
+    def _add(self, path, texture):
+        if path in self.textures:
+            return
+        self.textures[path] = texture
+        self.size += texture.estimate_texture_memory()
+        self._evict()
+
+    def _evict(self):
+        '''Drops the least recently used textures until the cache fits in max_bytes'''
+        for path in list(self.textures):
+            if self.size <= self.max_bytes:
+                break
+            # never drop the texture that was just added, or one that is pinned
+            if path in self.pinned or path == next(reversed(self.textures)):
+                continue
+            texture = self.textures.pop(path)
+            self.size -= texture.estimate_texture_memory()
+            texture.release_all()
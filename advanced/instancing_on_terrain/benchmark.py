@@ -0,0 +1,291 @@
+'''
+Headless checks and timings for the instancing_on_terrain sample.
+No window is opened, run it from this directory:
+
+python benchmark.py placement
+    compares grass.place_grass() with the old per-pixel loop
+    (ShaderTerrainMesh.uv_to_world() for each grass blade) and times both
+
+python benchmark.py cache
+    times building the grass instance cache and loading it,
+    checks that the cached data matches and that a rebuild gives the same result
+
+python benchmark.py gpu
+    checks the CPU reference of the GPU grass placement (grass.gpu_placement_reference(),
+    the same math as shaders/grass_gpu_v.glsl) against the CPU placement and
+    ShaderTerrainMesh.uv_to_world(), and counts the instances in the tiles
+
+python benchmark.py culling [--software] [--no-lod] [--occlusion] [--gpu]
+    flies the camera along a fixed path, renders into an offscreen buffer
+    and reports how many grass instances (and vertices) are visible, how long
+    the frames and the cull traversal take, use --software on machines without a GPU,
+    --no-lod to compare with the full model used at all distances,
+    --occlusion to also cull the chunks hidden by the terrain (see occlusion.py, off in main.py by default),
+    --gpu to use the grass placed on the GPU (the instances counted include the empty cells)
+'''
+import panda3d.core as p3d
+import numpy as np
+
+import argparse
+import math
+import time
+
+import grass
+import occlusion
+import terrain
+
+
+def make_terrain():
+    '''Returns a ShaderTerrainMesh set up just like in main.py'''
+    return terrain.make_terrain_node(p3d.TexturePool.load_texture(terrain.HEIGHTFIELD))
+
+
+def timed(function, *args, **kwargs):
+    '''Returns the result of function(*args, **kwargs) and the time it took'''
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def bench_placement(args):
+    terrain_node = make_terrain()
+    grass_list, ref_time = timed(grass.place_grass_reference, terrain_node, terrain.GRASS_MASK)
+    positions, new_time = timed(grass.place_grass, terrain_node, terrain.GRASS_MASK, seed=0)
+    print('reference: {} instances in {:.3f}s'.format(len(grass_list), ref_time))
+    print('numpy:     {} instances in {:.3f}s ({:.1f}x faster)'.format(len(positions),
+                                                                       new_time,
+                                                                       ref_time/new_time))
+    # the jitter is random, so check the height lookup and transform on the same UVs
+    uvs = grass.mask_to_uvs(grass.read_mask(terrain.GRASS_MASK), seed=0)
+    heightfield = grass.texture_to_array(terrain_node.heightfield)
+    positions = grass.uvs_to_world(terrain_node, heightfield, uvs)
+    expected = np.array([tuple(terrain_node.uv_to_world(u, v)) for u, v in uvs])
+    error = np.abs(positions - expected).max(initial=0.0)
+    print('max position error vs uv_to_world(): {:.6f}'.format(error))
+    if len(grass_list) != len(positions) or error > args.tolerance:
+        raise SystemExit('placement does not match the reference!')
+
+
+def bench_cache(args):
+    terrain_node = make_terrain()
+    cache_file = 'cache/benchmark_grass.bin'
+    built, build_time = timed(grass.load_or_build_instances, terrain_node, terrain.GRASS_MASK,
+                              cache_file, force=True)
+    loaded, load_time = timed(grass.load_or_build_instances, terrain_node, terrain.GRASS_MASK, cache_file)
+    print('build: {:.3f}s, load from cache: {:.3f}s'.format(build_time, load_time))
+    if not all(np.array_equal(a, b) for a, b in zip(built, loaded)):
+        raise SystemExit('cached instances do not match!')
+    rebuilt = grass.load_or_build_instances(terrain_node, terrain.GRASS_MASK, cache_file, force=True)
+    if not all(np.array_equal(a, b) for a, b in zip(built, rebuilt)):
+        raise SystemExit('building the instances again gave a different result!')
+    print('cache matches, and the placement is deterministic')
+
+
+def bench_gpu(args):
+    terrain_node = make_terrain()
+    positions, cpu_time = timed(grass.place_grass, terrain_node, terrain.GRASS_MASK, seed=0)
+    (mask, mask_tex), mask_time = timed(grass.read_mask_texture, terrain.GRASS_MASK)
+    # all the cells of the mask, to check the cells the tiles draw
+    y, x = np.mgrid[0:mask.shape[0], 0:mask.shape[1]]
+    cells = np.stack([x.ravel(), y.ravel()], axis=1)
+    heightfield = grass.texture_to_array(terrain_node.heightfield)
+    terrain_pos, terrain_scale = grass.terrain_pos_scale(terrain_node)
+    (has_grass, data, keep), ref_time = timed(grass.gpu_placement_reference, mask, heightfield,
+                                              terrain_pos, terrain_scale, cells)
+    print('CPU placement: {} instances, {:.3f}s'.format(len(positions), cpu_time))
+    print('GPU placement: {} instances, {:.3f}s startup (reading the mask), '
+          'CPU reference took {:.3f}s'.format(int(has_grass.sum()), mask_time, ref_time))
+    # the mask is quantized to 8 bit for the GPU, pixels right at the threshold may differ
+    if abs(int(has_grass.sum()) - len(positions)) > len(positions) * 0.001:
+        raise SystemExit('the GPU placement has a different number of instances!')
+    placed = data[has_grass]
+    sample = np.random.default_rng(0).choice(len(placed), min(1000, len(placed)), replace=False)
+    uvs = (placed[sample, :2] - np.array(terrain_pos)[:2]) / np.array(terrain_scale)[:2]
+    expected = np.array([tuple(terrain_node.uv_to_world(u, v)) for u, v in uvs])
+    error = np.abs(placed[sample, :3] - expected).max(initial=0.0)
+    print('max position error vs uv_to_world(): {:.6f}'.format(error))
+    if error > args.tolerance:
+        raise SystemExit('the GPU placement does not match uv_to_world()!')
+    again = grass.gpu_placement_reference(mask, heightfield, terrain_pos, terrain_scale, cells)
+    if not all(np.array_equal(a, b) for a, b in zip((has_grass, data, keep), again)):
+        raise SystemExit('the GPU placement is not deterministic!')
+    # the tiles drawn by the GPU placement, with the LOD bands used in main.py
+    grass_model = p3d.NodePath(p3d.Loader.get_global_ptr().load_sync('../../models/grass'))
+    grass_root, tiles_time = timed(grass.make_gpu_grass, grass_model, terrain_node, terrain.GRASS_MASK,
+                                   p3d.NodePath('root'), tile_size=args.tile_size)
+    cell_tex = grass_root.get_shader_input('grass_cells').get_texture()
+    cell_list = np.frombuffer(cell_tex.get_ram_image(), dtype=np.int32)
+    # do what the shader does - the instances of each band are the cells from cell_offset on
+    drawn = []
+    for tile in grass_root.get_children():
+        # keep the ShaderInput, get_vector() of a temporary one reads freed memory
+        cell_offset = tile.get_shader_input('cell_offset')
+        offset = int(cell_offset.get_vector()[0])
+        bounds = tile.get_child(0).node().get_bounds()
+        for i, band in enumerate(tile.get_children()):
+            # the cells are x + y * mask width, the same order as the cells above
+            band_cells = cell_list[offset:offset + band.get_instance_count()]
+            if not np.all(has_grass[band_cells]):
+                raise SystemExit('a GPU grass tile draws a cell without grass!')
+            density = band.get_shader_input('density')
+            if not np.all(keep[band_cells] < density.get_vector()[0]):
+                raise SystemExit('a GPU grass band draws grass it should not keep!')
+            if not all(bounds.contains(p3d.Point3(*pos)) for pos in data[band_cells, :3]):
+                raise SystemExit('the grass is out of the bounds of its GPU grass tile!')
+            if i == 0:
+                drawn.append(band_cells)
+    drawn = np.concatenate(drawn)
+    if len(drawn) != has_grass.sum() or not np.array_equal(np.sort(drawn), np.nonzero(has_grass)[0]):
+        raise SystemExit('the GPU grass tiles do not draw each cell with grass once!')
+    print('{} tiles in {:.3f}s, {} instances in all the tiles (of {} mask pixels), '
+          'cell list: {} bytes (CPU placement instance data: {} bytes)'.format(
+          grass_root.get_num_children(), tiles_time, len(drawn), mask.size,
+          cell_tex.get_ram_image_size(), len(positions) * 9 * 4))
+    print('run: benchmark.py culling --gpu, for the instances drawn each frame')
+
+
+def make_base(software=False):
+    '''Returns a ShowBase rendering to an offscreen buffer'''
+    if software:
+        p3d.load_prc_file_data('', 'load-display p3tinydisplay')
+    p3d.load_prc_file_data('', 'sync-video 0')
+    from direct.showbase.ShowBase import ShowBase
+    base = ShowBase(windowType='offscreen')
+    base.disable_mouse()
+    return base
+
+
+def camera_path(frames, radius=180.0, height=20.0):
+    '''Yields (pos, look_at) for a camera flying in a circle over the terrain,
+    looking ahead, along the path'''
+    for frame in range(frames):
+        angle = 2.0 * math.pi * frame / frames
+        ahead = angle + 0.5
+        yield ((math.cos(angle) * radius, math.sin(angle) * radius, height),
+               (math.cos(ahead) * radius, math.sin(ahead) * radius, 0.0))
+
+
+def vertex_count(model):
+    '''Returns the number of vertices in all the geoms of a model'''
+    return sum(geom.get_vertex_data().get_num_rows()
+               for geom_np in model.find_all_matches('**/+GeomNode')
+               for geom in geom_np.node().get_geoms())
+
+
+def count_visible(grass_root):
+    '''Adds a CallbackNode to each chunk (and LOD) of grass, the callback is only run
+    for chunks that pass the cull traversal.
+    Returns a list with the number of instances and vertices seen since the last reset'''
+    visible = [0, 0]
+    def add(cbdata, count, vertices):
+        visible[0] += count
+        visible[1] += count * vertices
+    for chunk in grass_root.find_all_matches('**/+LODNode/*'):
+        counter = p3d.CallbackNode('counter')
+        counter.set_cull_callback(p3d.PythonCallbackObject(
+            lambda cbdata, count=chunk.get_instance_count(), vertices=vertex_count(chunk):
+                add(cbdata, count, vertices)))
+        chunk.attach_new_node(counter)
+    return visible
+
+
+def bench_culling(args):
+    base = make_base(args.software)
+    terrain_node = make_terrain()
+    positions = grass.place_grass(terrain_node, terrain.GRASS_MASK, seed=0)
+    grass_model = base.loader.load_model('../../models/grass')
+    if args.gpu:
+        grass_root = grass.make_gpu_grass(grass_model, terrain_node, terrain.GRASS_MASK, base.render,
+                                          clip_distance=args.clip_distance,
+                                          lod_distances=None if args.no_lod else (40.0, 80.0),
+                                          tile_size=args.chunk_size)
+        print('{} instances placed on the GPU, in {} tiles'.format(len(positions),
+                                                                   grass_root.get_num_children()))
+    else:
+        instances = grass.build_instances(positions, args.chunk_size, seed=0)
+        grass_root = grass.make_grass(grass_model, instances, base.render,
+                                      clip_distance=args.clip_distance,
+                                      lod_distances=None if args.no_lod else (40.0, 80.0))
+        print('{} instances in {} chunks'.format(len(positions), len(instances[2])))
+    occluder = None
+    occlusion_times = []
+    if args.occlusion:
+        # the rays are marched in a thread, the time of the update in the main thread is measured
+        occluder = occlusion.GrassOcclusion(grass_root, terrain_node, base.camera,
+                                            task_mgr=base.taskMgr, max_distance=args.clip_distance)
+        update = occluder.update
+        def timed_update():
+            occlusion_times.append(timed(update)[1])
+        occluder.update = timed_update
+    # the time of the cull traversal is measured in a display region callback
+    cull_times = []
+    def time_cull(cbdata):
+        start = time.perf_counter()
+        cbdata.upcall()
+        cull_times.append(time.perf_counter() - start)
+    display_region = base.cam.node().get_display_region(0)
+    display_region.set_cull_callback(p3d.PythonCallbackObject(time_cull))
+    # first pass - time the frames (the whole task manager step, with the occlusion update,
+    # the occlusion is tested while the camera flies, the cells are not cached yet)
+    frame_times = []
+    for pos, look_at in camera_path(args.frames):
+        start = time.perf_counter()
+        base.camera.set_pos(pos)
+        base.camera.look_at(look_at)
+        base.taskMgr.step()
+        frame_times.append(time.perf_counter() - start)
+    # second pass - count visible instances (the callbacks would skew the times)
+    display_region.clear_cull_callback()
+    visible = count_visible(grass_root)
+    visible_counts = []
+    visible_vertices = []
+    for pos, look_at in camera_path(args.frames):
+        base.camera.set_pos(pos)
+        base.camera.look_at(look_at)
+        visible[:] = [0, 0]
+        base.taskMgr.step()
+        visible_counts.append(visible[0])
+        visible_vertices.append(visible[1])
+    cull_times = np.array(cull_times) * 1000.0
+    frame_times = np.array(frame_times) * 1000.0
+    print('visible instances: mean {:.0f}, min {}, max {} ({:.1f}% of all on average)'.format(
+          np.mean(visible_counts), min(visible_counts), max(visible_counts),
+          100.0 * np.mean(visible_counts) / max(1, len(positions))))
+    print('visible vertices: mean {:.0f}, max {}'.format(np.mean(visible_vertices),
+                                                         max(visible_vertices)))
+    print('frame time: mean {:.3f}ms, max {:.3f}ms'.format(frame_times.mean(), frame_times.max()))
+    print('cull time: mean {:.3f}ms, max {:.3f}ms'.format(cull_times.mean(), cull_times.max()))
+    if occluder:
+        occlusion_times = np.array(occlusion_times) * 1000.0
+        print('occlusion update (main thread): mean {:.3f}ms, max {:.3f}ms, {} camera cells tested'.format(
+              occlusion_times.mean(), occlusion_times.max(), len(occluder.cells)))
+        occluder.destroy()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+    placement = subparsers.add_parser('placement', help='check and time grass placement')
+    placement.add_argument('--tolerance', type=float, default=0.01)
+    placement.set_defaults(run=bench_placement)
+    cache = subparsers.add_parser('cache', help='check and time the instance cache')
+    cache.set_defaults(run=bench_cache)
+    gpu = subparsers.add_parser('gpu', help='check the GPU grass placement')
+    gpu.add_argument('--tolerance', type=float, default=0.01)
+    gpu.add_argument('--tile-size', type=float, default=16.0)
+    gpu.set_defaults(run=bench_gpu)
+    culling = subparsers.add_parser('culling', help='count visible grass and time culling')
+    culling.add_argument('--frames', type=int, default=300)
+    culling.add_argument('--chunk-size', type=float, default=32.0)
+    culling.add_argument('--clip-distance', type=float, default=125.0)
+    culling.add_argument('--no-lod', action='store_true', help='use the full model at all distances')
+    culling.add_argument('--gpu', action='store_true',
+                         help='use the grass placed on the GPU, --chunk-size sets the tile size')
+    culling.add_argument('--occlusion', action='store_true',
+                         help='also cull the chunks hidden by the terrain')
+    culling.add_argument('--software', action='store_true', help='use the tinydisplay renderer')
+    culling.set_defaults(run=bench_culling)
+    args = parser.parse_args()
+    args.run(args)
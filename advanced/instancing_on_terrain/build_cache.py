@@ -0,0 +1,35 @@
+'''
+Builds the grass instance cache (cache/grass.bin) and the terrain normal map
+(cache/terrain_normal_*.txo) used by main.py.
+main.py will also build it if it's missing or out of date,
+this is for doing it ahead of time (eg. as part of a build).
+
+python build_cache.py [--force]
+'''
+import panda3d.core as p3d
+
+import argparse
+import time
+
+import grass
+import terrain
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--force', action='store_true', help='rebuild even if the cache is up to date')
+    parser.add_argument('--chunk-size', type=float, default=32.0)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    heightfield = p3d.TexturePool.load_texture(terrain.HEIGHTFIELD)
+    terrain_node = terrain.make_terrain_node(heightfield)
+    data, keep, chunks = grass.load_or_build_instances(terrain_node, terrain.GRASS_MASK,
+                                                       chunk_size=args.chunk_size,
+                                                       force=args.force)
+    print('{}: {} instances in {} chunks, {:.3f}s'.format(grass.CACHE_FILE, len(data),
+                                                         len(chunks), time.perf_counter() - start))
+
+    start = time.perf_counter()
+    terrain.load_or_build_normal_map(heightfield, force=args.force)
+    print('{}: {:.3f}s'.format(terrain.normal_map_file(heightfield), time.perf_counter() - start))
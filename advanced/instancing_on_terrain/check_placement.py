@@ -0,0 +1,38 @@
+'''
+Checks that grass.place_grass() (numpy) still places the grass just like
+grass.place_grass_reference() (the old per-pixel loop with ShaderTerrainMesh.uv_to_world()).
+No window is needed, run it from this directory:
+
+python check_placement.py [--tolerance 0.01]
+
+Both are run without the jitter, so they place the grass on the same UVs (in the
+same order), the number of instances has to be the same and no position can be
+more than tolerance units away from the reference.
+The exit code is 1 if the check fails.
+'''
+import panda3d.core as p3d
+import numpy as np
+
+import argparse
+
+import grass
+import terrain
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tolerance', type=float, default=0.01, help='max position error, in world units')
+    args = parser.parse_args()
+
+    terrain_node = terrain.make_terrain_node(p3d.TexturePool.load_texture(terrain.HEIGHTFIELD))
+    expected = np.array([tuple(point) for point in
+                         grass.place_grass_reference(terrain_node, terrain.GRASS_MASK, jitter=0.0)])
+    positions = grass.place_grass(terrain_node, terrain.GRASS_MASK, jitter=0.0)
+    print('reference: {} instances, place_grass(): {} instances'.format(len(expected), len(positions)))
+    if len(positions) != len(expected):
+        raise SystemExit('place_grass() makes a different number of instances than the reference!')
+    error = np.abs(positions - expected.reshape(-1, 3)).max(initial=0.0)
+    print('max position error: {:.6f}'.format(error))
+    if error > args.tolerance:
+        raise SystemExit('place_grass() does not match the reference!')
+    print('OK')
@@ -0,0 +1,631 @@
+'''
+Grass placement helpers for the instancing_on_terrain sample.
+
+Placing grass pixel by pixel with PNMImage.get_bright() and
+ShaderTerrainMesh.uv_to_world() is simple, but slow for big masks
+(one Python call per pixel, and one more per grass blade).
+Here the mask and the heightfield are read as NumPy arrays in one go
+and all the grass positions are computed at once.
+
+place_grass_reference() is the old per-pixel loop, it's kept around
+so the results can be compared (see benchmark.py)
+
+pack_instances() and make_instance_texture() pack the positions
+(and rotation, scale and color) for the GPU
+
+make_grass() puts it all together, the grass is split into a grid of chunks,
+each chunk is a node with its own bounds and range of instances,
+so Panda3D can cull chunks outside the view frustum (and LODNodes
+cull chunks that are too far away) - without drawing all instances every frame.
+The LODNodes also switch chunks to a simpler model (a card) at mid range,
+and draw fewer instances far away, so the vertex work follows what's in view.
+
+load_or_build_instances() keeps all of the above in a binary cache file,
+keyed by a hash of the heightfield, mask and params, so on the next run
+the file can be just memory mapped (and the grass is the same each time).
+'''
+import panda3d.core as p3d
+import numpy as np
+
+import hashlib
+import os
+import random
+import struct
+
+# luminance weights used by PNMImage.get_bright()
+LUMINANCE = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+# numpy types for the Texture component types we may get from a heightfield
+COMPONENT_TYPES = {p3d.Texture.T_unsigned_byte: np.uint8,
+                   p3d.Texture.T_unsigned_short: np.uint16,
+                   p3d.Texture.T_float: np.float32}
+
+
+def texture_to_array(texture, channels='R'):
+    '''Returns the ram image of a texture as a float32 array in the 0.0-1.0 range.
+    The array has the shape (y_size, x_size, len(channels)),
+    rows are bottom to top - same as texture UVs'''
+    dtype = COMPONENT_TYPES[texture.get_component_type()]
+    data = np.frombuffer(texture.get_ram_image_as(channels), dtype=dtype)
+    data = data.reshape(texture.get_y_size(), texture.get_x_size(), len(channels))
+    if dtype == np.float32:
+        return data
+    return data.astype(np.float32) / np.iinfo(dtype).max
+
+
+def read_mask(filename):
+    '''Reads an image and returns its brightness (like PNMImage.get_bright())
+    as an array with the shape (y_size, x_size), rows are top to bottom - same as PNMImage'''
+    image = p3d.PNMImage()
+    image.read(filename)
+    texture = p3d.Texture()
+    # we want the real size of the mask, not the nearest power of 2
+    texture.set_auto_texture_scale(p3d.ATS_none)
+    texture.load(image)
+    rgb = texture_to_array(texture, 'RGB')
+    return np.dot(rgb, LUMINANCE)[::-1]
+
+
+def mask_to_uvs(mask, threshold=0.5, jitter=0.001, seed=None):
+    '''Returns the terrain UVs (shape (n, 2)) for all pixels of the mask brighter
+    than the threshold, with a random offset to avoid a 'grass grid'.
+    The order is the same as a x/y nested loop over the mask'''
+    y_size, x_size = mask.shape
+    # transposing makes nonzero() walk x first, then y
+    x, y = np.nonzero(mask.T > threshold)
+    uvs = np.empty((x.size, 2), dtype=np.float64)
+    # flip the y because OpenGL UVs...
+    uvs[:, 0] = x / x_size
+    uvs[:, 1] = 1.0 - y / y_size
+    rng = np.random.default_rng(seed)
+    uvs += rng.uniform(-jitter, jitter, uvs.shape)
+    return np.clip(uvs, 0.0, 1.0, out=uvs)
+
+
+def sample_bilinear(image, uvs):
+    '''Bilinear lookup of a (y_size, x_size) image at the given UVs.
+    Pixels outside the image are skipped, just like TexturePeeker.lookup_bilinear() does'''
+    y_size, x_size = image.shape
+    u = uvs[:, 0] * x_size - 0.5
+    v = uvs[:, 1] * y_size - 0.5
+    u0 = np.floor(u)
+    v0 = np.floor(v)
+    fu = u - u0
+    fv = v - v0
+    u0 = u0.astype(np.intp)
+    v0 = v0.astype(np.intp)
+    value = np.zeros(u.shape)
+    net_weight = np.zeros(u.shape)
+    for du, dv, weight in ((0, 0, (1.0 - fu) * (1.0 - fv)),
+                           (1, 0, fu * (1.0 - fv)),
+                           (0, 1, (1.0 - fu) * fv),
+                           (1, 1, fu * fv)):
+        x = u0 + du
+        y = v0 + dv
+        weight *= (x >= 0) & (x < x_size) & (y >= 0) & (y < y_size)
+        value += image[np.clip(y, 0, y_size - 1), np.clip(x, 0, x_size - 1)] * weight
+        net_weight += weight
+    return value / net_weight
+
+
+def mat_to_array(mat):
+    '''Converts a LMatrix4 to a numpy array'''
+    return np.array([tuple(mat.get_row(i)) for i in range(4)])
+
+
+def uvs_to_world(terrain_node, heightfield, uvs):
+    '''Vectorized ShaderTerrainMesh.uv_to_world(),
+    heightfield is the array returned by texture_to_array(terrain_node.heightfield)'''
+    points = np.empty((len(uvs), 4))
+    points[:, :2] = uvs
+    points[:, 2] = sample_bilinear(heightfield[:, :, 0], uvs)
+    points[:, 3] = 1.0
+    # Panda3D uses row vectors, so it's point*matrix
+    points = points @ mat_to_array(terrain_node.get_transform().get_mat())
+    return (points[:, :3] / points[:, 3:]).astype(np.float32)
+
+
+def place_grass(terrain_node, mask_file, threshold=0.5, jitter=0.001, seed=None):
+    '''Returns the world positions (float32 array, shape (n, 3)) of grass
+    for all the pixels in the mask_file brighter than the threshold.
+    seed can be a int or a numpy Generator'''
+    uvs = mask_to_uvs(read_mask(mask_file), threshold, jitter, seed)
+    heightfield = texture_to_array(terrain_node.heightfield)
+    return uvs_to_world(terrain_node, heightfield, uvs)
+
+
+def place_grass_reference(terrain_node, mask_file, threshold=0.5, jitter=0.001):
+    '''The old, per-pixel version of place_grass(), returns a list of LPoint3'''
+    grass_map = p3d.PNMImage()
+    grass_map.read(mask_file)
+    grass_list = []
+    x_size = grass_map.get_read_x_size()
+    y_size = grass_map.get_read_y_size()
+    for x in range(x_size):
+        for y in range(y_size):
+            if grass_map.get_bright(x, y) > threshold:
+                uv_x = x/x_size
+                uv_y = 1.0-y/y_size
+                uv_x += random.uniform(-jitter, jitter)
+                uv_y += random.uniform(-jitter, jitter)
+                uv_x = max(0.0, min(1.0, uv_x))
+                uv_y = max(0.0, min(1.0, uv_y))
+                grass_list.append(terrain_node.uv_to_world(uv_x, uv_y))
+    return grass_list
+
+
+# number of RGBA32 texels used by one instance in the instance texture
+TEXELS_PER_INSTANCE = 2
+
+
+def pack_instances(positions, heading=None, scale=None, tint=None):
+    '''Packs per-instance data into a float32 array with the shape (n, 8),
+    that's 2 RGBA texels for each instance:
+        texel 0: xyz - position, w - heading (in radians)
+        texel 1: x - scale, yzw - color (rgb) multiplier
+    heading, scale and tint are optional, if not given there's no rotation,
+    the scale is 1.0 and the tint is white'''
+    data = np.zeros((len(positions), TEXELS_PER_INSTANCE * 4), dtype=np.float32)
+    data[:, 0:3] = positions
+    if heading is not None:
+        data[:, 3] = heading
+    data[:, 4] = 1.0 if scale is None else scale
+    data[:, 5:8] = 1.0 if tint is None else tint
+    return data
+
+
+def random_attributes(count, scale=(0.8, 1.2), tint=(0.85, 1.1), seed=None):
+    '''Returns random heading, scale and tint for count instances,
+    to be used with pack_instances()'''
+    rng = np.random.default_rng(seed)
+    heading = rng.uniform(0.0, 2.0 * np.pi, count)
+    scale = rng.uniform(scale[0], scale[1], count)
+    tint = rng.uniform(tint[0], tint[1], (count, 3))
+    return heading, scale, tint
+
+
+def make_instance_texture(data, instances_per_row=2048, name='instance_tex'):
+    '''Returns a 2D float texture with the data from pack_instances().
+    Instance i is at texel ((i % instances_per_row) * 2, i // instances_per_row)
+    the shader can find the instances_per_row from the size of the texture.
+    A 2D texture is used and not a buffer texture, because a buffer texture may
+    be limited to just 65536 texels.
+    The data is copied into the texture in one go, no per-instance Python objects are made'''
+    data = np.ascontiguousarray(data, dtype=np.float32).reshape(-1)
+    count = data.size // (TEXELS_PER_INSTANCE * 4)
+    instances_per_row = max(1, min(count, instances_per_row))
+    rows = max(1, -(-count // instances_per_row))
+    instance_tex = p3d.Texture(name)
+    instance_tex.setup_2d_texture(instances_per_row * TEXELS_PER_INSTANCE, rows,
+                                  p3d.Texture.T_float, p3d.Texture.F_rgba32)
+    # texelFetch() is used to read the data, but we don't want any mipmaps or filtering
+    instance_tex.set_minfilter(p3d.SamplerState.FT_nearest)
+    instance_tex.set_magfilter(p3d.SamplerState.FT_nearest)
+    instance_tex.set_wrap_u(p3d.SamplerState.WM_clamp)
+    instance_tex.set_wrap_v(p3d.SamplerState.WM_clamp)
+    # rows are filled left to right, so the packed data is already in the right order
+    image = np.frombuffer(instance_tex.modify_ram_image(), dtype=np.float32)
+    image[:data.size] = data
+    return instance_tex
+
+
+def chunk_instances(positions, chunk_size, keep=None):
+    '''Sorts instances into a uniform grid of square chunks (chunk_size x chunk_size).
+    If keep values are given, the instances in each chunk are also sorted by keep.
+    Returns the order (indices that sort the instances chunk by chunk)
+    and a list of (start, count) instance ranges, one for each non-empty chunk'''
+    cells = np.floor(positions[:, :2] / chunk_size).astype(np.int64)
+    cells -= cells.min(axis=0, initial=0)
+    keys = cells[:, 0] * (cells[:, 1].max(initial=0) + 1) + cells[:, 1]
+    if keep is None:
+        order = np.argsort(keys, kind='stable')
+    else:
+        order = np.lexsort((keep, keys))
+    _, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+    return order, list(zip(starts.tolist(), counts.tolist()))
+
+
+def make_card(model):
+    '''Returns a simplified version of the (grass) model - 2 crossed, two sided quads
+    with the same size, texture and UVs as the model'''
+    lo, hi = model.get_tight_bounds()
+    uv_min = p3d.Point2(float('inf'))
+    uv_max = p3d.Point2(float('-inf'))
+    for geom_np in model.find_all_matches('**/+GeomNode'):
+        for geom in geom_np.node().get_geoms():
+            reader = p3d.GeomVertexReader(geom.get_vertex_data(), 'texcoord')
+            while not reader.is_at_end():
+                uv = reader.get_data2()
+                uv_min = p3d.Point2(min(uv_min.x, uv.x), min(uv_min.y, uv.y))
+                uv_max = p3d.Point2(max(uv_max.x, uv.x), max(uv_max.y, uv.y))
+    card_maker = p3d.CardMaker('grass_card')
+    card_maker.set_frame(min(lo.x, lo.y), max(hi.x, hi.y), lo.z, hi.z)
+    card_maker.set_uv_range(uv_min, uv_max)
+    card = p3d.NodePath('grass_card')
+    card.attach_new_node(card_maker.generate())
+    card.attach_new_node(card_maker.generate()).set_h(90)
+    for tex_stage in model.find_all_texture_stages():
+        tex = model.find_texture(tex_stage)
+        if tex:
+            card.set_texture(tex_stage, tex, 1)
+    card.set_two_sided(True)
+    card.flatten_strong()
+    return card
+
+
+def make_chunk_nodes(data, keep, chunks, parent, lods):
+    '''Makes a LODNode for each chunk, with one child for each LOD band.
+    data is the sorted output of pack_instances(), keep is the sorted keep values,
+    chunks is the list of ranges from chunk_instances()
+    lods is a list of (model, near, far, density) tuples - the model is drawn for chunks
+    between the near and far distance from the camera, using a density fraction
+    of the instances in the chunk (the ones with the lowest keep value)'''
+    # the bounds of each chunk need to fit the model, at max scale and rotated any way
+    lo, hi = lods[0][0].get_tight_bounds()
+    pad = (hi - lo).length() * float(data[:, 4].max(initial=1.0))
+    nodes = []
+    for start, count in chunks:
+        pos = data[start:start+count, :3]
+        chunk_min = p3d.Point3(*pos.min(axis=0)) - p3d.Vec3(pad)
+        chunk_max = p3d.Point3(*pos.max(axis=0)) + p3d.Vec3(pad)
+        center = (chunk_min + chunk_max) * 0.5
+        # the last band should cull whole chunks only when they are all further then far
+        radius = (chunk_max - center).length()
+        lod = p3d.LODNode('grass_chunk')
+        lod.set_center(center)
+        lod_np = parent.attach_new_node(lod)
+        for i, (model, near, far, density) in enumerate(lods):
+            if i == len(lods) - 1:
+                far += radius
+            lod.add_switch(far, near)
+            chunk = model.copy_to(lod_np)
+            if density < 1.0:
+                chunk.set_instance_count(int(np.searchsorted(keep[start:start+count], density)))
+            else:
+                chunk.set_instance_count(count)
+            chunk.set_shader_input('instance_offset', start)
+            # set_bounds() still adds the bounds of the children, and the GeomNodes
+            # of the model would add the model at the origin, so they need it too
+            bounds = p3d.BoundingBox(chunk_min, chunk_max)
+            chunk.node().set_bounds(bounds)
+            for geom_np in chunk.find_all_matches('**/+GeomNode'):
+                geom_np.node().set_bounds(bounds)
+            chunk.node().set_final(True)
+            nodes.append(chunk)
+    return nodes
+
+
+def build_instances(positions, chunk_size=32.0, seed=None):
+    '''Gives the grass at the positions (shape (n, 3)) random rotation, scale, color
+    and keep value (see make_grass()), and sorts them into chunks.
+    seed can be a int or a numpy Generator.
+    Returns (data, keep, chunks) - packed instance data, keep values
+    and (start, count) ranges, all sorted chunk by chunk'''
+    rng = np.random.default_rng(seed)
+    heading, scale, tint = random_attributes(len(positions), seed=rng)
+    # each instance gets a random 'keep' value, instances with keep < density
+    # are drawn in LOD bands with a lower density, this way the same grass is
+    # kept at each distance and there's no flickering when moving the camera
+    keep = rng.random(len(positions), dtype=np.float32)
+    order, chunks = chunk_instances(positions, chunk_size, keep)
+    data = pack_instances(positions, heading, scale, tint)[order]
+    return data, keep[order], chunks
+
+
+def make_grass(model, instances, parent, clip_distance=125.0,
+               lod_distances=(40.0, 80.0), far_density=0.35, card=None):
+    '''Makes instanced grass from the model, instances is the
+    (data, keep, chunks) tuple from build_instances() or load_instances().
+    The full model is used up to lod_distances[0] from the camera,
+    a simplified card (see make_card()) up to lod_distances[1],
+    and the card with just a far_density fraction of the grass up to clip_distance.
+    If lod_distances is None, the full model is used all the way.
+    Returns a NodePath with one child LODNode for each chunk'''
+    data, keep, chunks = instances
+    if lod_distances is None:
+        lods = [(model, 0.0, clip_distance, 1.0)]
+    else:
+        if card is None:
+            card = make_card(model)
+        near, far = lod_distances
+        lods = [(model, 0.0, near, 1.0),
+                (card, near, far, 1.0),
+                (card, far, clip_distance, far_density)]
+    root = parent.attach_new_node('grass')
+    root.set_shader(p3d.Shader.load(p3d.Shader.SL_GLSL, 'shaders/grass_v.glsl', 'shaders/grass_f.glsl'), 1)
+    root.set_shader_input('instance_tex', make_instance_texture(data))
+    root.set_shader_input('clip_distance', clip_distance)
+    # alpha testing will be done in the shader
+    root.set_transparency(p3d.TransparencyAttrib.M_none, 1)
+    make_chunk_nodes(data, keep, chunks, root, lods)
+    return root
+
+
+# the instance cache file layout is:
+# header: magic, sha256 key, number of instances, number of chunks
+# float32 data (8 for each instance), float32 keep (1 for each instance),
+# int32 chunks (start and count for each chunk)
+CACHE_FILE = 'cache/grass.bin'
+CACHE_MAGIC = b'GRASS001'
+CACHE_HEADER = struct.Struct('<8s32sII')
+
+
+def cache_key(terrain_node, mask_file, **params):
+    '''Returns a hash of everything that goes into the grass placement -
+    the heightfield, the mask, the terrain transform and all other params'''
+    key = hashlib.sha256(CACHE_MAGIC)
+    key.update(memoryview(terrain_node.heightfield.get_ram_image()))
+    with open(mask_file, 'rb') as f:
+        key.update(f.read())
+    key.update(mat_to_array(terrain_node.get_transform().get_mat()).tobytes())
+    key.update(repr(sorted(params.items())).encode())
+    return key.digest()
+
+
+def save_instances(filename, key, data, keep, chunks):
+    '''Writes the output of build_instances() to a file'''
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    # write to a temp file first, so a half written cache is never loaded
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        f.write(CACHE_HEADER.pack(CACHE_MAGIC, key, len(data), len(chunks)))
+        np.ascontiguousarray(data, dtype=np.float32).tofile(f)
+        np.ascontiguousarray(keep, dtype=np.float32).tofile(f)
+        np.array(chunks, dtype=np.int32).reshape(-1, 2).tofile(f)
+    os.replace(temp_filename, filename)
+
+
+def load_instances(filename, key):
+    '''Memory maps a file written by save_instances(),
+    returns (data, keep, chunks) or None if there's no file or the key does not match'''
+    try:
+        mapped = np.memmap(filename, dtype=np.uint8, mode='r')
+    except (OSError, ValueError):
+        return None
+    if mapped.size < CACHE_HEADER.size:
+        return None
+    magic, file_key, count, num_chunks = CACHE_HEADER.unpack(mapped[:CACHE_HEADER.size].tobytes())
+    if magic != CACHE_MAGIC or file_key != key:
+        return None
+    if mapped.size != CACHE_HEADER.size + count * 36 + num_chunks * 8:
+        return None
+    offset = CACHE_HEADER.size
+    data = np.frombuffer(mapped, np.float32, count * 8, offset).reshape(count, 8)
+    offset += data.nbytes
+    keep = np.frombuffer(mapped, np.float32, count, offset)
+    offset += keep.nbytes
+    chunks = np.frombuffer(mapped, np.int32, num_chunks * 2, offset).reshape(-1, 2)
+    return data, keep, [tuple(chunk) for chunk in chunks.tolist()]
+
+
+def load_or_build_instances(terrain_node, mask_file, cache_file=CACHE_FILE,
+                            chunk_size=32.0, threshold=0.5, jitter=0.001, seed=0, force=False):
+    '''Returns (data, keep, chunks) from the cache_file, if the cache is missing
+    or was made for a different heightfield/mask/params (or force is True), the grass
+    is placed again (see place_grass() and build_instances()) and the cache is written'''
+    key = cache_key(terrain_node, mask_file, chunk_size=chunk_size,
+                    threshold=threshold, jitter=jitter, seed=seed)
+    instances = None if force else load_instances(cache_file, key)
+    if instances is None:
+        rng = np.random.default_rng(seed)
+        positions = place_grass(terrain_node, mask_file, threshold, jitter, rng)
+        instances = build_instances(positions, chunk_size, rng)
+        save_instances(cache_file, key, *instances)
+    return instances
+
+
+# GPU placement - instead of uploading the position of each blade of grass,
+# the grass vertex shader (shaders/grass_gpu_v.glsl) finds the position
+# of each instance from gl_InstanceID. The mask is split into square tiles,
+# the mask pixels (cells) with grass are listed tile by tile in a int texture
+# (one int for each cell, made from the mask in one numpy pass, see gpu_grass_cells()),
+# an instance reads its cell from that list, hashes the cell coordinates for the jitter,
+# rotation, scale and color and reads the height from the heightfield.
+# Empty cells are not in the list, so they cost nothing. Within a tile the cells
+# are sorted by their keep value, so a LOD band that draws only a part of the grass
+# draws only that many instances. The tiles are culled (and switch LODs) on the CPU
+# like the chunks of make_grass(), the bounds of a tile are its rectangle of cells
+# and the lowest and highest point of the heightfield under it,
+# tiles without grass are not made at all.
+# gpu_placement_reference() does the same placement on the CPU, to check the shader.
+GPU_GRASS = p3d.ConfigVariableBool('grass-gpu', False,
+                                   'Place the grass on the GPU from the mask, see grass.py')
+HASH_SEED_MUL = np.uint32(0x9e3779b9)
+# the random values of each cell, in the order the shader makes them
+HASH_VALUES = ('jitter_u', 'jitter_v', 'heading', 'scale', 'tint_r', 'tint_g', 'tint_b', 'keep')
+
+
+def hash_uint32(x):
+    '''The 'lowbias32' integer hash, same as hash() in grass_gpu_v.glsl'''
+    x = np.array(x, dtype=np.uint32)
+    x ^= x >> np.uint32(16)
+    x *= np.uint32(0x7feb352d)
+    x ^= x >> np.uint32(15)
+    x *= np.uint32(0x846ca68b)
+    x ^= x >> np.uint32(16)
+    return x
+
+
+def cell_randoms(cells, mask_width, seed=0):
+    '''Returns a dict of float32 arrays (0.0-1.0) with the random values
+    (see HASH_VALUES) for the cells (int array, shape (n, 2))'''
+    cells = np.asarray(cells, dtype=np.int64)
+    key = (cells[:, 0] + cells[:, 1] * mask_width + int(HASH_SEED_MUL) * seed) % (1 << 32)
+    key = key.astype(np.uint32)
+    values = {}
+    h = hash_uint32(key)
+    for name in HASH_VALUES:
+        values[name] = (h >> np.uint32(8)).astype(np.float32) / np.float32(16777216.0)
+        h = hash_uint32(h)
+    return values
+
+
+def terrain_pos_scale(terrain_node):
+    '''Returns the position and scale of the terrain (it must not be rotated)'''
+    transform = terrain_node.get_transform()
+    return p3d.Vec3(transform.get_pos()), p3d.Vec3(transform.get_scale())
+
+
+def gpu_placement_reference(mask, heightfield, terrain_pos, terrain_scale, cells,
+                            threshold=0.5, jitter=0.001, seed=0):
+    '''CPU version of the placement done in grass_gpu_v.glsl.
+    mask is the mask as a float array (rows bottom to top, like make_mask_texture() uses),
+    heightfield the array from texture_to_array(), cells an int array (shape (n, 2))
+    of mask pixels. Returns (has_grass, data, keep) - a bool for each cell,
+    the pack_instances() data and keep values for all the cells'''
+    cells = np.asarray(cells, dtype=np.int64)
+    y_size, x_size = mask.shape
+    inside = (cells[:, 0] >= 0) & (cells[:, 0] < x_size) & (cells[:, 1] >= 0) & (cells[:, 1] < y_size)
+    has_grass = inside.copy()
+    has_grass[inside] = mask[cells[inside, 1], cells[inside, 0]] > threshold
+    values = cell_randoms(cells, x_size, seed)
+    uvs = (cells + 0.5) / np.array([x_size, y_size])
+    uvs += (np.stack([values['jitter_u'], values['jitter_v']], axis=1) * 2.0 - 1.0) * jitter
+    uvs = np.clip(uvs, 0.0, 1.0)
+    positions = np.empty((len(cells), 3), dtype=np.float32)
+    positions[:, :2] = np.array(terrain_pos)[:2] + uvs * np.array(terrain_scale)[:2]
+    positions[:, 2] = terrain_pos[2] + sample_bilinear(heightfield[:, :, 0], uvs) * terrain_scale[2]
+    data = pack_instances(positions,
+                          values['heading'] * np.float32(2.0 * np.pi),
+                          np.float32(0.8) + values['scale'] * np.float32(0.4),
+                          np.float32(0.85) + np.stack([values['tint_r'], values['tint_g'], values['tint_b']],
+                                                      axis=1) * np.float32(0.25))
+    return has_grass, data, values['keep']
+
+
+def make_mask_texture(mask):
+    '''Returns the mask (float array, rows bottom to top) as a 8 bit texture for texelFetch()'''
+    data = np.round(np.clip(mask, 0.0, 1.0) * 255.0).astype(np.uint8)
+    mask_tex = p3d.Texture('grass_mask')
+    mask_tex.setup_2d_texture(data.shape[1], data.shape[0], p3d.Texture.T_unsigned_byte, p3d.Texture.F_red)
+    mask_tex.set_ram_image(np.ascontiguousarray(data).tobytes())
+    mask_tex.set_minfilter(p3d.SamplerState.FT_nearest)
+    mask_tex.set_magfilter(p3d.SamplerState.FT_nearest)
+    return mask_tex
+
+
+def read_mask_texture(mask_file):
+    '''Reads the mask, returns it as an array (rows bottom to top, quantized to 8 bit
+    like the texture) and the texture from make_mask_texture()'''
+    mask = np.round(np.clip(read_mask(mask_file)[::-1], 0.0, 1.0) * 255.0) / 255.0
+    return mask.astype(np.float32), make_mask_texture(mask)
+
+
+def gpu_grass_cells(mask, tile_cells, threshold=0.5, seed=0):
+    '''Lists the cells with grass of the mask (float array, rows bottom to top)
+    tile by tile (tile_cells x tile_cells cells), sorted by keep value in each tile.
+    Returns (cells, keep, tiles) - the cell indices (x + y * mask width, int32),
+    their keep values and a (tile_x, tile_y, start, count) tuple for each tile with grass'''
+    y_size, x_size = mask.shape
+    tiles_y = -(-y_size // tile_cells)
+    tiles_x = -(-x_size // tile_cells)
+    grass = np.zeros((tiles_y * tile_cells, tiles_x * tile_cells), dtype=bool)
+    grass[:y_size, :x_size] = mask > threshold
+    # one row for each tile, with the cells of the tile row by row
+    grass = grass.reshape(tiles_y, tile_cells, tiles_x, tile_cells).transpose(0, 2, 1, 3)
+    tile, local = np.nonzero(grass.reshape(tiles_y * tiles_x, tile_cells * tile_cells))
+    x = (tile % tiles_x) * tile_cells + local % tile_cells
+    y = (tile // tiles_x) * tile_cells + local // tile_cells
+    keep = cell_randoms(np.stack([x, y], axis=1), x_size, seed)['keep']
+    order = np.lexsort((keep, tile))
+    tile = tile[order]
+    cells = (x + y * x_size)[order].astype(np.int32)
+    counts = np.bincount(tile, minlength=tiles_y * tiles_x)
+    starts = np.cumsum(counts) - counts
+    tiles = [(index % tiles_x, index // tiles_x, starts[index], counts[index])
+             for index in np.nonzero(counts)[0].tolist()]
+    return cells, keep[order], tiles
+
+
+def make_cell_texture(cells, cells_per_row=2048):
+    '''Returns the cell list from gpu_grass_cells() as a int texture for texelFetch(),
+    cell i is at texel (i % cells_per_row, i // cells_per_row)'''
+    cells_per_row = max(1, min(len(cells), cells_per_row))
+    rows = max(1, -(-len(cells) // cells_per_row))
+    cell_tex = p3d.Texture('grass_cells')
+    cell_tex.setup_2d_texture(cells_per_row, rows, p3d.Texture.T_int, p3d.Texture.F_r32i)
+    cell_tex.set_minfilter(p3d.SamplerState.FT_nearest)
+    cell_tex.set_magfilter(p3d.SamplerState.FT_nearest)
+    image = np.frombuffer(cell_tex.modify_ram_image(), dtype=np.int32)
+    image[:len(cells)] = cells
+    return cell_tex
+
+
+def make_gpu_grass(model, terrain_node, mask_file, parent, clip_distance=125.0,
+                   lod_distances=(40.0, 80.0), far_density=0.35, card=None,
+                   tile_size=16.0, threshold=0.5, jitter=0.001, seed=0):
+    '''Makes grass placed on the GPU (see above) from the mask_file on the terrain_node,
+    with the same LOD bands as make_grass(). The mask is split into tiles
+    (tile_size x tile_size units), each tile is a LODNode with one child for each LOD band,
+    with real bounds, so tiles out of view or too far are culled. A band draws one instance
+    for each cell with grass in the tile (only the part kept at the density of the band).
+    Returns a NodePath with one child LODNode for each tile with grass'''
+    if lod_distances is None:
+        lods = [(model, 0.0, clip_distance, 1.0)]
+    else:
+        if card is None:
+            card = make_card(model)
+        near, far = lod_distances
+        lods = [(model, 0.0, near, 1.0),
+                (card, near, far, 1.0),
+                (card, far, clip_distance, far_density)]
+    mask, mask_tex = read_mask_texture(mask_file)
+    terrain_pos, terrain_scale = terrain_pos_scale(terrain_node)
+    y_size, x_size = mask.shape
+    tile_cells = max(1, int(round(tile_size * x_size / terrain_scale.x)))
+    cells, keep, tiles = gpu_grass_cells(mask, tile_cells, threshold, seed)
+    heights = texture_to_array(terrain_node.heightfield)[:, :, 0]
+    height_y, height_x = heights.shape
+    # the bounds need to fit the model, at max scale and rotated any way
+    lo, hi = lods[0][0].get_tight_bounds()
+    pad = (hi - lo).length() * 1.2
+    root = parent.attach_new_node('grass')
+    root.set_shader(p3d.Shader.load(p3d.Shader.SL_GLSL, 'shaders/grass_gpu_v.glsl', 'shaders/grass_f.glsl'), 1)
+    root.set_shader_input('grass_mask', mask_tex)
+    root.set_shader_input('grass_cells', make_cell_texture(cells))
+    root.set_shader_input('heightfield', terrain_node.heightfield)
+    root.set_shader_input('terrain_pos', terrain_pos)
+    root.set_shader_input('terrain_scale', terrain_scale)
+    root.set_shader_input('threshold', threshold)
+    root.set_shader_input('jitter', jitter)
+    root.set_shader_input('seed', seed)
+    root.set_shader_input('clip_distance', clip_distance)
+    root.set_transparency(p3d.TransparencyAttrib.M_none, 1)
+    for tile_x, tile_y, start, count in tiles:
+        # the rectangle of the tile (uv), the grass can be jittered a bit out of it
+        uv_min = np.array([tile_x, tile_y]) * tile_cells / np.array([x_size, y_size]) - jitter
+        uv_max = np.array([tile_x + 1, tile_y + 1]) * tile_cells / np.array([x_size, y_size]) + jitter
+        uv_min = np.clip(uv_min, 0.0, 1.0)
+        uv_max = np.clip(uv_max, 0.0, 1.0)
+        # the heights under it, one pixel more on each side for the bilinear filtering
+        x0, y0 = np.maximum(np.floor(uv_min * (height_x, height_y)).astype(int) - 1, 0).tolist()
+        x1, y1 = np.ceil(uv_max * (height_x, height_y)).astype(int).tolist()
+        tile_heights = heights[y0:y1 + 1, x0:x1 + 1]
+        tile_min = p3d.Point3(terrain_pos.x + uv_min[0] * terrain_scale.x,
+                              terrain_pos.y + uv_min[1] * terrain_scale.y,
+                              terrain_pos.z + float(tile_heights.min()) * terrain_scale.z) - p3d.Vec3(pad)
+        tile_max = p3d.Point3(terrain_pos.x + uv_max[0] * terrain_scale.x,
+                              terrain_pos.y + uv_max[1] * terrain_scale.y,
+                              terrain_pos.z + float(tile_heights.max()) * terrain_scale.z) + p3d.Vec3(pad)
+        center = (tile_min + tile_max) * 0.5
+        radius = (tile_max - center).length()
+        bounds = p3d.BoundingBox(tile_min, tile_max)
+        lod = p3d.LODNode('grass_tile')
+        lod.set_center(center)
+        lod_np = root.attach_new_node(lod)
+        lod_np.set_shader_input('cell_offset', int(start))
+        for i, (band_model, near, far, density) in enumerate(lods):
+            # the last band should cull whole tiles only when they are all further then far
+            if i == len(lods) - 1:
+                far += radius
+            lod.add_switch(far, near)
+            band = band_model.copy_to(lod_np)
+            # the cells are sorted by keep, the band draws the ones with keep < density
+            band.set_instance_count(int(np.searchsorted(keep[start:start + count], density)))
+            band.set_shader_input('density', density)
+            # the GeomNodes would add the model at the origin to the bounds, see make_chunk_nodes()
+            band.node().set_bounds(bounds)
+            for geom_np in band.find_all_matches('**/+GeomNode'):
+                geom_np.node().set_bounds(bounds)
+            band.node().set_final(True)
+    return root
@@ -1,14 +1,25 @@
 '''
 This demo shows how to use instancing to place a lot of models on a height map terrain.
 
-We'll use a samplerBuffer (Buffer Texture) to pack the position(offset) of all the grass instances,
-if there's more data to pack (rotation, scale, color, etc) a floating point texture
-may be a better choice because the buffer may be limited to 65536 texels.
-We're rendering 'only' ~21.5k instances of the grass so there should be no problems.
+The grass is split into a grid of chunks (32x32 units), each chunk is drawn
+with its own instance count, so chunks outside the view or too far away can be culled.
+Each chunk is also a LODNode, far away chunks use a simpler model and draw less grass.
+
+We'll use a floating point texture to pack the position(offset), rotation, scale
+and color of all the grass instances (2 texels for each instance, see grass.py).
+A samplerBuffer (Buffer Texture) would also work for positions only,
+but the buffer may be limited to 65536 texels, a 2D texture can hold a lot more.
+
+With 'grass-occlusion 1' chunks hidden behind the hills are also culled, a coarse test
+done on the CPU with the heightfield for each cell the camera is in (see occlusion.py),
+it's off by default, it costs more CPU time than it saves for now.
+
+With 'grass-gpu 1' in a prc file the grass is placed by the vertex shader instead
+(tiles of the grass mask, culled like the chunks, see grass.py), there's no instance data at all.
 
 The grass shader has some additional features:
 - animation (for show)
-- discarding far away grass (for performance, but test show it has no impact on speed)
+- discarding far away grass (whole chunks are culled on the CPU, this just makes the edge round)
 '''
 import panda3d.core as p3d
 p3d.load_prc_file_data('', '''framebuffer-srgb 1
@@ -17,9 +28,17 @@ p3d.load_prc_file_data('', '''framebuffer-srgb 1
                               multisamples 1''')
 from direct.showbase.ShowBase import ShowBase
 
-from operator import itemgetter
-import struct
-import random
+import sys
+
+import grass
+import occlusion
+import pager
+import terrain
+# the utilities are two levels up
+sys.path.append('../..')
+from utilities import assets
+from utilities import profiling
+from utilities import skybox
 
 FT_LINEAR = p3d.SamplerState.FT_linear
 FT_MIPMAP = p3d.SamplerState.FT_linear_mipmap_linear
@@ -30,106 +49,86 @@ F_SRGBA = p3d.Texture.F_srgb_alpha
 class App(ShowBase):
     def __init__(self):
         super().__init__(self)
+        # record the profiling times to a csv file, if asked to (see utilities/profiling.py)
+        profiling.enable()
         # MSAA just for making thinkgs look good
         self.render.set_antialias(p3d.AntialiasAttrib.M_multisample)
 
-        # ShaderTerrainMesh used for terrain
-        self.terrain_node = p3d.ShaderTerrainMesh()
-        heightfield = self.loader.load_texture('../../models/texture/terrain/terrain_height.png')
-        self.terrain_node.heightfield = heightfield
-        # self.terrain_node.target_triangle_width = 10.0
-        self.terrain_node.generate()
-        self.terrain = self.render.attach_new_node(self.terrain_node)
-        self.terrain.set_scale(512, 512, 100)
-        self.terrain.set_pos(-256, -256, -30)
+        srgb = p3d.ConfigVariableBool('framebuffer-srgb').get_value()
+        # load the grass model, with the texture fixed for srgb
+        grass_model = assets.load_model('../../models/grass', srgb)
+        # close to the camera the full grass model is used, further away a simple card,
+        # and even further a card but only for some (35%) of the grass
+        grass_options = dict(clip_distance=125.0, lod_distances=(40.0, 80.0), far_density=0.35)
+        if pager.TERRAIN_MAP.get_value():
+            # a big terrain, loaded in tiles around the camera (with the grass), see pager.py
+            self.pager = pager.TerrainPager(self.taskMgr, pager.TiledMap(pager.TERRAIN_MAP.get_value()),
+                                            self.render, self.camera, grass_model=grass_model,
+                                            grass_options=grass_options, srgb=srgb)
+            self.terrain = self.pager.root
+        else:
+            self.setup_terrain(grass_model, grass_options, srgb)
         self.terrain.set_shader(p3d.Shader.load(GLSL, 'shaders/terrain_v.glsl', 'shaders/terrain_f.glsl'), 1)
         # load terrain textures
-        grass = self.loader.load_texture('../../models/texture/terrain/grass_c.png',
-                                        minfilter = FT_MIPMAP, magfilter = FT_LINEAR)
-        rock = self.loader.load_texture('../../models/texture/terrain/rock_c.png',
-                                        minfilter = FT_MIPMAP, magfilter = FT_LINEAR)
-        snow = self.loader.load_texture('../../models/texture/terrain/snow_c.png',
-                                        minfilter = FT_MIPMAP, magfilter = FT_LINEAR)
-        attribute = self.loader.load_texture('../../models/texture/terrain/terrain_atr.png')
-        # make sure textures are sRGB
-        if  p3d.ConfigVariableBool('framebuffer-srgb').get_value():
-            grass.set_format(F_SRGB)
-            rock.set_format(F_SRGB)
-            snow.set_format(F_SRGB)
-            attribute.set_format(F_SRGB)
-        self.terrain.set_shader_input('grass_map', grass)
-        self.terrain.set_shader_input('rock_map', rock)
-        self.terrain.set_shader_input('snow_map', snow)
-        self.terrain.set_shader_input('attribute_map', attribute)
+        # the color and normal maps of all the layers are packed into two texture arrays
+        # the textures are loaded from a cache, already mipmapped and sRGB (see utilities/assets.py)
+        # the order of the layers is the same as the channels of the attribute map (r, g, b)
+        layers = ['rock', 'grass', 'snow']
+        with profiling.timer('Startup:load textures'):
+            albedo_layers = assets.load_texture_array(['../../models/texture/terrain/{}_c.png'.format(layer)
+                                                       for layer in layers], srgb)
+            normal_layers = assets.load_texture_array(['../../models/texture/terrain/{}_n.png'.format(layer)
+                                                       for layer in layers])
+        self.terrain.set_shader_input('albedo_layers', albedo_layers)
+        self.terrain.set_shader_input('normal_layers', normal_layers)
         self.terrain.set_shader_input('camera', self.camera)
 
-        # make the grass map more gpu friendly:
-        grass_map = p3d.PNMImage()
-        grass_map.read('../../models/texture/terrain/terrain_grass.png')
-        grass_list=[]
-        x_size = grass_map.get_read_x_size()
-        y_size = grass_map.get_read_y_size()
-        for x in range(x_size):
-            for y in range(y_size):
-                if grass_map.get_bright(x,y) > 0.5:
-                    # terrain_node.uv_to_world() will give as the position of the grass
-                    # but we need to flip the y because OpenGL UVs...
-                    # we also want to add a bit of random to avoid 'grass grid'
-                    uv_x = x/x_size
-                    uv_y = 1.0-y/y_size
-                    uv_x += random.uniform(-0.001, 0.001)
-                    uv_y += random.uniform(-0.001, 0.001)
-                    uv_x = max(0.0, min(1.0, uv_x))
-                    uv_y = max(0.0, min(1.0, uv_y))
-                    grass_list.append(self.terrain_node.uv_to_world(uv_x, uv_y) )
-        # pack the grass_list into a buffer_texture
-        grass_buf_tex = p3d.Texture('texbuffer')
-        grass_buf_tex.setup_buffer_texture(len(grass_list)+1,
-                                            p3d.Texture.T_float,
-                                            p3d.Texture.F_rgb32,
-                                            p3d.GeomEnums.UH_static)
-        image = memoryview(grass_buf_tex.modify_ram_image())
-        for i, pos in enumerate(grass_list):
-            off = i * 12
-            image[off:off+12] = struct.pack('fff', pos[0], pos[1], pos[2])
-        # load the grass model
-        grass_model=self.loader.load_model('../../models/grass')
-        # fix texture for srgb
-        if  p3d.ConfigVariableBool('framebuffer-srgb').get_value():
-            for tex_stage in grass_model.find_all_texture_stages():
-                tex = grass_model.find_texture(tex_stage)
-                if tex:
-                    tex.set_format(F_SRGBA)
-                    grass_model.set_texture(tex_stage, tex, 1)
-        grass_model.set_shader(p3d.Shader.load(GLSL, 'shaders/grass_v.glsl', 'shaders/grass_f.glsl'), 1)
-        grass_model.set_shader_input('grass_buf_tex', grass_buf_tex)
-        grass_model.set_shader_input('clip_distance', 125.0)
-        grass_model.set_instance_count(len(grass_list))
-        grass_model.reparent_to(self.render)
-        # alpha testing will be done in the shader
-        grass_model.set_transparency(p3d.TransparencyAttrib.M_none, 1)
-        # set the bounds so it stays visible
-        grass_model.node().set_bounds( p3d.BoundingBox( (0,0,0), max( grass_list,key=itemgetter(1) ) ) )
-        grass_model.node().set_final(1)
-
-         #make skybox
-        self.sky_box=self.loader.load_model('../../models//box')
-        self.sky_box.reparent_to(self.render)
-        self.sky_box.set_scale(10)
-        self.sky_box.set_shader(p3d.Shader.load(GLSL, 'shaders/skybox_v.glsl', 'shaders/skybox_f.glsl'), 1)
-        self.sky_box.set_shader_input('blur', 0.0)
-        self.sky_box.set_bin('background', 100)
-        self.sky_box.set_depth_test(False)
-        self.sky_box.set_depth_write(False)
+        # make skybox, it follows the camera on its own (see utilities/skybox.py)
+        self.sky_box = skybox.make_skybox(self.render, self.cam)
         self.render.set_shader_input("camera", self.cam)
         self.render.set_shader_input('env_map', self.loader.load_texture('../../models/texture/cubemap/qwantani.txo'))
-        #add a task to update the skybox
-        self.taskMgr.add(self.update, 'update')
 
-    def update(self, task):
-        ''' Per frame update task'''
-        self.sky_box.set_pos(self.cam.get_pos(render))
-        return task.cont
+    def setup_terrain(self, grass_model, grass_options, srgb):
+        '''Makes the terrain from one heightfield, and the grass on it'''
+        # ShaderTerrainMesh used for terrain
+        # it's already scaled and moved into place, see terrain.py
+        with profiling.timer('Startup:terrain'):
+            heightfield = self.loader.load_texture(terrain.HEIGHTFIELD)
+            self.terrain_node = terrain.make_terrain_node(heightfield)
+        # the normals are baked from the heightfield (or loaded from a cache)
+        # so the shader does not need to compute them for each pixel
+        with profiling.timer('Startup:terrain normals'):
+            normal_map = terrain.load_or_build_normal_map(heightfield)
+        self.terrain = self.render.attach_new_node(self.terrain_node)
+        attribute_tex = assets.load_texture('../../models/texture/terrain/terrain_atr.png', srgb,
+                                            minfilter = FT_LINEAR, magfilter = FT_LINEAR)
+        self.terrain.set_shader_input('attribute_map', attribute_tex)
+        self.terrain.set_shader_input('normal_map', normal_map)
+
+        if grass.GPU_GRASS.get_value():
+            # the grass is placed by the vertex shader, straight from the mask, see grass.py
+            # nothing to scan or pack, only the grass around the camera is drawn
+            with profiling.timer('Startup:grass packing'):
+                self.grass = grass.make_gpu_grass(grass_model, self.terrain_node, terrain.GRASS_MASK,
+                                                  self.render, **grass_options)
+            return
+        # make the grass map more gpu friendly:
+        # find all the bright pixels in the grass map and turn them into
+        # world positions, give each grass a random rotation, size and color
+        # and sort them into chunks that can be culled, see grass.py for details
+        # this is only done once, the result is kept in a cache file
+        # (run build_cache.py to make it ahead of time)
+        with profiling.timer('Startup:grass scan'):
+            grass_instances = grass.load_or_build_instances(self.terrain_node, terrain.GRASS_MASK,
+                                                            chunk_size=32.0)
+        # pack the grass into a float texture and make a node for each chunk
+        with profiling.timer('Startup:grass packing'):
+            self.grass = grass.make_grass(grass_model, grass_instances, self.render, **grass_options)
+        # stash the chunks of grass hidden behind the terrain, see occlusion.py
+        if occlusion.GRASS_OCCLUSION.get_value():
+            self.grass_occlusion = occlusion.GrassOcclusion(self.grass, self.terrain_node, self.camera,
+                                                            self.taskMgr,
+                                                            max_distance=grass_options['clip_distance'])
 
 app=App()
 app.run()
@@ -0,0 +1,281 @@
+'''
+Coarse occlusion culling of the grass chunks, done on the CPU with the heightfield.
+
+The view frustum and the LODNodes cull the grass chunks that are out of view or too far,
+but in hilly views a lot of the chunks left are behind a ridge - all their vertices
+still go through the vertex shader, only for the pixels to fail the depth test.
+
+Here the world is split into camera cells (cell_size x cell_size x cell_height units),
+for each cell the chunks hidden by the terrain are found from a few eye points in the cell
+(the corners and the center, at the top of the cell). From each eye point rays are marched
+over the heightfield in AZIMUTHS directions, keeping the highest slope of the terrain seen
+so far along each ray - the horizon. A ray from the eye to a point on top of a chunk
+is blocked if the horizon in its direction, before it gets to the chunk, is above it.
+A chunk is occluded only if the rays to a 3x3 grid of points on its top are blocked
+from all the eyes, occluded chunks are stashed.
+The terrain used for the rays is a coarse, min filtered copy of the heightfield,
+so it's smaller and a ridge is never taller than it really is.
+
+This is only a coarse test - the rays are only cast from the eye points, not from
+every point in the cell, only to some points of a chunk, and along the nearest of
+the horizon rays, a little bit of grass that should be seen through a notch in a ridge
+can still be culled.
+
+The results are kept per camera cell (the least recently used cells are dropped).
+The cells are tested on a threaded task chain ('grass_occlusion'), for up to about
+budget seconds each frame - when the camera moves into a new cell it's tested first,
+and then the cells next to it, so they are often ready before the camera gets there.
+The main thread only looks up the cell and stashes/unstashes the chunks that changed,
+until the cell is tested all the chunks are drawn. Without a task_mgr the cells
+are tested in update().
+'''
+import panda3d.core as p3d
+import numpy as np
+
+import time
+from collections import OrderedDict
+
+import grass
+
+# off by default - the test costs more CPU time than the grass it culls saves, for now
+GRASS_OCCLUSION = p3d.ConfigVariableBool('grass-occlusion', False,
+                                         'Stash grass chunks hidden behind the terrain, see occlusion.py')
+# points on the top of a chunk the rays are cast to, (0,0) to (1,1) over the bounds
+TARGET_POINTS = [(x, y) for x in (0.0, 0.5, 1.0) for y in (0.0, 0.5, 1.0)]
+# eye points in a camera cell, same but over the cell
+EYE_POINTS = [(0.0, 0.0), (1.0, 0.0), (0.0, 1.0), (1.0, 1.0), (0.5, 0.5)]
+# number of rays marched around each eye point
+AZIMUTHS = 256
+
+
+def min_filter(heights, block):
+    '''Returns a coarse version of the heights (shape (y_size, x_size), rows bottom to top),
+    each pixel is the min of a block x block area, and one pixel around it
+    (bilinear filtering mixes in the neighbours) - the coarse terrain
+    is never higher than the real one.'''
+    heights = np.pad(heights, 1, mode='edge')
+    y_size, x_size = heights.shape
+    # min of each pixel and its 8 neighbours
+    eroded = heights[1:-1, 1:-1].copy()
+    for dy in (0, 1, 2):
+        for dx in (0, 1, 2):
+            np.minimum(eroded, heights[dy:dy + y_size - 2, dx:dx + x_size - 2], out=eroded)
+    y_size, x_size = eroded.shape
+    eroded = eroded[:y_size - y_size % block, :x_size - x_size % block]
+    return eroded.reshape(y_size // block, block, x_size // block, block).min(axis=(1, 3))
+
+
+def chunk_bounds(grass_root):
+    '''Returns the min and max corners (arrays, shape (n, 3)) of the grass chunks
+    made by grass.make_grass(), in the coordinate space of grass_root,
+    in the same order as grass_root.get_children()'''
+    lo = []
+    hi = []
+    for lod_np in grass_root.get_children():
+        bounds = lod_np.get_child(0).find('**/+GeomNode').node().get_internal_bounds()
+        lo.append(tuple(bounds.get_min()))
+        hi.append(tuple(bounds.get_max()))
+    return np.array(lo, dtype=np.float64).reshape(-1, 3), np.array(hi, dtype=np.float64).reshape(-1, 3)
+
+
+class GrassOcclusion:
+    '''Stashes the chunks of grass (from grass.make_grass()) hidden from the camera
+    by the terrain (ShaderTerrainMesh, not rotated), see above.
+    If a task_mgr is given, a task updates it every frame and the cells are tested
+    in a thread, else call update()'''
+    def __init__(self, grass_root, terrain_node, camera, task_mgr=None, cell_size=16.0,
+                 cell_height=8.0, max_distance=150.0, block=4, budget=0.002, max_cells=1024):
+        self.grass_root = grass_root
+        self.camera = camera
+        self.task_mgr = task_mgr
+        self.cell_size = np.array([cell_size, cell_size, cell_height])
+        self.max_distance = max_distance
+        self.budget = budget
+        self.max_cells = max_cells
+        self.chunks = list(grass_root.get_children())
+        self.chunk_min, self.chunk_max = chunk_bounds(grass_root)
+        self.chunk_center = (self.chunk_min + self.chunk_max) * 0.5
+        self.chunk_radius = np.linalg.norm(self.chunk_max[:, :2] - self.chunk_center[:, :2], axis=1)
+        # the points the rays are cast to, shape (chunks, points, 3)
+        self.targets = np.empty((len(self.chunks), len(TARGET_POINTS), 3))
+        self.targets[:, :, :2] = (self.chunk_min[:, None, :2] + np.array(TARGET_POINTS)
+                                  * (self.chunk_max - self.chunk_min)[:, None, :2])
+        self.targets[:, :, 2] = self.chunk_max[:, None, 2]
+        terrain_pos, terrain_scale = grass.terrain_pos_scale(terrain_node)
+        self.terrain_pos = np.array(terrain_pos)
+        self.terrain_scale = np.array(terrain_scale)
+        # the heights are kept in world units
+        heights = grass.texture_to_array(terrain_node.heightfield)[:, :, 0]
+        self.heights = heights * self.terrain_scale[2] + self.terrain_pos[2]
+        self.coarse = min_filter(self.heights, block)
+        self.step = min(self.terrain_scale[:2] / self.coarse.shape[::-1])
+        # the horizon is sampled at fixed offsets (pixels of the coarse terrain) from the eye,
+        # the coarse terrain is padded with -inf so the longest ray never gets out of it
+        angles = np.arange(AZIMUTHS) * 2.0 * np.pi / AZIMUTHS
+        directions = np.stack((np.cos(angles), np.sin(angles)), axis=-1)
+        longest = max_distance + 2.0 * self.chunk_radius.max(initial=0.0) + 2.0 * cell_size
+        self.distances = (np.arange(int(np.ceil(longest / self.step))) + 0.5) * self.step
+        self.pixel_size = self.terrain_scale[:2] / self.coarse.shape[::-1]
+        self.pad = 2 * len(self.distances) + 1
+        # the samples can be a pixel off, so each pixel is the min of it and the pixels around it
+        padded = np.pad(min_filter(self.coarse, 1), self.pad, constant_values=-np.inf)
+        self.padded_size = np.array(padded.shape[::-1])
+        self.padded = padded.ravel()
+        offsets = np.round(directions[:, None, :] * self.distances[:, None] / self.pixel_size)
+        self.offsets = offsets[..., 1].astype(np.intp) * padded.shape[1] + offsets[..., 0].astype(np.intp)
+        # occluded chunks (bool array) for each tested camera cell, least recently used first
+        self.cells = OrderedDict()
+        # cells for the thread to test, in order
+        self.queue = []
+        self.key = None
+        self.applied = None
+        self.stashed = np.zeros(len(self.chunks), dtype=bool)
+        self.task = None
+        if task_mgr is not None:
+            # frameSync - the thread tests cells for up to budget seconds once a frame
+            self.task_mgr.setupTaskChain('grass_occlusion', numThreads=1, frameSync=True,
+                                         threadPriority=p3d.TP_low)
+            self.task = task_mgr.add(self._update_task, 'grass_occlusion_update')
+        self.test_task = None
+
+    def _update_task(self, task):
+        self.update()
+        return task.cont
+
+    def _test_task(self, task):
+        # this runs in the 'grass_occlusion' thread, it's done when there's nothing
+        # to test, so the thread is not woken up each frame for nothing
+        if self.test_queue():
+            return task.cont
+        return task.done
+
+    def update(self):
+        '''Checks in what cell the camera is, and stashes the chunks hidden from it,
+        only does anything when the cell changes or when it was just tested'''
+        pos = np.array(self.camera.get_pos(self.grass_root))
+        key = tuple(np.floor(pos / self.cell_size).astype(int).tolist())
+        if key != self.key:
+            self.key = key
+            # this cell first, then the cells around it
+            keys = [key] + [(key[0] + dx, key[1] + dy, key[2])
+                            for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1),
+                                           (1, 1), (-1, -1), (1, -1), (-1, 1))]
+            for neighbour in reversed(keys):
+                if neighbour in self.cells:
+                    self.cells.move_to_end(neighbour)
+            # the thread takes a new list, it never sees one half made
+            self.queue = keys
+        if self.queue:
+            self.queue = [k for k in self.queue if k not in self.cells]
+            if self.task_mgr is None:
+                self.test_queue()
+            elif self.test_task is None or not self.test_task.is_alive():
+                self.test_task = self.task_mgr.add(self._test_task, 'grass_occlusion_test',
+                                                   taskChain='grass_occlusion')
+        occluded = self.cells.get(key)
+        if self.applied != (key, occluded is not None):
+            self.applied = (key, occluded is not None)
+            self.apply(np.zeros(len(self.chunks), dtype=bool) if occluded is None else occluded)
+        while len(self.cells) > self.max_cells:
+            self.cells.popitem(last=False)
+
+    def test_queue(self):
+        '''Tests the cells in the queue, at least one, until budget seconds are used,
+        returns False if there was nothing to test'''
+        start = time.perf_counter()
+        tested = False
+        for key in self.queue:
+            if key not in self.cells:
+                self.cells[key] = self.test_cell(key)
+                tested = True
+                if time.perf_counter() - start > self.budget:
+                    break
+        return tested
+
+    def test_cell(self, key):
+        '''Returns a bool for each chunk, True if it's hidden from the camera cell -
+        chunks far away are culled by the LODNodes anyway, chunks close to the cell
+        are never hidden'''
+        occluded = np.zeros(len(self.chunks), dtype=bool)
+        center = (np.array(key) + 0.5) * self.cell_size
+        distance = np.linalg.norm(self.chunk_center[:, :2] - center[:2], axis=1)
+        # the distance from the cell to the nearest point of the chunk (roughly)
+        near = distance - self.chunk_radius - self.cell_size[0]
+        chunks = np.nonzero((near > self.cell_size[0]) & (near < self.max_distance))[0]
+        if len(chunks) > 0:
+            occluded[chunks] = self.test_chunks(self.eye_points(key), chunks)
+        return occluded
+
+    def eye_points(self, key):
+        '''Returns the eye points (shape (n, 3)) of the camera cell,
+        at the top of the cell, but never below the terrain'''
+        corner = np.array(key) * self.cell_size
+        eyes = np.empty((len(EYE_POINTS), 3))
+        eyes[:, :2] = corner[:2] + np.array(EYE_POINTS) * self.cell_size[:2]
+        eyes[:, 2] = corner[2] + self.cell_size[2]
+        ground = self.terrain_height(eyes[:, :2])
+        eyes[:, 2] = np.maximum(eyes[:, 2], np.where(np.isnan(ground), -np.inf, ground) + 0.5)
+        return eyes
+
+    def terrain_height(self, points):
+        '''Returns the height of the terrain at the points (xy, shape (n, 2)),
+        nan outside the terrain'''
+        uvs = (points - self.terrain_pos[:2]) / self.terrain_scale[:2]
+        height = grass.sample_bilinear(self.heights, np.clip(uvs, 0.0, 1.0))
+        outside = np.any((uvs < 0.0) | (uvs > 1.0), axis=1)
+        height[outside] = np.nan
+        return height
+
+    def horizon(self, eyes, distance):
+        '''Returns the horizon around the eyes (shape (n, 3)) up to distance, shape
+        (eyes, AZIMUTHS, steps) - the highest slope (height over distance) of the coarse
+        terrain seen from the eye in each direction, up to self.distances[step]'''
+        steps = min(len(self.distances), max(1, int(np.ceil(distance / self.step))))
+        pixels = np.floor((eyes[:, :2] - self.terrain_pos[:2]) / self.pixel_size).astype(np.intp)
+        # an eye this far from the terrain has no chunks close enough to test anyway
+        pixels = np.clip(pixels + self.pad, self.pad // 2, self.padded_size - self.pad // 2 - 1)
+        start = pixels[:, 1] * self.padded_size[0] + pixels[:, 0]
+        heights = self.padded[start[:, None, None] + self.offsets[:, :steps]]
+        slopes = (heights - eyes[:, 2, None, None]) / self.distances[:steps]
+        return np.maximum.accumulate(slopes, axis=-1)
+
+    def test_chunks(self, eyes, chunks):
+        '''Returns a bool for each of the chunks (indices), True if all the rays
+        from the eyes to the top of the chunk are blocked by the terrain'''
+        lo = self.chunk_min[chunks, None, :2]
+        hi = self.chunk_max[chunks, None, :2]
+        # rays, shape (eyes, chunks, points, 3)
+        rays = self.targets[chunks] - eyes[:, None, None, :]
+        length = np.linalg.norm(rays[..., :2], axis=-1)
+        horizon = self.horizon(eyes, length.max())
+        # the terrain under the chunk itself does not count, so only the horizon
+        # before the ray enters the chunk's bounds (in xy) is used
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t_lo = (lo - eyes[:, None, None, :2]) / rays[..., :2]
+            t_hi = (hi - eyes[:, None, None, :2]) / rays[..., :2]
+        t_enter = np.nan_to_num(np.minimum(t_lo, t_hi), nan=-np.inf).max(axis=-1)
+        # the number of horizon steps before the chunk
+        steps = np.clip(np.ceil(t_enter * length / self.step - 0.5), 0, horizon.shape[-1]).astype(np.intp)
+        azimuth = np.round(np.arctan2(rays[..., 1], rays[..., 0]) * AZIMUTHS / (2.0 * np.pi))
+        azimuth = azimuth.astype(np.intp) % AZIMUTHS
+        eye = np.arange(len(eyes))[:, None, None]
+        blocked = horizon[eye, azimuth, np.maximum(steps - 1, 0)] > rays[..., 2] / length
+        blocked &= steps > 0
+        return np.all(blocked, axis=(0, 2))
+
+    def apply(self, occluded):
+        '''Stashes the occluded chunks, unstashes the rest, only touches chunks that changed'''
+        for i in np.nonzero(occluded != self.stashed)[0]:
+            if occluded[i]:
+                self.chunks[i].stash()
+            else:
+                self.chunks[i].unstash()
+        self.stashed = occluded.copy()
+
+    def destroy(self):
+        if self.task is not None:
+            self.task_mgr.remove(self.task)
+        if self.test_task is not None:
+            self.task_mgr.remove(self.test_task)
+        self.apply(np.zeros(len(self.chunks), dtype=bool))
+        self.cells.clear()
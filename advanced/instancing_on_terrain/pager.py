@@ -0,0 +1,400 @@
+'''
+Streams a big terrain, split into square tiles, around the camera.
+
+A single ShaderTerrainMesh needs the whole heightfield in memory (and a
+power of 2 size), that's fine for the 512x512 terrain of this sample,
+but not for a world many times that size. Here the world is a TiledMap -
+a directory with the heights, splat weights and grass mask of the whole world
+as memory mapped .npy files - and a TerrainPager keeps a ring of tiles
+around the camera, each tile is a ShaderTerrainMesh with its own heightfield,
+normal map, attribute map and grass.
+
+Tiles are loaded on a background thread (the files are memory mapped,
+so only the part of the map the tile needs is read from disk), and tiles
+that are no longer near the camera are hidden, and dropped when the tiles
+in memory take more than the memory budget.
+
+Neighbour tiles share the pixels on their edges (a tile is tile_size pixels wide,
+but the next one starts tile_size-1 pixels later), the terrain vertices on the
+edge of a tile sample that edge pixel, so the seams line up when both tiles
+use the same LOD there. The normals are computed with one extra pixel from
+the neighbours, so the lighting is also the same on both sides of a seam.
+Each tile is its own ShaderTerrainMesh with its own LOD, when neighbours use
+different levels on the seam the coarser edge skips some of the pixels
+and cracks open. So each tile has a skirt - a strip of quads hanging down
+from its edges (skirt_depth units, see make_skirt() and shaders/terrain_skirt_v.glsl),
+the cracks show the skirt, not the sky. A crack deeper than skirt_depth can still show.
+
+To make a tiled map out of the terrain of this sample (mirrored, so the copies line up),
+run from this directory:
+python pager.py [--repeat 4] [--tile-size 512] [--out cache/tiled_map]
+then set 'terrain-map cache/tiled_map' in a prc file (or with load_prc_file_data()) to use it in main.py.
+'''
+import panda3d.core as p3d
+from direct.showbase.MessengerGlobal import messenger
+import numpy as np
+
+import argparse
+import json
+import os
+from collections import OrderedDict
+
+import grass
+import terrain
+
+TERRAIN_MAP = p3d.ConfigVariableString('terrain-map', '',
+                                       'Directory with a tiled terrain map to stream, see pager.py')
+ATTRIBUTE_MAP = '../../models/texture/terrain/terrain_atr.png'
+MAP_FILE = 'map.json'
+
+
+class TiledMap:
+    '''A terrain map split into square tiles, stored in a directory:
+        map.json - tile_size (pixels, power of 2), tiles (number of tiles in x and y),
+                   tile_world_size, height_scale and origin (world position of the corner)
+        height.npy - uint16 heights, shape (tiles_y*(tile_size-1)+1, tiles_x*(tile_size-1)+1)
+        attributes.npy - uint8 splat weights (rgb), same size as the heights
+        grass.npy - uint8 grass mask, shape (tiles_y*mask_size, tiles_x*mask_size)
+    All the rows are bottom to top (same as texture UVs)'''
+    def __init__(self, path):
+        with open(os.path.join(path, MAP_FILE)) as f:
+            info = json.load(f)
+        self.tile_size = info['tile_size']
+        self.tiles = tuple(info['tiles'])
+        self.tile_world_size = info['tile_world_size']
+        self.height_scale = info['height_scale']
+        self.origin = tuple(info['origin'])
+        self.heights = np.load(os.path.join(path, 'height.npy'), mmap_mode='r')
+        self.attributes = np.load(os.path.join(path, 'attributes.npy'), mmap_mode='r')
+        self.grass = np.load(os.path.join(path, 'grass.npy'), mmap_mode='r')
+        self.mask_size = self.grass.shape[1] // self.tiles[0]
+
+    def has_tile(self, x, y):
+        return 0 <= x < self.tiles[0] and 0 <= y < self.tiles[1]
+
+    def tile_at(self, pos):
+        '''Returns the (x, y) of the tile at the world position (may be outside the map)'''
+        return (int(np.floor((pos[0] - self.origin[0]) / self.tile_world_size)),
+                int(np.floor((pos[1] - self.origin[1]) / self.tile_world_size)))
+
+    def tile_transform(self, x, y):
+        '''Returns the TransformState for the ShaderTerrainMesh of a tile'''
+        size = self.tile_world_size
+        return p3d.TransformState.make_pos_hpr_scale((self.origin[0] + x * size,
+                                                      self.origin[1] + y * size,
+                                                      self.origin[2]),
+                                                     (0, 0, 0),
+                                                     (size, size, self.height_scale))
+
+    def height_window(self, x, y, border=0):
+        '''Returns the heights of a tile (0.0-1.0, float32) with border extra pixels
+        on each side from the neighbour tiles (repeating the edge of the map)'''
+        step = self.tile_size - 1
+        size = self.tile_size + 2 * border
+        rows = np.clip(np.arange(size) + y * step - border, 0, self.heights.shape[0] - 1)
+        cols = np.clip(np.arange(size) + x * step - border, 0, self.heights.shape[1] - 1)
+        return self.heights[np.ix_(rows, cols)].astype(np.float32) / 65535.0
+
+    def attribute_window(self, x, y):
+        step = self.tile_size - 1
+        return np.ascontiguousarray(self.attributes[y * step:y * step + self.tile_size,
+                                                    x * step:x * step + self.tile_size])
+
+    def grass_window(self, x, y):
+        size = self.mask_size
+        return self.grass[y * size:(y + 1) * size, x * size:(x + 1) * size].astype(np.float32) / 255.0
+
+
+def make_skirt(tile_size, depth):
+    '''Returns a GeomNode with the skirt for a tile with tile_size pixels -
+    a strip of quads along each edge, with a vertex for each pixel on the edge,
+    the vertices are (u, v, 0) on the top and (u, v, 1) on the bottom,
+    shaders/terrain_skirt_v.glsl puts them on the heightfield.
+    depth is how far down the skirt goes (in heightfield units, 0-1)'''
+    steps = np.linspace(0.0, 1.0, tile_size)
+    zeros = np.zeros(tile_size)
+    ones = np.ones(tile_size)
+    edges = [(steps, zeros), (ones, steps), (steps[::-1], ones), (zeros, steps[::-1])]
+    # top and bottom vertex for each point, shape (edges, points, 2, 3)
+    vertices = np.empty((4, tile_size, 2, 3), dtype=np.float32)
+    for i, (u, v) in enumerate(edges):
+        vertices[i, :, :, 0] = u[:, None]
+        vertices[i, :, :, 1] = v[:, None]
+    vertices[..., 2] = (0.0, 1.0)
+    # two triangles for each quad between two points, the skirt is two sided
+    first = (np.arange(4)[:, None] * tile_size + np.arange(tile_size - 1)) * 2
+    first = first.reshape(-1, 1)
+    indices = np.concatenate((first + (0, 1, 2), first + (2, 1, 3)), axis=1).astype(np.uint32)
+
+    vdata = p3d.GeomVertexData('skirt', p3d.GeomVertexFormat.get_v3(), p3d.Geom.UH_static)
+    vdata.unclean_set_num_rows(vertices.size // 3)
+    memoryview(vdata.modify_array(0)).cast('B')[:] = vertices.tobytes()
+    triangles = p3d.GeomTriangles(p3d.Geom.UH_static)
+    triangles.set_index_type(p3d.GeomEnums.NT_uint32)
+    index_array = triangles.modify_vertices()
+    index_array.unclean_set_num_rows(indices.size)
+    memoryview(index_array).cast('B')[:] = indices.tobytes()
+    geom = p3d.Geom(vdata)
+    geom.add_primitive(triangles)
+    node = p3d.GeomNode('skirt')
+    node.add_geom(geom)
+    # the shader moves the vertices onto the heightfield, and the bottom below it
+    node.set_bounds(p3d.BoundingBox(p3d.Point3(0.0, 0.0, -depth), p3d.Point3(1.0, 1.0, 1.0)))
+    node.set_final(True)
+    return node
+
+
+class Tile:
+    '''A loaded tile - root is the node with the terrain (and grass),
+    textures are the textures made for it, size is the estimated memory use in bytes'''
+    def __init__(self, key, root, textures, size):
+        self.key = key
+        self.root = root
+        self.textures = textures
+        self.size = size
+
+    def release(self):
+        self.root.remove_node()
+        for texture in self.textures:
+            texture.release_all()
+
+
+def make_texture(data, name, texture_format, component_type=p3d.Texture.T_unsigned_byte):
+    '''Returns a clamped, linear filtered texture with the data (rows bottom to top)'''
+    texture = p3d.Texture(name)
+    texture.setup_2d_texture(data.shape[1], data.shape[0], component_type, texture_format)
+    channels = 'RGB' if data.ndim == 3 else 'R'
+    texture.set_ram_image_as(np.ascontiguousarray(data).tobytes(), channels)
+    texture.set_wrap_u(p3d.SamplerState.WM_clamp)
+    texture.set_wrap_v(p3d.SamplerState.WM_clamp)
+    texture.set_minfilter(p3d.SamplerState.FT_linear)
+    texture.set_magfilter(p3d.SamplerState.FT_linear)
+    return texture
+
+
+def load_tile(tiled_map, x, y, grass_model=None, grass_card=None, grass_options={},
+              srgb=False, chunk_size=32.0, seed=0, skirt=None):
+    '''Makes the terrain (and grass, if a grass_model is given) for one tile,
+    skirt is a NodePath with the skirt (see make_skirt(), with the skirt shader),
+    this can be called from any thread. Returns a Tile'''
+    name = 'tile_{}_{}'.format(x, y)
+    root = p3d.NodePath(name)
+    size = tiled_map.tile_world_size
+    heights = tiled_map.height_window(x, y, border=1)
+    heightfield = make_texture(np.round(heights[1:-1, 1:-1] * 65535.0).astype(np.uint16),
+                               name+'_height', p3d.Texture.F_r16, p3d.Texture.T_unsigned_short)
+    terrain_node = p3d.ShaderTerrainMesh()
+    terrain_node.set_name(name)
+    terrain_node.heightfield = heightfield
+    terrain_node.generate()
+    terrain_node.set_transform(tiled_map.tile_transform(x, y))
+    terrain_np = root.attach_new_node(terrain_node)
+    # the heights have one extra pixel on each side, so the normals match on the seams
+    spacing = size / (tiled_map.tile_size - 1)
+    normals = terrain.compute_normals(heights, (size, size, tiled_map.height_scale), (spacing, spacing))
+    normal_map = terrain.normals_to_texture(normals[1:-1, 1:-1], name+'_normal')
+    attribute_map = make_texture(tiled_map.attribute_window(x, y), name+'_attribute',
+                                 p3d.Texture.F_srgb if srgb else p3d.Texture.F_rgb8)
+    terrain_np.set_shader_input('normal_map', normal_map)
+    terrain_np.set_shader_input('attribute_map', attribute_map)
+    if skirt is not None:
+        # the same skirt for all the tiles, with the heightfield and maps of this one
+        skirt_np = root.attach_new_node(name+'_skirt')
+        skirt_np.set_transform(tiled_map.tile_transform(x, y))
+        skirt_np.set_shader_input('ShaderTerrainMesh.heightfield', heightfield)
+        skirt_np.set_shader_input('normal_map', normal_map)
+        skirt_np.set_shader_input('attribute_map', attribute_map)
+        skirt.instance_to(skirt_np)
+    textures = [heightfield, normal_map, attribute_map]
+
+    if grass_model is not None:
+        rng = np.random.default_rng((seed, x, y))
+        # the mask is bottom to top, mask_to_uvs() wants it top to bottom (like an image)
+        uvs = grass.mask_to_uvs(tiled_map.grass_window(x, y)[::-1], seed=rng)
+        positions = grass.uvs_to_world(terrain_node, heights[1:-1, 1:-1, None], uvs)
+        if len(positions):
+            instances = grass.build_instances(positions, chunk_size, rng)
+            grass_root = grass.make_grass(grass_model, instances, root, card=grass_card, **grass_options)
+            textures.append(grass_root.get_shader_input('instance_tex').get_texture())
+    return Tile((x, y), root, textures, sum(texture.estimate_texture_memory() for texture in textures))
+
+
+class TerrainPager:
+    '''Keeps the tiles within radius (in tiles) of the camera loaded and shown,
+    tiles are loaded in the background, tiles further away are hidden
+    and dropped when all the tiles take more than max_bytes,
+    the skirts of the tiles go skirt_depth units down (0 - no skirts)'''
+    def __init__(self, task_mgr, tiled_map, parent, camera, radius=1, max_bytes=256*1024*1024,
+                 grass_model=None, grass_options={}, srgb=False, chunk_size=32.0, seed=0,
+                 skirt_depth=4.0):
+        self.task_mgr = task_mgr
+        self.map = tiled_map
+        self.camera = camera
+        self.radius = radius
+        self.max_bytes = max_bytes
+        self.root = parent.attach_new_node('terrain_pager')
+        self.tile_options = dict(grass_model=grass_model, grass_options=grass_options, srgb=srgb,
+                                 chunk_size=chunk_size, seed=seed,
+                                 grass_card=grass.make_card(grass_model) if grass_model else None)
+        if skirt_depth > 0.0:
+            depth = skirt_depth / tiled_map.height_scale
+            skirt = p3d.NodePath(make_skirt(tiled_map.tile_size, depth))
+            # over the terrain shader set on the root
+            skirt.set_shader(p3d.Shader.load(p3d.Shader.SL_GLSL, 'shaders/terrain_skirt_v.glsl',
+                                             'shaders/terrain_f.glsl'), 2)
+            skirt.set_shader_input('skirt_depth', depth)
+            skirt.set_two_sided(True)
+            self.tile_options['skirt'] = skirt
+        # loaded tiles, least recently wanted first
+        self.tiles = OrderedDict()
+        self.size = 0
+        self.pending = set()
+        self.wanted = []
+        self.center = None
+        self.task_mgr.setupTaskChain('terrain_pager', numThreads=1,
+                                     threadPriority=p3d.TP_low)
+        self.task = self.task_mgr.add(self.update, 'terrain_pager_update')
+
+    def update(self, task):
+        '''Checks in what tile the camera is, only does anything when that changes'''
+        center = self.map.tile_at(self.camera.get_pos(self.root))
+        if center != self.center:
+            self.set_center(center)
+        return task.cont
+
+    def set_center(self, center):
+        '''Loads the tiles around the center tile (nearest first), hides the rest'''
+        self.center = center
+        cx, cy = center
+        wanted = [(x, y) for x in range(cx - self.radius, cx + self.radius + 1)
+                         for y in range(cy - self.radius, cy + self.radius + 1)
+                  if self.map.has_tile(x, y)]
+        self.wanted = sorted(wanted, key=lambda key: (key[0] - cx) ** 2 + (key[1] - cy) ** 2)
+        for key, tile in self.tiles.items():
+            if key not in self.wanted:
+                tile.root.stash()
+        for key in self.wanted:
+            if key in self.tiles:
+                self.tiles[key].root.unstash()
+                self.tiles.move_to_end(key)
+            elif key not in self.pending:
+                self._request(key)
+        self._evict()
+
+    def _request(self, key):
+        self.pending.add(key)
+        self.task_mgr.add(self._load_task, 'terrain_pager_load', extraArgs=[key],
+                          taskChain='terrain_pager')
+
+    def is_ready(self):
+        '''Returns True if all the tiles around the camera are loaded'''
+        return all(key in self.tiles for key in self.wanted)
+
+    def _load_task(self, key):
+        # this runs in the 'terrain_pager' thread
+        if key not in self.wanted:
+            # the camera moved on before we got to it
+            self.task_mgr.add(self._loaded_task, 'terrain_pager_loaded', extraArgs=[key, None])
+            return
+        tile = load_tile(self.map, *key, **self.tile_options)
+        # hand the tile over to the main thread
+        self.task_mgr.add(self._loaded_task, 'terrain_pager_loaded', extraArgs=[key, tile])
+
+    def _loaded_task(self, key, tile):
+        self.pending.discard(key)
+        if tile is None:
+            # skipped, but the camera may have come back in the meantime
+            if key in self.wanted:
+                self._request(key)
+            return
+        self.tiles[key] = tile
+        self.size += tile.size
+        tile.root.reparent_to(self.root)
+        if key not in self.wanted:
+            tile.root.stash()
+            self.tiles.move_to_end(key, last=False)
+        self._evict()
+        messenger.send('terrain_tile_loaded', [key])
+
+    def _evict(self):
+        '''Drops the least recently wanted tiles until the tiles fit in max_bytes,
+        the tiles around the camera are never dropped'''
+        for key in list(self.tiles):
+            if self.size <= self.max_bytes:
+                break
+            if key in self.wanted:
+                continue
+            tile = self.tiles.pop(key)
+            self.size -= tile.size
+            tile.release()
+
+    def destroy(self):
+        self.task_mgr.remove(self.task)
+        for tile in self.tiles.values():
+            tile.release()
+        self.tiles.clear()
+        self.root.remove_node()
+
+
+def read_image(filename, channels):
+    '''Reads an image (at its real size), returns a float32 array (0.0-1.0)
+    with the shape (y_size, x_size, len(channels)), rows bottom to top'''
+    image = p3d.PNMImage()
+    if not image.read(filename):
+        raise IOError('Could not read image: '+filename)
+    texture = p3d.Texture()
+    texture.set_auto_texture_scale(p3d.ATS_none)
+    texture.load(image)
+    return grass.texture_to_array(texture, channels)
+
+
+def mirror_repeat(image, repeat):
+    '''Repeats the image repeat x repeat times, every other copy is mirrored,
+    so the edges of the copies line up'''
+    row = np.concatenate([image if i % 2 == 0 else image[:, ::-1] for i in range(repeat)], axis=1)
+    return np.concatenate([row if i % 2 == 0 else row[::-1] for i in range(repeat)], axis=0)
+
+
+def resample(image, y_size, x_size):
+    '''Bilinear resize of a (y_size, x_size[, channels]) image, the corner pixels stay in the corners'''
+    y = np.linspace(0.0, image.shape[0] - 1, y_size)
+    x = np.linspace(0.0, image.shape[1] - 1, x_size)
+    y0 = np.minimum(np.floor(y).astype(np.intp), image.shape[0] - 2)
+    x0 = np.minimum(np.floor(x).astype(np.intp), image.shape[1] - 2)
+    fy = (y - y0).reshape((-1, 1) + (1,) * (image.ndim - 2))
+    fx = (x - x0).reshape((1, -1) + (1,) * (image.ndim - 2))
+    top = image[y0][:, x0] * (1.0 - fx) + image[y0][:, x0 + 1] * fx
+    bottom = image[y0 + 1][:, x0] * (1.0 - fx) + image[y0 + 1][:, x0 + 1] * fx
+    return top * (1.0 - fy) + bottom * fy
+
+
+def build_map(path, repeat=4, tile_size=512):
+    '''Makes a TiledMap in path from the terrain of this sample, repeated (mirrored)
+    repeat x repeat times, each copy is a tile'''
+    pixels = repeat * (tile_size - 1) + 1
+    heights = resample(mirror_repeat(read_image(terrain.HEIGHTFIELD, 'R')[:, :, 0], repeat), pixels, pixels)
+    attributes = resample(mirror_repeat(read_image(ATTRIBUTE_MAP, 'RGB'), repeat), pixels, pixels)
+    mask = mirror_repeat(grass.read_mask(terrain.GRASS_MASK)[::-1], repeat)
+    os.makedirs(path, exist_ok=True)
+    np.save(os.path.join(path, 'height.npy'), np.round(heights * 65535.0).astype(np.uint16))
+    np.save(os.path.join(path, 'attributes.npy'), np.round(attributes * 255.0).astype(np.uint8))
+    np.save(os.path.join(path, 'grass.npy'), np.round(mask * 255.0).astype(np.uint8))
+    world_size = terrain.TERRAIN_SCALE[0]
+    with open(os.path.join(path, MAP_FILE), 'w') as f:
+        json.dump({'tile_size': tile_size,
+                   'tiles': [repeat, repeat],
+                   'tile_world_size': world_size,
+                   'height_scale': terrain.TERRAIN_SCALE[2],
+                   'origin': [-world_size * repeat * 0.5, -world_size * repeat * 0.5,
+                              terrain.TERRAIN_POS[2]]}, f, indent=1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=4, help='the map is repeat x repeat tiles')
+    parser.add_argument('--tile-size', type=int, default=512, help='pixels in a tile, a power of 2')
+    parser.add_argument('--out', default='cache/tiled_map')
+    args = parser.parse_args()
+    build_map(args.out, args.repeat, args.tile_size)
+    print('{}: {}x{} tiles'.format(args.out, args.repeat, args.repeat))
@@ -1,5 +1,6 @@
 #version 150
 in vec2 UV;
+in vec3 TINT;
 in float DISTANCE_TO_CAMERA;
 
 out vec4 final_color;
@@ -21,5 +22,5 @@ void main()
         {
         discard;
         }
-    final_color=color;
+    final_color=vec4(color.rgb*TINT, color.a);
     }
@@ -0,0 +1,98 @@
+#version 150
+in vec4 p3d_Vertex;
+in vec2 p3d_MultiTexCoord0;
+
+//the grass mask (brightness), one cell for each texel
+uniform sampler2D grass_mask;
+uniform sampler2D heightfield;
+uniform vec3 terrain_pos;
+uniform vec3 terrain_scale;
+uniform float threshold;
+uniform float jitter;
+uniform int seed;
+//the cells with grass (x + y * mask width), tile by tile, the instances
+//of a tile are the cells starting at cell_offset (see gpu_grass_cells() in grass.py)
+uniform isampler2D grass_cells;
+uniform int cell_offset;
+//this LOD band draws only this fraction of the grass
+uniform float density;
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelViewMatrix;
+uniform float osg_FrameTime;
+
+out vec2 UV;
+out vec3 TINT;
+out float DISTANCE_TO_CAMERA;
+
+//the 'lowbias32' integer hash, see hash_uint32() in grass.py
+uint hash(uint x)
+    {
+    x ^= x >> 16u;
+    x *= 0x7feb352du;
+    x ^= x >> 15u;
+    x *= 0x846ca68bu;
+    x ^= x >> 16u;
+    return x;
+    }
+
+//returns a value 0.0-1.0 from the hash, and moves on to the next hash
+float next_random(inout uint h)
+    {
+    float value = float(h >> 8u) / 16777216.0;
+    h = hash(h);
+    return value;
+    }
+
+void main()
+    {
+    //the position and everything else is made the same way
+    //as in gpu_placement_reference() in grass.py
+    ivec2 mask_size = textureSize(grass_mask, 0);
+    int index = cell_offset + gl_InstanceID;
+    int cells_per_row = textureSize(grass_cells, 0).x;
+    int cell_index = texelFetch(grass_cells, ivec2(index % cells_per_row, index / cells_per_row), 0).r;
+    ivec2 cell = ivec2(cell_index % mask_size.x, cell_index / mask_size.x);
+    bool has_grass = all(greaterThanEqual(cell, ivec2(0))) && all(lessThan(cell, mask_size))
+                     && texelFetch(grass_mask, clamp(cell, ivec2(0), mask_size-1), 0).r > threshold;
+
+    uint h = hash(uint(cell.x) + uint(cell.y)*uint(mask_size.x) + uint(seed)*0x9e3779b9u);
+    vec2 uv_jitter = vec2(next_random(h), next_random(h));
+    float heading = next_random(h) * 6.283185307;
+    float scale = 0.8 + next_random(h) * 0.4;
+    vec3 tint = 0.85 + vec3(next_random(h), next_random(h), next_random(h)) * 0.25;
+    float keep = next_random(h);
+
+    vec2 uv = clamp((vec2(cell) + 0.5) / vec2(mask_size) + (uv_jitter * 2.0 - 1.0) * jitter, 0.0, 1.0);
+    vec3 pos = terrain_pos + vec3(uv, textureLod(heightfield, uv, 0.0).r) * terrain_scale;
+
+    //density of the LOD band, the same grass is kept at each distance (see build_instances())
+    has_grass = has_grass && keep < density;
+    if (!has_grass)
+        {
+        //no grass here, all the vertices are put in the same point outside the view
+        gl_Position = vec4(2.0, 2.0, 2.0, 1.0);
+        UV = vec2(0.0);
+        TINT = vec3(0.0);
+        DISTANCE_TO_CAMERA = 0.0;
+        return;
+        }
+
+    vec4 vertex=p3d_Vertex;
+    //animation
+    float anim_co=vertex.z*0.2;
+    float phase = float(cell.x + cell.y);
+    float animation =sin(0.7*osg_FrameTime+phase)*sin(1.7*osg_FrameTime+phase)*anim_co;
+    vertex.xy += animation;
+    //rotate and scale
+    float s = sin(heading);
+    float c = cos(heading);
+    vertex.xy = mat2(c, s, -s, c) * vertex.xy;
+    vertex.xyz *= scale;
+    //position offset
+    vertex.xyz+=pos;
+    gl_Position = p3d_ModelViewProjectionMatrix *vertex;
+
+    UV = p3d_MultiTexCoord0;
+    TINT = tint;
+    DISTANCE_TO_CAMERA= -vec4(p3d_ModelViewMatrix* vertex).z;
+    }
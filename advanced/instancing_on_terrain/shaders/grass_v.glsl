@@ -2,26 +2,44 @@
 in vec4 p3d_Vertex;
 in vec2 p3d_MultiTexCoord0;
 
-uniform samplerBuffer grass_buf_tex;
+uniform sampler2D instance_tex;
+uniform int instance_offset;
 uniform mat4 p3d_ModelViewProjectionMatrix;
 uniform mat4 p3d_ModelViewMatrix;
 uniform float osg_FrameTime;
 
 out vec2 UV;
+out vec3 TINT;
 out float DISTANCE_TO_CAMERA;
 
 void main()
     {
+    //per instance data read from the instance texture, see python code (grass.py)
+    //each instance uses 2 texels:
+    //0: xyz - position offset, w - heading
+    //1: x - scale, yzw - color
+    //each chunk of grass starts at instance_offset
+    int id = gl_InstanceID + instance_offset;
+    int instances_per_row = textureSize(instance_tex, 0).x/2;
+    ivec2 coord = ivec2((id % instances_per_row)*2, id / instances_per_row);
+    vec4 pos_heading = texelFetch(instance_tex, coord, 0);
+    vec4 scale_tint = texelFetch(instance_tex, coord+ivec2(1, 0), 0);
+
     vec4 vertex=p3d_Vertex;
     //animation
     float anim_co=vertex.z*0.2;
-    float animation =sin(0.7*osg_FrameTime+float(gl_InstanceID))*sin(1.7*osg_FrameTime+float(gl_InstanceID))*anim_co;
+    float animation =sin(0.7*osg_FrameTime+float(id))*sin(1.7*osg_FrameTime+float(id))*anim_co;
     vertex.xy += animation;
-    //position offset read from the buffer texture, see python code
-    vec3 pos_offset= texelFetch(grass_buf_tex, gl_InstanceID).xyz;
-    vertex.xyz+=pos_offset;
+    //rotate and scale
+    float s = sin(pos_heading.w);
+    float c = cos(pos_heading.w);
+    vertex.xy = mat2(c, s, -s, c) * vertex.xy;
+    vertex.xyz *= scale_tint.x;
+    //position offset
+    vertex.xyz+=pos_heading.xyz;
     gl_Position = p3d_ModelViewProjectionMatrix *vertex;
 
     UV = p3d_MultiTexCoord0;
+    TINT = scale_tint.yzw;
     DISTANCE_TO_CAMERA= -vec4(p3d_ModelViewMatrix* vertex).z;
     }
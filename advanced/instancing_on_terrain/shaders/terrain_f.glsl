@@ -2,7 +2,12 @@
 
 // This is the terrain fragment shader. There is a lot of code in here
 // which is not necessary to render the terrain, but included for convenience -
-// Like generating normals from the heightmap or a simple fog effect.
+// Like a simple fog effect.
+// The normals are baked into normal_map from the heightfield when the terrain
+// is loaded (see terrain.py), so getting the normal is just one texture fetch.
+// The detail textures (color and normal) of all the layers are in two texture
+// arrays, layer i is blended in with the weight from channel i of the attribute_map,
+// layers with a zero weight are not sampled at all.
 
 // Most of the time you want to adjust this shader to get your terrain the look
 // you want. The vertex shader most likely will stay the same.
@@ -20,35 +25,40 @@ uniform struct {
 } ShaderTerrainMesh;
 
 uniform sampler2D attribute_map;
-uniform sampler2D grass_map;
-uniform sampler2D rock_map;
-uniform sampler2D snow_map;
-
-uniform vec3 wspos_camera;
-
-// Compute normal from the heightmap, this assumes the terrain is facing z-up
-vec3 get_terrain_normal() {
-  const float terrain_height = 50.0;
-  vec3 pixel_size = vec3(1.0, -1.0, 0) / textureSize(ShaderTerrainMesh.heightfield, 0).xxx;
-  float u0 = texture(ShaderTerrainMesh.heightfield, terrain_uv + pixel_size.yz).x * terrain_height;
-  float u1 = texture(ShaderTerrainMesh.heightfield, terrain_uv + pixel_size.xz).x * terrain_height;
-  float v0 = texture(ShaderTerrainMesh.heightfield, terrain_uv + pixel_size.zy).x * terrain_height;
-  float v1 = texture(ShaderTerrainMesh.heightfield, terrain_uv + pixel_size.zx).x * terrain_height;
-  vec3 tangent = normalize(vec3(1.0, 0, u1 - u0));
-  vec3 binormal = normalize(vec3(0, 1.0, v1 - v0));
-  return normalize(cross(tangent, binormal));
-}
+uniform sampler2D normal_map;
+// rock, grass, snow - same order as the channels of the attribute_map
+uniform sampler2DArray albedo_layers;
+uniform sampler2DArray normal_layers;
 
+// for more than 4 layers, add a second attribute map
+const int NUM_LAYERS = 3;
 
+uniform vec3 wspos_camera;
 
 void main() {
-  vec3 attr=texture(attribute_map, terrain_uv).rgb;
-  vec3 grass=texture(grass_map, terrain_uv*40.0).rgb;
-  vec3 rock=texture(rock_map, terrain_uv*40.0).rgb;
-  vec3 snow=texture(snow_map, terrain_uv*40.0).rgb;
-  vec3 diffuse = rock*attr.r + snow*attr.b + grass*attr.g;
-
-  vec3 normal = get_terrain_normal();
+  vec4 attr=texture(attribute_map, terrain_uv);
+  vec2 uv = terrain_uv*40.0;
+  // the layers are sampled in a branch, where the derivatives for picking
+  // the mipmap level are not defined, so they are computed here
+  vec2 uv_dx = dFdx(uv);
+  vec2 uv_dy = dFdy(uv);
+  vec3 diffuse = vec3(0.0);
+  // a tiny bit of 'up', so there's a normal even if all the weights are 0
+  vec3 detail_normal = vec3(0.0, 0.0, 0.001);
+  for (int i = 0; i < NUM_LAYERS; i++) {
+    float weight = attr[i];
+    if (weight > 0.0) {
+      diffuse += textureGrad(albedo_layers, vec3(uv, i), uv_dx, uv_dy).rgb*weight;
+      detail_normal += (textureGrad(normal_layers, vec3(uv, i), uv_dx, uv_dy).xyz*2.0-1.0)*weight;
+    }
+  }
+
+  // the normal map is in terrain space, the terrain is not rotated, so it's also world space
+  vec3 normal = normalize(texture(normal_map, terrain_uv).xyz*2.0-1.0);
+  // the detail normals are in tangent space, the tangent follows the u (x) axis of the terrain
+  vec3 tangent = normalize(vec3(1.0, 0.0, 0.0) - normal*normal.x);
+  vec3 binormal = cross(normal, tangent);
+  normal = normalize(mat3(tangent, binormal, normal)*detail_normal);
 
   // Add some fake lighting - you usually want to use your own lighting code here
   vec3 sun_vec = normalize(vec3(0.7, 0.2, 0.6));
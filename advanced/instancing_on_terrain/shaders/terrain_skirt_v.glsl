@@ -0,0 +1,36 @@
+#version 150
+
+// Vertex shader for the skirts of the terrain tiles (see pager.py), used with
+// the terrain fragment shader. The skirt is a strip of quads along the edges of a tile,
+// p3d_Vertex.xy is the position on the tile (0-1, same as the terrain UVs)
+// and p3d_Vertex.z is 0 for the top of the strip and 1 for the bottom.
+// The top follows the heightfield, the bottom hangs skirt_depth lower,
+// so the cracks between tiles that use a different LOD on the edge are covered.
+
+in vec4 p3d_Vertex;
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform mat4 p3d_ModelMatrix;
+uniform vec3 wspos_camera;
+// the same struct as in the fragment shader, only the heightfield is set for the skirts
+uniform struct {
+  sampler2D data_texture;
+  sampler2D heightfield;
+  int view_index;
+  int terrain_size;
+  int chunk_size;
+} ShaderTerrainMesh;
+// in heightfield units (0-1)
+uniform float skirt_depth;
+
+out vec2 terrain_uv;
+out vec3 vtx_pos;
+out vec3 view_vec;
+
+void main() {
+  terrain_uv = p3d_Vertex.xy;
+  vec3 position = vec3(terrain_uv, texture(ShaderTerrainMesh.heightfield, terrain_uv).x
+                                   - p3d_Vertex.z * skirt_depth);
+  gl_Position = p3d_ModelViewProjectionMatrix * vec4(position, 1);
+  vtx_pos = (p3d_ModelMatrix * vec4(position, 1)).xyz;
+  view_vec = vtx_pos - wspos_camera;
+}
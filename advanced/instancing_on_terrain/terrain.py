@@ -0,0 +1,101 @@
+'''
+Terrain setup shared by main.py, benchmark.py and build_cache.py
+
+The terrain normals are baked into a texture once (see make_normal_map()),
+so the terrain fragment shader can do one texture fetch for the normal,
+instead of sampling the heightfield 4 more times for each pixel.
+The normal map is kept in a cache file, keyed by a hash of the heightfield
+and the terrain scale (run build_cache.py to make it ahead of time).
+'''
+import panda3d.core as p3d
+import numpy as np
+
+import hashlib
+import os
+
+import grass
+
+HEIGHTFIELD = '../../models/texture/terrain/terrain_height.png'
+GRASS_MASK = '../../models/texture/terrain/terrain_grass.png'
+# the terrain is 512x512 units, 100 units high
+TERRAIN_SCALE = (512, 512, 100)
+TERRAIN_POS = (-256, -256, -30)
+NORMAL_CACHE_DIR = 'cache'
+
+
+def make_terrain_node(heightfield):
+    '''Returns a ShaderTerrainMesh for the heightfield (Texture),
+    scaled and moved into place, ready to be attached to the scene'''
+    terrain_node = p3d.ShaderTerrainMesh()
+    terrain_node.heightfield = heightfield
+    # terrain_node.target_triangle_width = 10.0
+    terrain_node.generate()
+    terrain_node.set_transform(p3d.TransformState.make_pos_hpr_scale(TERRAIN_POS,
+                                                                     (0, 0, 0),
+                                                                     TERRAIN_SCALE))
+    return terrain_node
+
+
+def compute_normals(heights, scale=TERRAIN_SCALE, spacing=None):
+    '''Returns the normals (shape (y_size, x_size, 3), z-up, unit length)
+    of a heightfield array (shape (y_size, x_size), 0.0-1.0, rows bottom to top)
+    using central differences (one sided at the edges), in world units.
+    spacing is the (x, y) distance between two pixels, by default scale/size'''
+    y_size, x_size = heights.shape
+    heights = heights.astype(np.float64) * scale[2]
+    if spacing is None:
+        spacing = (scale[0] / x_size, scale[1] / y_size)
+    dz_dy, dz_dx = np.gradient(heights, spacing[1], spacing[0])
+    normals = np.empty((y_size, x_size, 3))
+    normals[:, :, 0] = -dz_dx
+    normals[:, :, 1] = -dz_dy
+    normals[:, :, 2] = 1.0
+    normals /= np.linalg.norm(normals, axis=2, keepdims=True)
+    return normals
+
+
+def normals_to_texture(normals, name='terrain_normal'):
+    '''Returns a mipmapped RGB texture with the normals from compute_normals(),
+    packed into the 0-255 range (normal*0.5+0.5)'''
+    data = np.round((normals * 0.5 + 0.5) * 255.0).astype(np.uint8)
+    texture = p3d.Texture(name)
+    texture.setup_2d_texture(data.shape[1], data.shape[0], p3d.Texture.T_unsigned_byte,
+                             p3d.Texture.F_rgb8)
+    texture.set_ram_image_as(data.tobytes(), 'RGB')
+    texture.set_wrap_u(p3d.SamplerState.WM_clamp)
+    texture.set_wrap_v(p3d.SamplerState.WM_clamp)
+    texture.set_minfilter(p3d.SamplerState.FT_linear_mipmap_linear)
+    texture.set_magfilter(p3d.SamplerState.FT_linear)
+    texture.generate_ram_mipmap_images()
+    return texture
+
+
+def make_normal_map(heightfield, scale=TERRAIN_SCALE):
+    '''Returns a mipmapped RGB texture with the normals of the heightfield (Texture)'''
+    return normals_to_texture(compute_normals(grass.texture_to_array(heightfield)[:, :, 0], scale))
+
+
+def normal_map_file(heightfield, scale=TERRAIN_SCALE, cache_dir=NORMAL_CACHE_DIR):
+    '''Returns the name of the cache file for the normal map of the heightfield'''
+    key = hashlib.sha256(b'NORMAL001')
+    key.update(memoryview(heightfield.get_ram_image()))
+    key.update(repr((heightfield.get_x_size(), heightfield.get_y_size(), tuple(scale))).encode())
+    return os.path.join(cache_dir, 'terrain_normal_{}.txo'.format(key.hexdigest()[:16]))
+
+
+def load_or_build_normal_map(heightfield, scale=TERRAIN_SCALE, cache_dir=NORMAL_CACHE_DIR, force=False):
+    '''Returns the normal map of the heightfield from the cache,
+    if it's missing (or force is True) it's made with make_normal_map() and saved'''
+    filename = normal_map_file(heightfield, scale, cache_dir)
+    if not force and os.path.exists(filename):
+        texture = p3d.Texture()
+        if texture.read(p3d.Filename.from_os_specific(filename)):
+            return texture
+    texture = make_normal_map(heightfield, scale)
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temp file first, so a half written cache is never loaded
+    # (Panda3D picks the file type from the extension, so keep it at the end)
+    temp_filename = filename[:-len('.txo')] + '.tmp.txo'
+    if texture.write(p3d.Filename.from_os_specific(temp_filename)):
+        os.replace(temp_filename, filename)
+    return texture
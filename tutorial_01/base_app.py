@@ -7,10 +7,21 @@ New things that are not in 01_hello_world.py:
 -changing the title of the window at runtime
 -adding dirs to the model path
 -changing texture format for sRGB
+-loading models and textures from a cache of converted files (see utilities/assets.py)
+-loading models in the background, and putting them in the scene a few at a time
+-merging static models into a few big ones (set 'static-batching 1' to try it)
 '''
-
+import os
+import sys
+import collections
 import panda3d.core as p3d
 from direct.showbase.ShowBase import ShowBase
+from direct.directnotify.DirectNotifyGlobal import directNotify
+
+# the shared code in 'utilities' is one directory up
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from utilities import assets
+from utilities import batching
 
 FT_MIPMAP = p3d.SamplerState.FT_linear_mipmap_linear
 FT_LINEAR = p3d.SamplerState.FT_linear
@@ -25,6 +36,8 @@ M_MSAA= p3d.AntialiasAttrib.M_multisample
 
 
 class BaseApp(ShowBase):
+    notify = directNotify.newCategory('BaseApp')
+
     def __init__(self):
         super().__init__()
         # we are running from a sub directory
@@ -37,8 +50,25 @@ class BaseApp(ShowBase):
         self.render.set_shader_auto()
         self.render.set_antialias(M_MSAA)
 
+        # models loaded in the background wait here until their textures can be uploaded
+        self.upload_queue = collections.deque()
+        # how many bytes of textures can be uploaded to the GPU each frame
+        # (at least one model is put in the scene each frame, even if it's bigger)
+        self.upload_budget = 16*1024*1024
+        self.assets_total = 0
+        self.assets_done = 0
+        # only runs while there are models loading
+        self.uploading = None
+        # models are converted (if not in the cache yet) and loaded in this thread
+        self.taskMgr.setupTaskChain('asset_loader', numThreads=1, threadPriority=p3d.TP_low)
+        # textures used by replace_texture(), shared by all the models that use them
+        self.textures = assets.TextureRegistry()
+
     def set_window_title(self, title):
         '''Change the title of the window'''
+        # offscreen buffers have no title
+        if not isinstance(self.win, p3d.GraphicsWindow):
+            return
         win_props = p3d.WindowProperties()
         win_props.set_title(title)
         self.win.request_properties(win_props)
@@ -68,12 +98,8 @@ class BaseApp(ShowBase):
 
     def setup_scene(self):
         '''Creates a industrial style room with 5 boxes '''
-        self.room = self.loader.load_model('models/room_industrial')
-        self.room.reparent_to(self.render)
-
-        crate_model = self.loader.load_model('models/crate')
-        crate_model.set_scale(1.033)
-        crate_model.flatten_light()
+        self.room = self.render.attach_new_node('room')
+        self.load_model_async('models/room_industrial', self.room)
 
         crate_transforms=[
                         {},
@@ -84,7 +110,9 @@ class BaseApp(ShowBase):
                         {'pos':(3.1,-1.35,0), 'scale':(1.3), 'color':(0.66, 0.55, 0.46, 1.0),
                          'tex':'models/texture/crate_2.png','tex_n':'models/texture/crate_2_ng.png'}
                          ]
-        self.crates = [crate_model.copy_to(self.render) for _ in range(5)]
+        # the crates are empty nodes until the model is loaded,
+        # so they can be moved (or looked at) right away
+        self.crates = [self.render.attach_new_node('crate') for _ in range(5)]
         for crate, transform in zip(self.crates, crate_transforms):
             if 'pos' in transform:
                 crate.set_pos(transform['pos'])
@@ -94,29 +122,119 @@ class BaseApp(ShowBase):
                 crate.set_scale(transform['scale'])
             if 'color' in transform:
                 crate.set_color(transform['color'], 1)
+        self.load_model_async('models/crate', self.crates, self.setup_crates, [crate_transforms])
+        # the room and crates never move, they can be merged once they are all loaded
+        if p3d.ConfigVariableBool('static-batching', False).get_value():
+            self.accept_once('assets_loaded', self.bake_static, [[self.room]+self.crates])
+
+    def setup_crates(self, crate_transforms, crates):
+        '''Called when the crate model is in place, changes the textures on some crates'''
+        for crate, transform in zip(crates, crate_transforms):
+            # the model is a tiny bit too small
+            crate.get_child(0).set_scale(1.033)
             if 'tex' in transform:
                 self.replace_texture(crate, transform['tex'])
             if 'tex_n' in transform:
                 self.replace_texture(crate, transform['tex_n'], stage=TS_NORMAL_GLOSS)
 
+    def bake_static(self, objects):
+        '''Merges the objects into as few geoms as possible (one for each texture/material)
+        the objects are stashed, see utilities/batching.py'''
+        self.static_batch = batching.bake_static(objects, self.render)
+        return self.static_batch
+
+    def load_model_async(self, model, parents, callback=None, extra_args=[]):
+        '''Loads a model in the background (from the asset cache, see utilities/assets.py),
+        once it's loaded and there's room in the upload budget it's copied to the
+        parent (or each parent, if parents is a list), then callback(*extra_args, parents) is called.
+        If the model is not in the cache yet, it's converted in the background too.
+        Sends a 'asset_progress' event with the number of loaded and all models
+        each time a model is done, and 'assets_loaded' when all are done'''
+        srgb = p3d.ConfigVariableBool('framebuffer-srgb').get_value()
+        self.assets_total += 1
+        if self.uploading is None:
+            self.uploading = self.add_task(self.upload_task, 'upload_task')
+        self.add_task(self.load_task, 'load_model_async', extraArgs=[model, srgb, parents, callback, extra_args],
+                      taskChain='asset_loader')
+
+    def load_task(self, model, srgb, parents, callback, extra_args):
+        '''Converts (if not in the cache yet) and loads a model, runs in the 'asset_loader' thread'''
+        try:
+            filename = p3d.Filename.from_os_specific(assets.model_file(model, srgb))
+            loaded = p3d.Loader.get_global_ptr().load_sync(filename)
+            if loaded is None:
+                raise IOError('Could not load model: '+str(filename))
+            loaded = p3d.NodePath(loaded)
+        except Exception as error:
+            # nothing would catch it in this thread, the model is skipped
+            self.notify.warning(str(error))
+            loaded = None
+        # hand the model over to the main thread
+        self.add_task(self.model_loaded, 'model_loaded', extraArgs=[loaded, parents, callback, extra_args])
+
+    def model_loaded(self, model, parents, callback, extra_args):
+        '''Called in the main thread when a model is loaded, see load_model_async()'''
+        self.upload_queue.append((model, parents, callback, extra_args))
+
+    def upload_task(self, task):
+        '''Puts loaded models in the scene, as many as the upload budget allows,
+        ends when all the models are loaded'''
+        uploaded = 0
+        gsg = self.win.get_gsg()
+        while self.upload_queue and uploaded < self.upload_budget:
+            model, parents, callback, extra_args = self.upload_queue.popleft()
+            if model is not None:
+                for texture in model.find_all_textures():
+                    if not texture.is_prepared(gsg.get_prepared_objects()):
+                        uploaded += texture.estimate_texture_memory()
+                # the textures and geometry are uploaded next frame, before drawing
+                model.prepare_scene(gsg)
+                if isinstance(parents, p3d.NodePath):
+                    parents = [parents]
+                for parent in parents:
+                    model.copy_to(parent)
+                if callback:
+                    callback(*extra_args, parents)
+            self.assets_done += 1
+            self.messenger.send('asset_progress', [self.assets_done, self.assets_total])
+            if self.assets_done == self.assets_total:
+                self.messenger.send('assets_loaded')
+        if self.assets_done == self.assets_total:
+            self.uploading = None
+            return task.done
+        return task.cont
+
+    def load_progress(self):
+        '''Returns how much of the models are loaded (0.0-1.0)'''
+        if self.assets_total == 0:
+            return 1.0
+        return self.assets_done / self.assets_total
+
     def replace_texture(self, model, texture, stage=TS_MODULATE, minfilter = FT_MIPMAP, magfilter = FT_LINEAR):
         '''Replace the texture on a model '''
-        new_tex=self.loader.load_texture(texture)
-        new_tex.set_minfilter(FT_MIPMAP)
-        new_tex.set_magfilter(FT_LINEAR)
-
-        if  p3d.ConfigVariableBool('framebuffer-srgb').get_value() and stage==TS_MODULATE:
-            tex_format=new_tex.get_format()
-            if tex_format == F_RGB:
-                new_tex.set_format(F_SRGB)
-            elif tex_format == F_RGBA:
-                new_tex.set_format(F_SRGBA)
+        # the format (sRGB or not), filters and mipmaps are already in the cached texture
+        # models using the same file (with the same settings) get the same texture
+        srgb = p3d.ConfigVariableBool('framebuffer-srgb').get_value() and stage==TS_MODULATE
+        new_tex=self.textures.get(texture, stage, srgb, minfilter, magfilter)
+        # the texture this replaces (if it was set here before) has one user less
+        replaced = model.get_python_tag('replaced_textures') or {}
+        if stage in replaced:
+            self.textures.release(replaced[stage])
+        replaced[stage] = new_tex
+        model.set_python_tag('replaced_textures', replaced)
 
         for tex_stage in model.find_all_texture_stages():
             if model.find_texture(tex_stage):
                 if tex_stage.get_mode() == stage:
                     model.set_texture(tex_stage, new_tex, 1)
 
+    def release_textures(self, model):
+        '''Call this before removing a model that had textures replaced,
+        textures no longer used by any model are removed from the GPU'''
+        for texture in (model.get_python_tag('replaced_textures') or {}).values():
+            self.textures.release(texture)
+        model.clear_python_tag('replaced_textures')
+
 
 # run all the code
 if __name__ == "__main__":
@@ -127,6 +245,10 @@ if __name__ == "__main__":
 
     app=BaseApp()
     app.set_window_title('Panda3D - Hello World')
+    # show the loading progress in the title
+    app.accept('asset_progress', lambda done, total: app.set_window_title(
+               'Panda3D - Hello World (loading {}/{})'.format(done, total)))
+    app.accept('assets_loaded', app.set_window_title, ['Panda3D - Hello World'])
     app.setup_scene()
     app.setup_lights()
 
@@ -0,0 +1,193 @@
+'''
+The camera controller from 02_camera_control.py, as a class that can be reused.
+
+The camera orbits around a point (the camera_node), the mouse is used to
+rotate, move and zoom, the keys are read from a .ini file (see keys.ini).
+
+The task that moves the camera only runs while it has something to do
+- while a key is held down or the zoom has not settled yet - when the player
+is not touching anything, no Python code runs for the camera at all.
+
+The controller can also be driven without a window, mouse or task, from
+recorded input, with feed() - this is useful for tests and benchmarks:
+
+    controller.feed([(['mouse3'], (0.0, 0.0)),
+                     ([], (0.1, 0.0)),
+                     (['mouse3-up'], (0.1, 0.0))], dt=1.0/60.0)
+'''
+import panda3d.core as p3d
+from direct.showbase.DirectObject import DirectObject
+from direct.showbase.MessengerGlobal import messenger
+
+import configparser
+import math
+
+from utilities import profiling
+
+
+class CameraController(DirectObject):
+    def __init__(self, camera, parent, key_file='tutorial_02/keys.ini', mouse_watcher=None):
+        '''camera - the camera NodePath (eg. ShowBase.camera)
+        parent - the node the camera rig is attached to (eg. ShowBase.render)
+        key_file - .ini file with the key bindings
+        mouse_watcher - the MouseWatcher node used to read the mouse (eg. ShowBase.mouseWatcherNode)'''
+        super().__init__()
+        self.camera = camera
+        self.mouse_watcher = mouse_watcher
+        # we will control the camera using a rig of 2 nodes
+        # the 'node' will be the point in space where the camera looks at
+        # the 'gimbal' will act as an arm that the camera is attached to
+        self.camera_node = parent.attach_new_node('camera_node')
+        self.camera_gimbal = self.camera_node.attach_new_node('gimbal')
+        # the camera will orbit around the camera_node, here we'll set
+        # how far that orbit is from the focus point
+        camera_offset = (0, 5, 5)
+        self.camera.set_pos(parent, camera_offset)
+        self.camera.look_at(self.camera_node)
+        # we use 'wrt_reparent_to' to keep the offset we just set
+        self.camera.wrt_reparent_to(self.camera_gimbal)
+
+        # configuration time
+        # how fast can the camera rotate?
+        self.rotation_speed = 100.0
+        # how fast can the camera move?
+        self.move_speed = 10.0
+        # how fast can the camera zoom?
+        self.zoom_speed = 10.0
+        self.zoom_damping = 2.0
+        # how much can the camera tilt? (change 'p' in HPR sense)
+        self.p_limit = p3d.Vec2(-45, 45)
+        # how much can the camera zoom in or out?
+        self.zoom_limit = [3, 20]
+
+        # controls:
+        # we'll read the keys from an .ini file
+        # not the .prc Panda3D configuration file format, because most players
+        # will not recognize .prc as human readable, .ini files are common in games
+        key_config = configparser.ConfigParser()
+        key_config.read(key_file)
+        # the mouse wheel works just like a button, it fires 'wheel_up' or 'wheel_down'
+        # we will zoom in (or out) some amount whenever the wheel is moved
+        # self.zoom will tell us how much we still need to move and in what direction
+        self.zoom = 0.0
+        # 'accept' tells the DirectObject to call a function (with a list of arguments)
+        # when an event happens, eg. when the wheel is spun Panda3D sends 'wheel_up'
+        # and the controller calls self.zoom_control(1.0)
+        self.accept(key_config['camera_zoom']['zoom_in'], self.zoom_control, [1.0])
+        self.accept(key_config['camera_zoom']['zoom_out'], self.zoom_control, [-1.0])
+        # for other keys we want to know if the player is holding down a key
+        self.key_down = {}
+        for event, key in key_config['camera_keys'].items():
+            self.key_down[event] = False
+            self.accept(key, self.set_key, [event, True])
+            # the keys can me 'compound' like 'shift-mouse1' or 'alt-mouse1'
+            # there is no -up event for such key-combos, we react just to the first key
+            if '-' in key:
+                self.accept(key.split('-')[0]+'-up', self.set_key, [event, False])
+            else:
+                self.accept(key+'-up', self.set_key, [event, False])
+
+        # where the mouse was last frame, has_last_mouse is False
+        # until we have a valid value (after the task wakes up)
+        # the vectors are made once and reused, so the update makes no new objects
+        self.last_mouse = p3d.Vec2()
+        self.has_last_mouse = False
+        self.move = p3d.Vec3()
+        # the task is only running if there's something to do
+        self.task = None
+        # True while driven by feed(), then the task is not used
+        self.manual = False
+
+    def zoom_control(self, amount):
+        self.zoom = amount
+        self.wake()
+
+    def set_key(self, event, value):
+        self.key_down[event] = value
+        if value:
+            self.wake()
+
+    def is_active(self):
+        '''Returns True if the camera has some moving to do'''
+        return self.zoom != 0.0 or True in self.key_down.values()
+
+    def wake(self):
+        '''Starts the update task, if it's not running'''
+        if self.task is None and not self.manual:
+            self.task = self.add_task(self.update_task, 'camera_update')
+
+    # the time this task takes is recorded as 'App:camera_update'
+    @profiling.timed('App:camera_update')
+    def update_task(self, task):
+        '''The task that moves the camera, it stops when there's nothing more to do'''
+        mouse_watcher = self.mouse_watcher
+        if mouse_watcher is not None and mouse_watcher.has_mouse():
+            self.update(p3d.ClockObject.get_global_clock().get_dt(),
+                        mouse_watcher.get_mouse_x(), mouse_watcher.get_mouse_y())
+        if self.is_active():
+            return task.cont
+        self.task = None
+        self.has_last_mouse = False
+        return task.done
+
+    def update(self, dt, mouse_x, mouse_y):
+        '''Moves, rotates and zooms the camera, dt is the frame time,
+        mouse_x and mouse_y is the mouse position (-1.0 to 1.0)'''
+        # let's see how much the mouse moved from last time, or if this is the first frame
+        if not self.has_last_mouse:
+            self.last_mouse.set(mouse_x, mouse_y)
+            self.has_last_mouse = True
+            return
+        delta_x = mouse_x - self.last_mouse.x
+        delta_y = mouse_y - self.last_mouse.y
+        self.last_mouse.set(mouse_x, mouse_y)
+        # camera zoom
+        if self.zoom != 0.0:
+            # let's see how far the camera is from the pivot point
+            distance = self.camera.get_distance(self.camera_node)
+            # we don't want it to be too close nor to far away
+            if (distance > self.zoom_limit[0] and self.zoom > 0.0) or \
+               (distance < self.zoom_limit[1] and self.zoom < 0.0):
+                # move the camera away or closer to the pivot point
+                # we do that by moving the camera relative to itself
+                self.camera.set_y(self.camera, self.zoom*dt*self.zoom_speed)
+                # slow down the zoom, until it stops
+                damping = dt*self.zoom_damping
+                if abs(self.zoom) <= damping:
+                    self.zoom = 0.0
+                else:
+                    self.zoom -= math.copysign(damping, self.zoom)
+            else:
+                self.zoom = 0.0
+        if self.key_down['rotate']:
+            h = self.camera_node.get_h() - delta_x*self.rotation_speed
+            self.camera_node.set_h(h)
+            p = self.camera_gimbal.get_p() - delta_y*self.rotation_speed
+            p = min(max(p, self.p_limit.x), self.p_limit.y)
+            self.camera_gimbal.set_p(p)
+        if self.key_down['relative_move']:
+            # move the node in the plane of the screen
+            self.move.set(-delta_x*self.move_speed, 0.0, -delta_y*self.move_speed)
+            self.camera_node.set_pos(self.camera_node, self.camera_node.get_relative_vector(self.camera, self.move))
+        elif self.key_down['move']:
+            self.move.set(delta_x*self.move_speed, delta_y*self.move_speed, 0.0)
+            self.camera_node.set_pos(self.camera_node, self.move)
+
+    def feed(self, frames, dt=1.0/60.0):
+        '''Drives the camera from recorded input, without the task.
+        frames is an iterable of (events, mouse) for each frame, events is a list
+        of event names sent (with the messenger, so they go through the same
+        accept() handlers as real input) before the frame is updated,
+        mouse is a (x, y) tuple or None if the mouse is outside the window'''
+        manual = self.manual
+        self.manual = True
+        try:
+            for events, mouse in frames:
+                for event in events:
+                    messenger.send(event)
+                if mouse is not None:
+                    self.update(dt, *mouse)
+                if not self.is_active():
+                    self.has_last_mouse = False
+        finally:
+            self.manual = manual
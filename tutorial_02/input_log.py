@@ -0,0 +1,151 @@
+'''
+Records the input of a CameraController (see camera_controller.py) to a small
+binary file, and plays it back, so the camera moves the same way every time -
+useful to profile the same camera path on different builds and machines.
+
+Set these in a prc file (or with load_prc_file_data()) before starting 02_camera_control.py:
+    input-record camera.log     - record the input, the file is written at exit
+    input-replay camera.log     - play the input back, 'input_replay_done' is sent at the end
+    input-replay-dt 0.016666    - the frame time used for the replay (default: the recorded one)
+
+The events sent during each frame (only the ones the controller listens to)
+and the mouse position at the end of the frame are recorded. When played back
+the events are sent with the messenger, so they go to the same accept() handlers
+as real input, and the camera is updated with a fixed dt.
+
+The file format (little endian):
+    header: b'P3DI', version (uint16), dt (float32), number of event names (uint16)
+    event names: length (uint8) + utf-8 name, for each name
+    frames: flags (uint8, 1 - has mouse), number of events (uint8),
+            mouse x, y (2x float32, only if it has mouse), event indices (uint8 each)
+'''
+import panda3d.core as p3d
+from direct.showbase.DirectObject import DirectObject
+from direct.showbase.MessengerGlobal import messenger
+
+import atexit
+import struct
+
+MAGIC = b'P3DI'
+VERSION = 1
+HEADER = struct.Struct('<4sHfH')
+FRAME = struct.Struct('<BB')
+MOUSE = struct.Struct('<ff')
+HAS_MOUSE = 1
+
+RECORD_FILE = p3d.ConfigVariableString('input-record', '',
+                                       'Record the camera input to this file')
+REPLAY_FILE = p3d.ConfigVariableString('input-replay', '',
+                                       'Play back the camera input from this file')
+REPLAY_DT = p3d.ConfigVariableDouble('input-replay-dt', 0.0,
+                                     'Frame time used to play back the camera input, 0 - the recorded one')
+
+
+def write_log(filename, frames, dt):
+    '''Writes frames - a list of (events, mouse) (see CameraController.feed()) to a file'''
+    names = sorted({event for events, mouse in frames for event in events})
+    index = {name: i for i, name in enumerate(names)}
+    data = bytearray(HEADER.pack(MAGIC, VERSION, dt, len(names)))
+    for name in names:
+        encoded = name.encode('utf-8')
+        data += struct.pack('<B', len(encoded)) + encoded
+    for events, mouse in frames:
+        data += FRAME.pack(HAS_MOUSE if mouse is not None else 0, len(events))
+        if mouse is not None:
+            data += MOUSE.pack(*mouse)
+        data += bytes(index[event] for event in events)
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+
+def read_log(filename):
+    '''Reads a file written by write_log(), returns (frames, dt)'''
+    with open(filename, 'rb') as f:
+        data = f.read()
+    magic, version, dt, num_names = HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise IOError('Not a input log (or a different version): '+filename)
+    offset = HEADER.size
+    names = []
+    for i in range(num_names):
+        length = data[offset]
+        names.append(data[offset+1:offset+1+length].decode('utf-8'))
+        offset += 1+length
+    frames = []
+    while offset < len(data):
+        flags, num_events = FRAME.unpack_from(data, offset)
+        offset += FRAME.size
+        mouse = None
+        if flags & HAS_MOUSE:
+            mouse = MOUSE.unpack_from(data, offset)
+            offset += MOUSE.size
+        events = [names[i] for i in data[offset:offset+num_events]]
+        offset += num_events
+        frames.append((events, mouse))
+    return frames, dt
+
+
+class InputRecorder(DirectObject):
+    '''Records the events the controller listens to, and the mouse position, each frame'''
+    def __init__(self, controller, filename=None):
+        super().__init__()
+        self.controller = controller
+        self.filename = filename
+        self.frames = []
+        self.events = []
+        self.total_dt = 0.0
+        for event in controller.getAllAccepting():
+            self.accept(event, self.events.append, [event])
+        # run late, after the events and the camera update for the frame
+        self.add_task(self.record_task, 'input_record', sort=49)
+        if filename:
+            atexit.register(self.save)
+
+    def record_task(self, task):
+        mouse = None
+        mouse_watcher = self.controller.mouse_watcher
+        if mouse_watcher is not None and mouse_watcher.has_mouse():
+            mouse = (mouse_watcher.get_mouse_x(), mouse_watcher.get_mouse_y())
+        self.frames.append((self.events, mouse))
+        self.events = []
+        self.total_dt += p3d.ClockObject.get_global_clock().get_dt()
+        return task.cont
+
+    def save(self, filename=None):
+        '''Writes what was recorded so far to a file, with the mean frame time as dt'''
+        dt = self.total_dt/len(self.frames) if self.frames else 1.0/60.0
+        write_log(filename or self.filename, self.frames, dt)
+
+
+class InputPlayer(DirectObject):
+    '''Plays back recorded frames, one each frame, with a fixed dt,
+    the live mouse is ignored by the controller until it's done'''
+    def __init__(self, controller, frames, dt=1.0/60.0):
+        super().__init__()
+        self.controller = controller
+        self.frames = iter(frames)
+        self.dt = dt
+        controller.manual = True
+        if controller.task is not None:
+            controller.remove_task(controller.task)
+            controller.task = None
+        self.add_task(self.play_task, 'input_replay')
+
+    def play_task(self, task):
+        for frame in self.frames:
+            self.controller.feed((frame,), self.dt)
+            return task.cont
+        self.controller.manual = False
+        messenger.send('input_replay_done')
+        return task.done
+
+
+def from_config(controller):
+    '''Starts recording or playing back the input of the controller,
+    if asked to in the config (see the module docs), returns the recorder or player'''
+    if REPLAY_FILE.get_value():
+        frames, dt = read_log(REPLAY_FILE.get_value())
+        return InputPlayer(controller, frames, REPLAY_DT.get_value() or dt)
+    if RECORD_FILE.get_value():
+        return InputRecorder(controller, RECORD_FILE.get_value())
+    return None
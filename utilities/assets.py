@@ -0,0 +1,304 @@
+'''
+Loads models and textures from a cache of preprocessed files.
+
+The first time a texture is loaded with load_texture() it's read from the png
+(or whatever it was), given the right format (sRGB or not) and filters,
+mipmaps are made (and optionally it's compressed, see below) and the result
+is written to cache/assets/ as a .txo file named after the hash of the source
+file and the options. The next time the .txo is loaded, no decoding,
+no mipmap generation, no fixing formats in Python.
+
+Models (.egg and .egg.pz) loaded with load_model() are written to the cache as .bam,
+with the textures of the model replaced by the cached .txo versions
+(sRGB for color textures, if asked to). The cached model is rebuilt if the model
+or any of its textures changes.
+
+Texture arrays (one layer for each file, eg. for terrain splatting) are made
+and cached the same way with load_texture_array().
+
+Set 'asset-compression dxt' in a prc file to also DXT compress the textures in the cache
+(less video memory, but lower quality, normal maps may look bad).
+
+To build the cache ahead of time (eg. as part of a build), run from the repo root:
+python utilities/assets.py [--force] [--srgb] [--linear] [files ...]
+'''
+import panda3d.core as p3d
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+# change this if the conversion changes, so old files get rebuilt
+VERSION = 1
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CACHE_DIR = os.path.join(ROOT, 'cache', 'assets')
+COMPRESSION = p3d.ConfigVariableString('asset-compression', 'none',
+                                       'Compression used for textures in the asset cache: none or dxt')
+MODEL_EXTENSIONS = ('.egg', '.egg.pz', '.bam')
+TEXTURE_EXTENSIONS = ('.png', '.jpg', '.tga', '.dds')
+
+FT_MIPMAP = p3d.SamplerState.FT_linear_mipmap_linear
+FT_LINEAR = p3d.SamplerState.FT_linear
+TS_MODULATE = p3d.TextureStage.M_modulate
+
+
+def find_file(filename):
+    '''Returns the full os specific path to a file on the model path,
+    trying the known model extensions if the filename has none, None if not found'''
+    for name in [filename] + [filename+ext for ext in MODEL_EXTENSIONS]:
+        path = p3d.Filename(name)
+        if path.resolve_filename(p3d.get_model_path().get_value()):
+            return path.to_os_specific()
+    return None
+
+
+def content_hash(filename, *options):
+    '''Returns a hash of the content of the file, VERSION and any options'''
+    digest = hashlib.sha256(repr((VERSION,)+options).encode())
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cache_file(key, extension):
+    return os.path.join(CACHE_DIR, key+extension)
+
+
+def write_file(filename, write):
+    '''Calls write(tmp_name) and moves the file into place,
+    so a half written file is never loaded'''
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Panda3D picks the file type from the extension, so keep it at the end
+    name, extension = os.path.splitext(filename)
+    tmp = name+'.tmp'+extension
+    if not write(p3d.Filename.from_os_specific(tmp)):
+        raise IOError('Could not write '+filename)
+    os.replace(tmp, filename)
+
+
+def srgb_format(texture):
+    '''Returns the sRGB version of the texture format'''
+    if texture.get_num_components() == 4:
+        return p3d.Texture.F_srgb_alpha
+    if texture.get_num_components() == 3:
+        return p3d.Texture.F_srgb
+    return texture.get_format()
+
+
+def build_texture(source, target, srgb, minfilter, magfilter, compression):
+    '''Converts the source texture into a mipmapped .txo'''
+    texture = p3d.Texture()
+    if not texture.read(p3d.Filename.from_os_specific(source)):
+        raise IOError('Could not load texture: '+source)
+    if srgb:
+        texture.set_format(srgb_format(texture))
+    texture.set_minfilter(minfilter)
+    texture.set_magfilter(magfilter)
+    texture.generate_ram_mipmap_images()
+    if compression == 'dxt':
+        # returns False if Panda3D was built without squish, the texture is fine uncompressed
+        texture.compress_ram_image(p3d.Texture.CM_dxt5 if texture.get_num_components() == 4
+                                   else p3d.Texture.CM_dxt1)
+    write_file(target, texture.write)
+
+
+def load_texture(filename, srgb=False, minfilter=FT_MIPMAP, magfilter=FT_LINEAR, force=False):
+    '''Loads a texture from the cache, converting it first if needed.
+    If srgb is True the texture uses a sRGB format'''
+    source = find_file(filename)
+    if source is None:
+        raise IOError('Could not find texture: '+filename)
+    compression = COMPRESSION.get_value()
+    key = content_hash(source, bool(srgb), int(minfilter), int(magfilter), compression)
+    target = cache_file(key, '.txo')
+    if force or not os.path.exists(target):
+        build_texture(source, target, srgb, minfilter, magfilter, compression)
+    texture = p3d.TexturePool.load_texture(p3d.Filename.from_os_specific(target))
+    if texture is None:
+        raise IOError('Could not load texture: '+target)
+    return texture
+
+
+def build_texture_array(sources, target, srgb, minfilter, magfilter, compression):
+    '''Converts the source textures (all the same size) into a mipmapped 2D texture array .txo,
+    one layer for each source, in the same order'''
+    image = p3d.PNMImage()
+    texture = p3d.Texture()
+    for layer, source in enumerate(sources):
+        if not image.read(p3d.Filename.from_os_specific(source)):
+            raise IOError('Could not load texture: '+source)
+        if layer == 0:
+            texture.setup_2d_texture_array(image.get_x_size(), image.get_y_size(), len(sources),
+                                           p3d.Texture.T_unsigned_byte,
+                                           p3d.Texture.F_rgba if image.get_num_channels() == 4 else p3d.Texture.F_rgb)
+        elif (image.get_x_size(), image.get_y_size()) != (texture.get_x_size(), texture.get_y_size()):
+            raise ValueError('All the layers of a texture array must be the same size: '+source)
+        image.set_num_channels(texture.get_num_components())
+        texture.load(image, layer, 0)
+    if srgb:
+        texture.set_format(srgb_format(texture))
+    texture.set_minfilter(minfilter)
+    texture.set_magfilter(magfilter)
+    texture.generate_ram_mipmap_images()
+    if compression == 'dxt':
+        texture.compress_ram_image(p3d.Texture.CM_dxt5 if texture.get_num_components() == 4
+                                   else p3d.Texture.CM_dxt1)
+    write_file(target, texture.write)
+
+
+def load_texture_array(filenames, srgb=False, minfilter=FT_MIPMAP, magfilter=FT_LINEAR, force=False):
+    '''Loads a 2D texture array with one layer for each file from the cache,
+    converting it first if needed. If srgb is True the texture uses a sRGB format'''
+    sources = []
+    for filename in filenames:
+        source = find_file(filename)
+        if source is None:
+            raise IOError('Could not find texture: '+filename)
+        sources.append(source)
+    compression = COMPRESSION.get_value()
+    key = hashlib.sha256(repr([content_hash(source, bool(srgb), int(minfilter), int(magfilter), compression)
+                               for source in sources]).encode()).hexdigest()
+    target = cache_file(key, '.txo')
+    if force or not os.path.exists(target):
+        build_texture_array(sources, target, srgb, minfilter, magfilter, compression)
+    texture = p3d.TexturePool.load_texture(p3d.Filename.from_os_specific(target))
+    if texture is None:
+        raise IOError('Could not load texture: '+target)
+    return texture
+
+
+class TextureRegistry:
+    '''Hands out one shared texture for each (file, stage, sRGB, filters)
+    and counts how many users each texture has. Different keys can give the same
+    texture (the TexturePool has one texture for each cached .txo file),
+    so the users are counted for each texture, not for each key.
+    When the last user releases a texture it's dropped from the TexturePool,
+    and removed from the GPU once nothing else (eg. a cached model) uses it'''
+    def __init__(self):
+        # key -> cached .txo file, and .txo file -> [texture, users, keys]
+        self.files = {}
+        self.textures = {}
+
+    def get(self, filename, stage=TS_MODULATE, srgb=False, minfilter=FT_MIPMAP, magfilter=FT_LINEAR):
+        '''Returns the texture (see load_texture()), call release() when it's no longer used'''
+        key = (find_file(filename) or filename, int(stage), bool(srgb), int(minfilter), int(magfilter))
+        if key in self.files:
+            entry = self.textures[self.files[key]]
+        else:
+            texture = load_texture(filename, srgb, minfilter, magfilter)
+            path = texture.get_fullpath().get_fullpath()
+            entry = self.textures.setdefault(path, [texture, 0, set()])
+            entry[2].add(key)
+            self.files[key] = path
+        entry[1] += 1
+        return entry[0]
+
+    def release(self, texture):
+        '''One user less for the texture'''
+        path = texture.get_fullpath().get_fullpath()
+        entry = self.textures.get(path)
+        if entry is None:
+            return
+        entry[1] -= 1
+        if entry[1] <= 0:
+            del self.textures[path]
+            for key in entry[2]:
+                del self.files[key]
+            # don't call release_all(), models loaded from the cache may share the texture,
+            # it's released from the GPU when the last reference is gone
+            p3d.TexturePool.release_texture(texture)
+
+    def __len__(self):
+        return len(self.textures)
+
+
+def model_file(filename, srgb=False, force=False):
+    '''Returns the name of the cached .bam file for a model, converting it
+    (and its textures) first if needed. Use this to load the model some other way,
+    eg. in the background with ShowBase.loader.load_model(..., callback=...).
+    If srgb is True the color textures of the model use a sRGB format'''
+    source = find_file(filename)
+    if source is None:
+        raise IOError('Could not find model: '+filename)
+    key = content_hash(source, bool(srgb), COMPRESSION.get_value())
+    target = cache_file(key, '.bam')
+    deps_file = cache_file(key, '.json')
+    if not force and os.path.exists(target) and deps_changed(deps_file) is False:
+        return target
+
+    loader = p3d.Loader.get_global_ptr()
+    model = p3d.NodePath(loader.load_sync(p3d.Filename.from_os_specific(source)))
+    if model.is_empty():
+        raise IOError('Could not load model: '+source)
+    deps = {}
+    for tex_stage in model.find_all_texture_stages():
+        texture = model.find_texture(tex_stage)
+        if not texture or not texture.get_fullpath():
+            continue
+        path = texture.get_fullpath().to_os_specific()
+        cached = load_texture(path, srgb and tex_stage.get_mode() == TS_MODULATE,
+                              texture.get_minfilter(), texture.get_magfilter(), force)
+        model.replace_texture(texture, cached)
+        deps[path] = content_hash(path)
+    # the .txo files are next to the .bam, so they are found when it's loaded
+    write_file(target, model.write_bam_file)
+    with open(deps_file, 'w') as f:
+        json.dump(deps, f, indent=1)
+    return target
+
+
+def load_model(filename, srgb=False, force=False):
+    '''Loads a model from the cache, converting it (and its textures) first if needed.
+    If srgb is True the color textures of the model use a sRGB format'''
+    target = p3d.Filename.from_os_specific(model_file(filename, srgb, force))
+    model = p3d.NodePath(p3d.Loader.get_global_ptr().load_sync(target))
+    if model.is_empty():
+        raise IOError('Could not load model: '+str(target))
+    return model
+
+
+def deps_changed(deps_file):
+    '''Returns True if any of the textures listed in the deps_file changed,
+    None if there is no deps_file'''
+    try:
+        with open(deps_file) as f:
+            deps = json.load(f)
+    except (OSError, ValueError):
+        return None
+    for path, digest in deps.items():
+        if not os.path.exists(path) or content_hash(path) != digest:
+            return True
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='models and textures to convert (default: all in models/)')
+    parser.add_argument('--force', action='store_true', help='convert all files, even if not changed')
+    parser.add_argument('--srgb', action='store_true', help='only build the sRGB versions')
+    parser.add_argument('--linear', action='store_true', help='only build the linear (non sRGB) versions')
+    args = parser.parse_args()
+
+    p3d.get_model_path().prepend_directory(p3d.Filename.from_os_specific(ROOT))
+    files = args.files
+    if not files:
+        for dirpath, dirnames, filenames in os.walk(os.path.join(ROOT, 'models')):
+            files += sorted(os.path.join(dirpath, name) for name in filenames
+                            if name.endswith(MODEL_EXTENSIONS[:2] + TEXTURE_EXTENSIONS))
+    modes = [mode for mode, skip in ((False, args.srgb), (True, args.linear)) if not skip]
+    start = time.perf_counter()
+    for filename in files:
+        for srgb in modes:
+            if filename.endswith(TEXTURE_EXTENSIONS):
+                load_texture(os.path.abspath(filename), srgb, force=args.force)
+            else:
+                load_model(os.path.abspath(filename), srgb, force=args.force)
+        print(filename)
+    print('{} file(s) in {:.2f}s'.format(len(files), time.perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+'''
+Bakes static objects into a few big geoms, one for each render state
+(texture, material, ...), so a scene with thousands of props takes just a few
+draw calls and the cull traversal has just a few nodes to look at.
+
+The objects are copied (with their transform, color and textures) under one node
+and flattened with flatten_strong(), the originals are stashed, so they can still
+be used as logical objects. Before flattening each vertex is tagged with the index
+of the object it came from, that's used to find out which rows of which geom
+belong to which object, so the objects can be picked or moved after baking:
+
+    batch = batching.bake_static(self.crates, self.render)
+    batch.find_object(geom_np, geom_index, row)  # -> index of a crate
+    batch.transform_object(3, p3d.Mat4.translate_mat(0, 0, 1))  # lift crate 3
+'''
+import panda3d.core as p3d
+import numpy as np
+
+OBJECT_COLUMN = p3d.InternalName.make('object_id')
+
+
+def tag_vertices(model, index):
+    '''Adds a 'object_id' column with the index to all the vertices of the model'''
+    for geom_np in model.find_all_matches('**/+GeomNode'):
+        geom_node = geom_np.node()
+        for i in range(geom_node.get_num_geoms()):
+            geom = geom_node.modify_geom(i)
+            vdata = geom.get_vertex_data()
+            vformat = p3d.GeomVertexFormat(vdata.get_format())
+            vformat.add_array(p3d.GeomVertexArrayFormat(OBJECT_COLUMN, 1, p3d.Geom.NT_uint32,
+                                                        p3d.Geom.C_other))
+            vdata = p3d.GeomVertexData(vdata.convert_to(p3d.GeomVertexFormat.register_format(vformat)))
+            array = vdata.modify_array(vdata.get_num_arrays() - 1)
+            np.frombuffer(memoryview(array), dtype=np.uint32)[:] = index
+            geom.set_vertex_data(vdata)
+
+
+def object_ids(vdata):
+    '''Returns the object_id column of the vertex data as a numpy array'''
+    for i in range(vdata.get_num_arrays()):
+        if vdata.get_format().get_array(i).has_column(OBJECT_COLUMN):
+            array_format = vdata.get_format().get_array(i)
+            column = array_format.get_column(OBJECT_COLUMN)
+            data = np.frombuffer(memoryview(vdata.get_array(i)), dtype=np.uint8)
+            rows = data.reshape(-1, array_format.get_stride())
+            start = column.get_start()
+            return rows[:, start:start+4].copy().view(np.uint32).reshape(-1)
+    return None
+
+
+class StaticBatch:
+    '''The result of bake_static(), root is the node with the merged geometry,
+    ranges[index] is a list of (geom_np, geom_index, start_row, end_row)
+    for each object'''
+    def __init__(self, root, objects):
+        self.root = root
+        self.objects = objects
+        self.ranges = {index: [] for index in range(len(objects))}
+        for geom_np in root.find_all_matches('**/+GeomNode'):
+            geom_node = geom_np.node()
+            for geom_index in range(geom_node.get_num_geoms()):
+                ids = object_ids(geom_node.get_geom(geom_index).get_vertex_data())
+                if ids is None or len(ids) == 0:
+                    continue
+                # the rows of each object are next to each other, find where the id changes
+                starts = np.flatnonzero(np.diff(ids)) + 1
+                starts = np.concatenate(([0], starts))
+                ends = np.concatenate((starts[1:], [len(ids)]))
+                for start, end in zip(starts, ends):
+                    self.ranges[int(ids[start])].append((geom_np, geom_index, int(start), int(end)))
+
+    def find_object(self, geom_np, geom_index, row):
+        '''Returns the index of the object that the vertex row of a geom came from,
+        eg. for a collision ray hit on the batch'''
+        for index, ranges in self.ranges.items():
+            for range_np, range_geom, start, end in ranges:
+                if range_np == geom_np and range_geom == geom_index and start <= row < end:
+                    return index
+        return None
+
+    def transform_object(self, index, mat):
+        '''Transforms the vertices of one object by mat (relative to the batch root)'''
+        for geom_np, geom_index, start, end in self.ranges[index]:
+            geom = geom_np.node().modify_geom(geom_index)
+            geom.modify_vertex_data().transform_vertices(mat, start, end)
+            geom.mark_bounds_stale()
+        self.root.node().mark_bounds_stale()
+
+
+def bake_static(objects, parent, name='static_batch'):
+    '''Copies the objects (NodePaths) under a new node under parent, with their
+    transform and render state relative to parent, merges them with flatten_strong()
+    and stashes the originals. Returns a StaticBatch'''
+    root = parent.attach_new_node(name)
+    for index, obj in enumerate(objects):
+        copy = obj.copy_to(root)
+        copy.set_transform(obj.get_transform(parent))
+        copy.set_state(obj.get_state(parent))
+        tag_vertices(copy, index)
+        obj.stash()
+    # models keep their ModelRoot nodes when flattened, unless told not to
+    root.clear_model_nodes()
+    root.flatten_strong()
+    return StaticBatch(root, objects)
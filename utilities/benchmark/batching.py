@@ -0,0 +1,108 @@
+'''
+Compares a scene of many separate props with the same scene baked
+into a static batch (see utilities/batching.py). No window is opened:
+
+python batching.py [--counts 100 1000 5000] [--frames 100] [--software]
+
+For each count crates (with 2 different textures and random colors) are put in a
+square grid, the camera looks at all of them, and for both ways the number of
+nodes and geoms (draw calls when all are in view), the time to bake the batch
+and the mean cull and draw time per frame are reported.
+Use --software on machines without a GPU (the software renderer spends its
+time filling pixels, not on draw calls, so only the cull times mean much then).
+'''
+import os
+import sys
+import math
+import time
+import argparse
+
+import panda3d.core as p3d
+import numpy as np
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+sys.path.append(ROOT)
+from utilities import assets
+from utilities import batching
+
+
+def make_base(software=False):
+    '''Returns a ShowBase rendering to an offscreen buffer'''
+    if software:
+        p3d.load_prc_file_data('', 'load-display p3tinydisplay')
+    p3d.load_prc_file_data('', 'sync-video 0')
+    p3d.load_prc_file_data('', 'audio-library-name null')
+    from direct.showbase.ShowBase import ShowBase
+    base = ShowBase(windowType='offscreen')
+    base.disable_mouse()
+    p3d.get_model_path().prepend_directory(p3d.Filename.from_os_specific(ROOT))
+    return base
+
+
+def make_props(base, count, spacing=2.0, seed=0):
+    '''Returns count crates in a square grid under a new node'''
+    rng = np.random.default_rng(seed)
+    crate = assets.load_model('models/crate')
+    crate_2 = crate.copy_to(p3d.NodePath('crate_2'))
+    crate_2.set_texture(assets.load_texture('models/texture/crate_2.png'), 1)
+    root = base.render.attach_new_node('props')
+    side = math.ceil(math.sqrt(count))
+    props = []
+    for i in range(count):
+        prop = (crate if i % 2 else crate_2).copy_to(root)
+        prop.set_pos((i % side - (side - 1) * 0.5) * spacing, (i // side - (side - 1) * 0.5) * spacing, 0)
+        prop.set_h(rng.uniform(0.0, 360.0))
+        prop.set_color(*rng.uniform(0.5, 1.0, 3), 1.0)
+        props.append(prop)
+    return root, props, side * spacing
+
+
+def measure(base, root, extent, frames):
+    '''Renders frames looking at all the props, returns (geoms, nodes, cull ms, draw ms)'''
+    base.camera.set_pos(0, -extent, extent)
+    base.camera.look_at(0, 0, 0)
+    base.camLens.set_near_far(1.0, extent * 4.0)
+    cull_times = []
+    draw_times = []
+    def timer(times):
+        def callback(cbdata):
+            start = time.perf_counter()
+            cbdata.upcall()
+            times.append(time.perf_counter() - start)
+        return p3d.PythonCallbackObject(callback)
+    display_region = base.cam.node().get_display_region(0)
+    display_region.set_cull_callback(timer(cull_times))
+    display_region.set_draw_callback(timer(draw_times))
+    for i in range(frames + 2):
+        base.graphics_engine.render_frame()
+    display_region.clear_cull_callback()
+    display_region.clear_draw_callback()
+    analyzer = p3d.SceneGraphAnalyzer()
+    analyzer.add_node(root.node())
+    return (analyzer.get_num_geoms(), analyzer.get_num_nodes(),
+            np.mean(cull_times[2:]) * 1000.0, np.mean(draw_times[2:]) * 1000.0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--counts', type=int, nargs='+', default=[100, 1000, 5000])
+    parser.add_argument('--frames', type=int, default=100)
+    parser.add_argument('--software', action='store_true', help='use the tinydisplay renderer')
+    args = parser.parse_args()
+
+    base = make_base(args.software)
+    row = '{:>8} {:>10} {:>8} {:>8} {:>10} {:>10} {:>10}'
+    print(row.format('count', 'way', 'nodes', 'geoms', 'bake ms', 'cull ms', 'draw ms'))
+    for count in args.counts:
+        root, props, extent = make_props(base, count)
+        geoms, nodes, cull, draw = measure(base, root, extent, args.frames)
+        print(row.format(count, 'separate', nodes, geoms, '-', '{:.3f}'.format(cull), '{:.3f}'.format(draw)))
+        start = time.perf_counter()
+        batch = batching.bake_static(props, base.render)
+        bake_time = (time.perf_counter() - start) * 1000.0
+        geoms, nodes, cull, draw = measure(base, batch.root, extent, args.frames)
+        print(row.format(count, 'baked', nodes, geoms, '{:.1f}'.format(bake_time),
+                         '{:.3f}'.format(cull), '{:.3f}'.format(draw)))
+        root.remove_node()
+        batch.root.remove_node()
@@ -0,0 +1,265 @@
+'''
+Runs the samples without a window and measures how long the frames take.
+
+Usage (run from this directory, or anywhere else):
+python benchmark.py [--frames 300] [--software] [--win-size 1920 1080] [--output results.json]
+                    [--replay camera.log] [--load-timeout 60] [sample.py ...]
+
+Each sample (01_hello_world.py, 02_camera_control.py, ..., advanced/*/main.py
+by default) is started in a new process, in its own directory,
+with a offscreen buffer instead of a window (use --software to use the
+tinydisplay renderer on machines without a GPU, --win-size to set the size of the buffer,
+bigger buffers show the cost of the fragment shaders better). When the sample calls run()
+the first frame is rendered, then for samples that load their models in the background
+(BaseApp.load_progress()) frames are rendered until all the models are loaded (or for up to
+--load-timeout seconds), then the camera is flown along a fixed path around the scene
+for the given number of frames.
+With --replay the camera is not moved by the benchmark, instead the recorded
+input is played back by samples that support it (02_camera_control.py,
+see tutorial_02/input_log.py), the benchmark ends when it's done.
+
+The results are written as JSON, for each sample:
+- startup: seconds from starting Python to the first frame
+- first_frame: seconds it took to render the first frame
+- load: seconds from the first frame until the background loading was done,
+  loaded is False if it was not done in time (the frames are timed anyway)
+- frame/app/cull/draw: mean, median, 95th percentile and max in ms
+  (cull and draw are timed with display region callbacks,
+  app is the rest of the frame - tasks, events, the scene graph update)
+- peak_rss: peak memory use of the process in MB (not on Windows)
+- error: if the sample failed to start or run, the error message
+
+The exit code is 1 if any sample failed.
+'''
+import os
+import sys
+import json
+import glob
+import math
+import time
+import argparse
+import subprocess
+
+START_TIME = time.perf_counter()
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+# where the camera flies for each sample - (center, radius, height), the default
+# fits the room with the crates in the tutorials
+CAMERA_PATHS = {'advanced/environment_maps/main.py': ((0.0, 5.0, 0.0), 20.0, 5.0),
+                'advanced/instancing_on_terrain/main.py': ((0.0, 0.0, 0.0), 180.0, 20.0)}
+DEFAULT_CAMERA_PATH = ((1.0, -1.0, 0.5), 8.0, 4.0)
+
+
+def find_samples():
+    '''Returns the paths (relative to the repo root) of all the samples'''
+    samples = [os.path.basename(path) for path in sorted(glob.glob(os.path.join(ROOT, '[0-9][0-9]_*.py')))
+               if os.path.getsize(path) > 0]
+    samples += [os.path.relpath(path, ROOT).replace(os.sep, '/')
+                for path in sorted(glob.glob(os.path.join(ROOT, 'advanced', '*', 'main.py')))]
+    return samples
+
+
+def camera_path(frames, center, radius, height):
+    '''Yields (pos, look_at) for a camera circling the center, once over all the frames'''
+    for frame in range(frames):
+        angle = 2.0 * math.pi * frame / max(1, frames)
+        yield ((center[0] + math.cos(angle) * radius,
+                center[1] + math.sin(angle) * radius,
+                center[2] + height), center)
+
+
+def peak_rss():
+    '''Returns the peak memory use of this process in MB, or None if not known'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+def stats(times):
+    '''Returns mean, median, 95th percentile and max of times (in seconds) in ms'''
+    if not times:
+        return None
+    times = sorted(t * 1000.0 for t in times)
+    return {'mean': sum(times) / len(times),
+            'median': times[len(times) // 2],
+            'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+            'max': times[-1]}
+
+
+def run_sample(sample, frames, software, output, replay=None, win_size=None, load_timeout=60.0):
+    '''Runs the sample in this process (this is called in the child process),
+    the results are written to the output file'''
+    import runpy
+    script = os.path.join(ROOT, sample)
+    sample_dir = os.path.dirname(script)
+    os.chdir(sample_dir)
+    # make it look like the sample was started on its own
+    sys.argv = [script]
+    sys.path[0] = sample_dir
+    center, radius, height = CAMERA_PATHS.get(sample, DEFAULT_CAMERA_PATH)
+
+    import panda3d.core as p3d
+    # the model path was set up for this script, not the sample
+    p3d.get_model_path().prepend_directory(p3d.Filename.from_os_specific(sample_dir))
+    p3d.load_prc_file_data('', 'window-type offscreen')
+    p3d.load_prc_file_data('', 'audio-library-name null')
+    if software:
+        p3d.load_prc_file_data('', 'load-display p3tinydisplay')
+    if replay:
+        p3d.load_prc_file_data('', 'input-replay '+replay)
+    from direct.showbase.ShowBase import ShowBase
+
+    result = {'sample': sample, 'frames': frames}
+    def benchmark_run(base, *args, **kwargs):
+        '''Replaces ShowBase.run(), renders the frames and exits'''
+        result['startup'] = time.perf_counter() - START_TIME
+        # the samples may sync to the monitor or drive the camera with the mouse
+        p3d.ClockObject.get_global_clock().set_mode(p3d.ClockObject.M_normal)
+        base.disable_mouse()
+        # there is no mouse without a window, but the samples may ask for it
+        if base.mouseWatcherNode is None:
+            base.mouseWatcherNode = p3d.MouseWatcher('no_mouse')
+        cull_times = []
+        draw_times = []
+        def timer(times):
+            def callback(cbdata):
+                start = time.perf_counter()
+                cbdata.upcall()
+                times[-1] += time.perf_counter() - start
+            return p3d.PythonCallbackObject(callback)
+        for display_region in base.win.get_active_display_regions():
+            display_region.set_cull_callback(timer(cull_times))
+            display_region.set_draw_callback(timer(draw_times))
+        def wait_for_load():
+            '''Renders frames until the sample has loaded all its models'''
+            start = time.perf_counter()
+            load_progress = getattr(base, 'load_progress', None)
+            while load_progress is not None and load_progress() < 1.0:
+                if time.perf_counter() - start > load_timeout:
+                    break
+                base.taskMgr.step()
+            result['load'] = time.perf_counter() - start
+            result['loaded'] = load_progress is None or load_progress() == 1.0
+        frame_times = []
+        for i, (pos, look_at) in enumerate(camera_path(frames + 1, center, radius, height)):
+            cull_times.append(0.0)
+            draw_times.append(0.0)
+            start = time.perf_counter()
+            if not replay:
+                base.camera.set_pos(base.render, pos)
+                base.camera.look_at(base.render, look_at)
+            try:
+                base.taskMgr.step()
+                if i == 0:
+                    frame_times.append(time.perf_counter() - start)
+                    wait_for_load()
+                    continue
+            except SystemExit:
+                # the sample exits when the replay is done, keep what was measured up to then
+                cull_times.pop()
+                draw_times.pop()
+                break
+            frame_times.append(time.perf_counter() - start)
+        if frame_times:
+            # the first frame (and the frames while loading) are not in the stats
+            result['first_frame'] = frame_times.pop(0)
+            del cull_times[:len(cull_times) - len(frame_times)]
+            del draw_times[:len(draw_times) - len(frame_times)]
+        app_times = [frame - cull - draw for frame, cull, draw in zip(frame_times, cull_times, draw_times)]
+        result.update(frames=len(frame_times), frame=stats(frame_times), app=stats(app_times),
+                      cull=stats(cull_times), draw=stats(draw_times))
+        raise SystemExit(0)
+    if win_size:
+        # the samples set their own win-size when they start, this has to come after that
+        show_base_init = ShowBase.__init__
+        def init_with_size(base, *args, **kwargs):
+            p3d.load_prc_file_data('', 'win-size {} {}'.format(*win_size))
+            show_base_init(base, *args, **kwargs)
+        ShowBase.__init__ = init_with_size
+    if replay:
+        # the replay decides when it's done
+        frames = sys.maxsize - 1
+    ShowBase.run = benchmark_run
+    try:
+        runpy.run_path(script, run_name='__main__')
+        result['error'] = 'the sample did not call run()'
+    except SystemExit as error:
+        if error.code not in (None, 0):
+            result['error'] = 'exit code {}'.format(error.code)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+    result['peak_rss'] = peak_rss()
+    with open(output, 'w') as f:
+        json.dump(result, f)
+    # don't wait for Panda3D to clean up
+    os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('samples', nargs='*', help='samples to run, relative to the repo root (default: all)')
+    parser.add_argument('--frames', type=int, default=300, help='number of frames to render')
+    parser.add_argument('--software', action='store_true', help='use the tinydisplay renderer (no GPU)')
+    parser.add_argument('--output', default='benchmark.json', help='where to write the results')
+    parser.add_argument('--timeout', type=float, default=600.0, help='seconds to wait for each sample')
+    parser.add_argument('--win-size', type=int, nargs=2, metavar=('WIDTH', 'HEIGHT'),
+                        help='size of the offscreen buffer (default: what the sample asks for)')
+    parser.add_argument('--replay', help='play back this input log instead of flying the camera')
+    parser.add_argument('--load-timeout', type=float, default=60.0,
+                        help='seconds to wait for the models loaded in the background')
+    parser.add_argument('--run-sample', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_sample:
+        run_sample(args.run_sample, args.frames, args.software, args.output, args.replay, args.win_size,
+                   args.load_timeout)
+        return
+
+    results = []
+    for sample in args.samples or find_samples():
+        sample_output = os.path.abspath(args.output + '.part')
+        command = [sys.executable, os.path.abspath(__file__), '--run-sample', sample,
+                   '--frames', str(args.frames), '--output', sample_output,
+                   '--load-timeout', str(args.load_timeout)]
+        if args.software:
+            command.append('--software')
+        if args.replay:
+            command += ['--replay', os.path.abspath(args.replay)]
+        if args.win_size:
+            command += ['--win-size'] + [str(size) for size in args.win_size]
+        try:
+            if os.path.exists(sample_output):
+                os.remove(sample_output)
+            subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                           timeout=args.timeout)
+            with open(sample_output) as f:
+                result = json.load(f)
+            os.remove(sample_output)
+        except subprocess.TimeoutExpired:
+            result = {'sample': sample, 'error': 'timeout'}
+        except (OSError, ValueError):
+            result = {'sample': sample, 'error': 'the sample crashed'}
+        results.append(result)
+        if 'error' in result:
+            print('{}: FAILED - {}'.format(sample, result['error']))
+        else:
+            print('{}: startup {:.2f}s, load {:.2f}s{}, frame {:.2f}ms (app {:.2f}, cull {:.2f}, draw {:.2f}), '
+                  'peak {}MB'.format(
+                  sample, result['startup'], result['load'], '' if result['loaded'] else ' (not done)',
+                  result['frame']['mean'], result['app']['mean'],
+                  result['cull']['mean'], result['draw']['mean'],
+                  '?' if result['peak_rss'] is None else '{:.0f}'.format(result['peak_rss'])))
+    with open(args.output, 'w') as f:
+        json.dump({'frames': args.frames, 'software': args.software, 'win_size': args.win_size,
+                   'results': results}, f, indent=1)
+    if any('error' in result for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
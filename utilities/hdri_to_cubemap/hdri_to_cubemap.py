@@ -1,45 +1,194 @@
+'''
+Converts equirectangular environment maps (hdri/*.png) into cube maps (cubemap/*.txo)
+with a fuzzy blur on the lower mipmaps, as used by advanced/environment_maps.
+
+Usage (run from this directory):
+python hdri_to_cubemap.py [--jobs N] [--force] [--headless] [hdri/some_map.png ...]
+
+The files are spread across a pool of processes, each with its own offscreen buffer.
+Files that did not change since the last run are skipped - the hash of each source
+is kept in cubemap/manifest.json, it's updated after each file,
+so an interrupted run will just pick up where it stopped.
+Use --headless on machines without a display (needs a EGL driver, Mesa llvmpipe will do).
+
+Each mipmap level is rendered to a cube map buffer, copied from ram straight into
+the matching mipmap of the output texture, and the whole thing is written once.
+Use --debug-png to also get all the faces of all the levels as png files in temp/
+
+Use --cpu to skip the GPU, window and the fuzzy blur shader altogether, the maps
+are then GGX prefiltered on the cpu (see prefilter.py), --sh also writes
+the irradiance spherical harmonics next to each cube map.
+'''
 import os
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
 from panda3d.core import *
-loadPrcFileData("", "framebuffer-multisample 1")
-loadPrcFileData("", "multisamples 8")
-from direct.showbase import ShowBase
-
-base=ShowBase.ShowBase()
-render.setAntialias(AntialiasAttrib.MMultisample)
-
-sky_box=loader.load_model('box')
-sky_box.reparent_to(render)
-sky_box.set_scale(10)
-sky_box.set_shader(Shader.load(Shader.SLGLSL, 'shaders/skybox_v.glsl', 'shaders/skybox_f.glsl'), 1)
-sky_box.set_shader_input('noise_tex', loader.load_texture('blue_noise.png', minfilter = SamplerState.FT_nearest, magfilter = SamplerState.FT_nearest))
-sky_box.set_bin('background', 100)
-sky_box.set_depth_test(False)
-sky_box.set_depth_write(False)
-
-for filename in os.listdir('hdri'):
-    source = filename[:-4]
-    print(source)
-    sky_map=loader.load_texture('hdri/'+source+'.png')
+
+# change this if the conversion changes, so old cube maps get rebuilt
+VERSION = 2
+MANIFEST = 'cubemap/manifest.json'
+
+# each worker process has its own ShowBase and skybox
+base = None
+sky_box = None
+write_debug_png = False
+
+def init_worker(headless=False, debug_png=False):
+    '''Sets up a ShowBase with an offscreen buffer and the skybox used for rendering'''
+    global base, sky_box, write_debug_png
+    write_debug_png = debug_png
+    loadPrcFileData("", "framebuffer-multisample 1")
+    loadPrcFileData("", "multisamples 8")
+    if headless:
+        loadPrcFileData("", "load-display p3headlessgl")
+    from direct.showbase import ShowBase
+
+    base=ShowBase.ShowBase(windowType='offscreen')
+    base.render.setAntialias(AntialiasAttrib.MMultisample)
+
+    sky_box=base.loader.load_model('box')
+    sky_box.reparent_to(base.render)
+    sky_box.set_scale(10)
+    sky_box.set_shader(Shader.load(Shader.SLGLSL, 'shaders/skybox_v.glsl', 'shaders/skybox_f.glsl'), 1)
+    sky_box.set_shader_input('noise_tex', base.loader.load_texture('blue_noise.png', minfilter = SamplerState.FT_nearest, magfilter = SamplerState.FT_nearest))
+    sky_box.set_bin('background', 100)
+    sky_box.set_depth_test(False)
+    sky_box.set_depth_write(False)
+
+def render_cube_map(size):
+    '''Renders the skybox into a offscreen cube map (like ShowBase.saveCubeMap() does),
+    returns a Texture with the 6 faces in ram'''
+    rig=NodePath('cube_rig')
+    buffer=base.win.make_cube_map('cube_map', size, rig, PandaNode.get_all_camera_mask(), True)
+    lens=rig.find('**/+Camera').node().get_lens()
+    lens.set_near_far(base.camLens.get_near(), base.camLens.get_far())
+    rig.reparent_to(base.camera)
+    base.graphicsEngine.openWindows()
+    base.graphicsEngine.renderFrame()
+    base.graphicsEngine.renderFrame()
+    base.graphicsEngine.syncFrame()
+    faces=buffer.get_texture()
+    base.graphicsEngine.removeWindow(buffer)
+    rig.remove_node()
+    return faces
+
+def convert(source_file):
+    '''Renders one equirectangular map into a cube map,
+    returns the name of the source file and how long it took'''
+    start = time.perf_counter()
+    source = os.path.splitext(os.path.basename(source_file))[0]
+    sky_map=base.loader.load_texture(source_file)
     sky_map.set_magfilter(SamplerState.FT_linear_mipmap_linear)
     sky_map.set_minfilter(SamplerState.FT_linear_mipmap_linear)
     sky_box.set_shader_input('sky_map', sky_map)
     sky_box.set_shader_input('sky_lod', 0.0)
     sky_box.set_shader_input('value', 0.0)
 
+    # all mipmap levels go straight into one cube map in ram
+    cubemap=Texture(source)
+    cubemap.setup_cube_map(1024, Texture.T_unsigned_byte, Texture.F_rgb)
+    cubemap.set_minfilter(SamplerState.FT_linear_mipmap_linear)
+    cubemap.set_magfilter(SamplerState.FT_linear_mipmap_linear)
     lod=0
     resolution =  1024
     while resolution >= 1:
-        base.saveCubeMap('temp/'+source+'_'+str(lod)+'_#.png', size = resolution)
+        faces=render_cube_map(resolution)
+        if write_debug_png:
+            faces.write(Filename('temp/'+source+'_'+str(lod)+'_#.png'), 0, 0, True, False)
+        # 'BGR' is the order Panda3D keeps F_rgb textures in ram
+        if lod == 0:
+            cubemap.set_ram_image(faces.get_ram_image_as('BGR'))
+        else:
+            cubemap.set_ram_mipmap_image(lod, faces.get_ram_image_as('BGR'))
         resolution=resolution//2
         lod+=1
         sky_box.set_shader_input('sky_lod', float(lod*1.5))
         sky_box.set_shader_input('value', lod*0.04)
-        base.graphicsEngine.renderFrame()
-        base.graphicsEngine.renderFrame()
-        base.graphicsEngine.renderFrame()
 
-    cubemap=loader.loadCubeMap('temp/'+source+'_#_#.png', readMipmaps = True, minfilter = SamplerState.FT_linear_mipmap_linear, magfilter = SamplerState.FT_linear_mipmap_linear)
+    # the driver compresses it on load (compress_ram_image() crashes on cube maps)
     cubemap.set_compression(Texture.CM_dxt1)
-    cubemap.write('cubemap/'+source+'.txo')
+    cubemap.write(output_name(source_file))
+    # don't keep old maps in the texture pool, a worker may convert a lot of them
+    TexturePool.release_texture(sky_map)
+    return source_file, time.perf_counter() - start
+
+def output_name(source_file):
+    '''Returns the name of the cube map made from the source_file'''
+    return 'cubemap/'+os.path.splitext(os.path.basename(source_file))[0]+'.txo'
+
+def source_hash(source_file, mode=''):
+    '''Returns a hash of the source_file content, the conversion version and mode'''
+    digest = hashlib.sha256((str(VERSION)+mode).encode())
+    with open(source_file, 'rb') as f:
+        for block in iter(lambda: f.read(1<<20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_manifest():
+    try:
+        with open(MANIFEST) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_manifest(manifest):
+    with open(MANIFEST+'.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(MANIFEST+'.tmp', MANIFEST)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='files to convert (default: all in hdri/)')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='number of processes')
+    parser.add_argument('--force', action='store_true', help='convert all files, even if not changed')
+    parser.add_argument('--headless', action='store_true', help='render without a display (EGL)')
+    parser.add_argument('--debug-png', action='store_true', help='also write each face of each mipmap to temp/')
+    parser.add_argument('--cpu', action='store_true', help='GGX prefilter on the cpu, no GPU needed (see prefilter.py)')
+    parser.add_argument('--sh', action='store_true', help='with --cpu, also write irradiance spherical harmonics')
+    args = parser.parse_args()
+
+    sources = args.files or sorted('hdri/'+filename for filename in os.listdir('hdri') if filename.endswith(('.png', '.hdr', '.pfm')))
+    manifest = load_manifest()
+    mode = ('cpu_sh' if args.sh else 'cpu') if args.cpu else ''
+    hashes = {source:source_hash(source, mode) for source in sources}
+    todo = []
+    for source in sources:
+        if args.force or manifest.get(source) != hashes[source] or not os.path.exists(output_name(source)):
+            todo.append(source)
+        else:
+            print(source, 'not changed, skipping')
+    if not todo:
+        return
+
+    total_start = time.perf_counter()
+    jobs = max(1, min(args.jobs, len(todo)))
+    if args.cpu:
+        # prefilter.py uses all the processes for one file at a time
+        import prefilter
+        jobs = args.jobs
+        def prefilter_job(source):
+            start = time.perf_counter()
+            prefilter.prefilter_file(source, output_name(source), sh=args.sh, jobs=jobs)
+            return source, time.perf_counter() - start
+        results = map(prefilter_job, todo)
+    elif jobs == 1:
+        init_worker(args.headless, args.debug_png)
+        results = map(convert, todo)
+    else:
+        # Panda3D should not be forked, each worker gets a fresh process
+        pool = multiprocessing.get_context('spawn').Pool(jobs, init_worker, (args.headless, args.debug_png))
+        results = pool.imap_unordered(convert, todo)
+    for source, seconds in results:
+        manifest[source] = hashes[source]
+        save_manifest(manifest)
+        print('{} -> {} {:.2f}s'.format(source, output_name(source), seconds))
+    if jobs > 1 and not args.cpu:
+        pool.close()
+        pool.join()
+    print('{} file(s) in {:.2f}s using {} process(es)'.format(len(todo), time.perf_counter() - total_start, jobs))
 
-#base.run()
+if __name__ == '__main__':
+    main()
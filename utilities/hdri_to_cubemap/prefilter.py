@@ -0,0 +1,275 @@
+'''
+CPU (NumPy) environment map prefilter, no GPU or window needed.
+
+Takes a equirectangular map (png, hdr, pfm, ...) and makes a cube map where
+each mipmap level is the map convolved with the GGX distribution
+(importance sampled) for a roughness of level/(number_of_levels-1).
+That's what advanced/environment_maps/shaders/ibl_f.glsl expects
+(it uses roughness*10.0 as the lod of a 1024x1024 cube map with 11 levels).
+Optionally also writes the diffuse irradiance as 9 spherical harmonics
+coefficients (L2, in a 9x1 float texture, rgb for each coefficient).
+
+The work is split by mipmap level and cube face across a pool of processes.
+
+Usage (run from this directory):
+python prefilter.py hdri/some_map.hdr cubemap/some_map.txo [--size 1024] [--samples 64] [--sh]
+or use 'python hdri_to_cubemap.py --cpu' to convert all the maps in hdri/
+'''
+import panda3d.core as p3d
+import numpy as np
+
+import os
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+COMPONENT_TYPES = {p3d.Texture.T_unsigned_byte: np.uint8,
+                   p3d.Texture.T_unsigned_short: np.uint16,
+                   p3d.Texture.T_float: np.float32}
+
+# the source mipmaps, loaded once in each worker process
+pyramid = None
+
+
+def srgb_to_linear(color):
+    return np.where(color <= 0.04045, color / 12.92, ((color + 0.055) / 1.055) ** 2.4)
+
+
+def linear_to_srgb(color):
+    color = np.clip(color, 0.0, 1.0)
+    return np.where(color <= 0.0031308, color * 12.92, 1.055 * color ** (1.0 / 2.4) - 0.055)
+
+
+def load_equirect(filename):
+    '''Returns the image as a linear, float32 array with the shape (y_size, x_size, 3),
+    rows are bottom to top - same as texture UVs.
+    8 and 16 bit images are assumed to be sRGB, float images linear'''
+    texture = p3d.Texture()
+    texture.set_auto_texture_scale(p3d.ATS_none)
+    if not texture.read(filename):
+        raise IOError('Could not read '+filename)
+    dtype = COMPONENT_TYPES[texture.get_component_type()]
+    data = np.frombuffer(texture.get_ram_image_as('RGB'), dtype=dtype)
+    data = data.reshape(texture.get_y_size(), texture.get_x_size(), 3)
+    if dtype == np.float32:
+        return data.astype(np.float32)
+    return srgb_to_linear(data.astype(np.float32) / np.iinfo(dtype).max).astype(np.float32)
+
+
+def build_pyramid(image):
+    '''Returns a list of mipmaps for the image (2x2 box filter), level 0 is the image'''
+    levels = [image]
+    while min(image.shape[:2]) > 1:
+        y_size, x_size = image.shape[0] // 2, image.shape[1] // 2
+        image = image[:y_size*2, :x_size*2].reshape(y_size, 2, x_size, 2, 3).mean(axis=(1, 3))
+        levels.append(image)
+    return levels
+
+
+def face_directions(face, size):
+    '''Returns the (normalized) direction for each texel of a cube map face,
+    as an array with the shape (size, size, 3), rows are bottom to top.
+    The faces follow the OpenGL cube map layout (+x, -x, +y, -y, +z, -z),
+    the directions are the same that a shader uses to sample the cube map'''
+    coords = (np.arange(size, dtype=np.float32) + 0.5) / size * 2.0 - 1.0
+    t, s = np.meshgrid(coords, coords, indexing='ij')
+    one = np.ones_like(s)
+    x, y, z = ((one, -t, -s),
+               (-one, -t, s),
+               (s, one, t),
+               (s, -one, -t),
+               (s, -t, one),
+               (-s, -t, -one))[face]
+    directions = np.stack((x, y, z), axis=-1)
+    return directions / np.linalg.norm(directions, axis=-1, keepdims=True)
+
+
+def sample_level(image, directions):
+    '''Bilinear lookup of a equirectangular image in the given directions,
+    uses the same mapping as shaders/skybox_f.glsl (z is up)'''
+    y_size, x_size = image.shape[:2]
+    u = np.arctan2(directions[..., 1], directions[..., 0]) / (2.0 * np.pi) + 0.5
+    v = np.arcsin(np.clip(directions[..., 2], -1.0, 1.0)) / np.pi + 0.5
+    x = u * x_size - 0.5
+    y = v * y_size - 0.5
+    x0 = np.floor(x)
+    y0 = np.floor(y)
+    fx = (x - x0)[..., None]
+    fy = (y - y0)[..., None]
+    # wrap around horizontally, clamp vertically
+    x0 = x0.astype(np.intp) % x_size
+    x1 = (x0 + 1) % x_size
+    y1 = np.clip(y0 + 1, 0, y_size - 1).astype(np.intp)
+    y0 = np.clip(y0, 0, y_size - 1).astype(np.intp)
+    top = image[y1, x0] * (1.0 - fx) + image[y1, x1] * fx
+    bottom = image[y0, x0] * (1.0 - fx) + image[y0, x1] * fx
+    return bottom * (1.0 - fy) + top * fy
+
+
+def sample(pyramid, directions, lod):
+    '''Trilinear lookup of the pyramid (from build_pyramid()) at a (scalar) lod'''
+    lod = min(max(lod, 0.0), len(pyramid) - 1.0)
+    level = int(lod)
+    blend = lod - level
+    color = sample_level(pyramid[level], directions)
+    if blend > 0.0 and level + 1 < len(pyramid):
+        color = color * (1.0 - blend) + sample_level(pyramid[level + 1], directions) * blend
+    return color
+
+
+def hammersley(count):
+    '''Returns count points of the Hammersley sequence, shape (count, 2)'''
+    i = np.arange(count, dtype=np.uint32)
+    bits = i.copy()
+    bits = ((bits << 16) | (bits >> 16)) & 0xFFFFFFFF
+    bits = ((bits & 0x55555555) << 1) | ((bits & 0xAAAAAAAA) >> 1)
+    bits = ((bits & 0x33333333) << 2) | ((bits & 0xCCCCCCCC) >> 2)
+    bits = ((bits & 0x0F0F0F0F) << 4) | ((bits & 0xF0F0F0F0) >> 4)
+    bits = ((bits & 0x00FF00FF) << 8) | ((bits & 0xFF00FF00) >> 8)
+    return np.stack((i / count, bits.astype(np.float64) / 2.0**32), axis=-1)
+
+
+def prefilter_face(pyramid, face, size, roughness, samples=64):
+    '''Returns one face (shape (size, size, 3)) of the GGX prefiltered cube map
+    for the given roughness. Like in the split sum approximation N=V=R is assumed'''
+    normals = face_directions(face, size)
+    # the lod of the source that matches the size of one output texel,
+    # without it small roughness levels would alias
+    texel_angle = 4.0 * np.pi / (6.0 * size * size)
+    source_angle = 4.0 * np.pi / (pyramid[0].shape[0] * pyramid[0].shape[1])
+    min_lod = max(0.0, 0.5 * np.log2(texel_angle / source_angle))
+    if roughness <= 0.0:
+        return sample(pyramid, normals, min_lod).astype(np.float32)
+    alpha = roughness * roughness
+    # a tangent space for each normal
+    up = np.zeros_like(normals)
+    up[..., 2] = 1.0
+    up[np.abs(normals[..., 2]) > 0.999] = (1.0, 0.0, 0.0)
+    tangent = np.cross(up, normals)
+    tangent /= np.linalg.norm(tangent, axis=-1, keepdims=True)
+    bitangent = np.cross(normals, tangent)
+
+    color = np.zeros(normals.shape, dtype=np.float64)
+    total_weight = np.zeros(normals.shape[:-1] + (1,), dtype=np.float64)
+    for xi_1, xi_2 in hammersley(samples):
+        # GGX importance sampling of the half vector, in tangent space
+        # it's the same for all the texels, so is the lod
+        phi = 2.0 * np.pi * xi_1
+        cos_theta = np.sqrt((1.0 - xi_2) / (1.0 + (alpha * alpha - 1.0) * xi_2))
+        sin_theta = np.sqrt(1.0 - cos_theta * cos_theta)
+        half = (tangent * (sin_theta * np.cos(phi))
+                + bitangent * (sin_theta * np.sin(phi))
+                + normals * cos_theta)
+        n_dot_h = cos_theta
+        light = 2.0 * np.sum(normals * half, axis=-1, keepdims=True) * half - normals
+        n_dot_l = np.sum(normals * light, axis=-1, keepdims=True)
+        weight = np.maximum(n_dot_l, 0.0)
+        # pick a lod based on the pdf of the sample, less noise for the same number of samples
+        # pdf = D * n_dot_h / (4 * v_dot_h), and with N=V n_dot_h == v_dot_h
+        d = alpha * alpha / (np.pi * (n_dot_h * n_dot_h * (alpha * alpha - 1.0) + 1.0) ** 2)
+        sample_angle = 4.0 / (samples * d + 1e-4)
+        lod = max(min_lod, 0.5 * np.log2(sample_angle / source_angle) + 1.0)
+        color += sample(pyramid, light, lod) * weight
+        total_weight += weight
+    return (color / np.maximum(total_weight, 1e-6)).astype(np.float32)
+
+
+def irradiance_sh(image):
+    '''Returns the diffuse irradiance of the equirectangular image as
+    9 spherical harmonics coefficients (shape (9, 3)).
+    To get the irradiance in the direction n (z is up) evaluate:
+    c[0]*0.282095
+    + c[1]*0.488603*n.y + c[2]*0.488603*n.z + c[3]*0.488603*n.x
+    + c[4]*1.092548*n.x*n.y + c[5]*1.092548*n.y*n.z + c[6]*0.315392*(3.0*n.z*n.z-1.0)
+    + c[7]*1.092548*n.x*n.z + c[8]*0.546274*(n.x*n.x-n.y*n.y)
+    and divide by pi for the diffuse light'''
+    y_size, x_size = image.shape[:2]
+    u = (np.arange(x_size) + 0.5) / x_size
+    v = (np.arange(y_size) + 0.5) / y_size
+    phi = (u - 0.5) * 2.0 * np.pi
+    theta = (v - 0.5) * np.pi
+    phi, theta = np.meshgrid(phi, theta)
+    x = np.cos(theta) * np.cos(phi)
+    y = np.cos(theta) * np.sin(phi)
+    z = np.sin(theta)
+    solid_angle = (2.0 * np.pi / x_size) * (np.pi / y_size) * np.cos(theta)
+    basis = np.stack((np.full_like(x, 0.282095),
+                      0.488603 * y, 0.488603 * z, 0.488603 * x,
+                      1.092548 * x * y, 1.092548 * y * z, 0.315392 * (3.0 * z * z - 1.0),
+                      1.092548 * x * z, 0.546274 * (x * x - y * y)))
+    radiance = np.einsum('kyx,yxc,yx->kc', basis, image, solid_angle)
+    # convolve with the cosine lobe
+    band = np.array([np.pi] + [2.0 * np.pi / 3.0] * 3 + [np.pi / 4.0] * 5)
+    return (radiance * band[:, None]).astype(np.float32)
+
+
+def init_worker(source_file):
+    global pyramid
+    pyramid = build_pyramid(load_equirect(source_file))
+
+
+def face_job(job):
+    level, face, size, roughness, samples = job
+    return level, face, prefilter_face(pyramid, face, size, roughness, samples)
+
+
+def prefilter_file(source_file, output_file, size=1024, samples=64, sh=False, jobs=None):
+    '''Writes a GGX prefiltered cube map (uint8 sRGB, all mipmap levels, dxt1 compression hint)
+    made from the source_file to output_file, if sh is True, the irradiance
+    spherical harmonics are also written to output_file with '_sh' added to the name'''
+    num_levels = int(np.log2(size)) + 1
+    job_list = [(level, face, max(1, size >> level), level / (num_levels - 1), samples)
+                for level in range(num_levels) for face in range(6)]
+    # the biggest jobs first, so the pool stays busy
+    job_list.sort(key=lambda job: -job[2] * job[2] * (job[4] if job[3] > 0.0 else 1))
+    faces = {}
+    # Panda3D should not be forked, each worker gets a fresh process (like in hdri_to_cubemap.py)
+    with ProcessPoolExecutor(jobs, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_worker, initargs=(source_file,)) as pool:
+        for level, face, color in pool.map(face_job, job_list):
+            faces[level, face] = color
+
+    cubemap = p3d.Texture(os.path.basename(output_file))
+    cubemap.setup_cube_map(size, p3d.Texture.T_unsigned_byte, p3d.Texture.F_rgb)
+    cubemap.set_minfilter(p3d.SamplerState.FT_linear_mipmap_linear)
+    cubemap.set_magfilter(p3d.SamplerState.FT_linear_mipmap_linear)
+    for level in range(num_levels):
+        color = np.stack([faces[level, face] for face in range(6)])
+        color = np.round(linear_to_srgb(color) * 255.0).astype(np.uint8)
+        # Panda3D keeps rgb textures as bgr in ram
+        image = p3d.CPTA_uchar(np.ascontiguousarray(color[..., ::-1]).tobytes())
+        if level == 0:
+            cubemap.set_ram_image(image)
+        else:
+            cubemap.set_ram_mipmap_image(level, image)
+    # the driver compresses it on load (compress_ram_image() crashes on cube maps)
+    cubemap.set_compression(p3d.Texture.CM_dxt1)
+    cubemap.write(output_file)
+
+    if sh:
+        image = load_equirect(source_file)
+        # a small version of the image is more then enough for the SH
+        image = next(level for level in build_pyramid(image) if level.shape[1] <= 256)
+        coefficients = irradiance_sh(image)
+        sh_tex = p3d.Texture(os.path.basename(output_file)+'_sh')
+        sh_tex.setup_2d_texture(9, 1, p3d.Texture.T_float, p3d.Texture.F_rgb32)
+        sh_tex.set_minfilter(p3d.SamplerState.FT_nearest)
+        sh_tex.set_magfilter(p3d.SamplerState.FT_nearest)
+        sh_tex.set_ram_image(np.ascontiguousarray(coefficients[:, ::-1]).tobytes())
+        root, ext = os.path.splitext(output_file)
+        sh_tex.write(root+'_sh'+ext)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('source', help='equirectangular map')
+    parser.add_argument('output', help='cube map to write (.txo)')
+    parser.add_argument('--size', type=int, default=1024, help='size of the cube map (power of 2)')
+    parser.add_argument('--samples', type=int, default=64, help='GGX samples for each texel')
+    parser.add_argument('--sh', action='store_true', help='also write irradiance spherical harmonics')
+    parser.add_argument('--jobs', type=int, default=None, help='number of processes')
+    args = parser.parse_args()
+    start = time.perf_counter()
+    prefilter_file(args.source, args.output, args.size, args.samples, args.sh, args.jobs)
+    print('{} -> {} {:.2f}s'.format(args.source, args.output, time.perf_counter() - start))
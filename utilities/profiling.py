@@ -0,0 +1,101 @@
+'''
+Named PStats collectors for the parts of the samples worth measuring.
+
+Use it like this:
+
+    from utilities import profiling
+
+    @profiling.timed('App:update')
+    def update(self, task):
+        ...
+
+    with profiling.timer('Startup:load textures'):
+        ...
+
+The times show up in PStats (run pstats, then the sample with 'want-pstats 1').
+When there's no PStats server (eg. on a machine without a display)
+call profiling.enable() after ShowBase is set up, and set 'profiling-csv'
+in a prc file (or with load_prc_file_data()) to the name of a csv file.
+Then the times are kept in a ring buffer (the last 'profiling-buffer-size'
+records, 100000 by default) and written to that file when the program exits,
+or whenever dump_csv() is called.
+'''
+import panda3d.core as p3d
+
+import atexit
+import collections
+import csv
+import functools
+import time
+
+PROFILING_CSV = p3d.ConfigVariableString('profiling-csv', '',
+                                         'Write profiling times to this file if PStats is not running')
+BUFFER_SIZE = p3d.ConfigVariableInt('profiling-buffer-size', 100000,
+                                    'How many profiling times to keep for the csv file')
+
+_collectors = {}
+# (frame, name, start, duration) of the last timings, None if not recording
+_records = None
+
+
+def collector(name):
+    '''Returns the PStatCollector with the name, names like 'App:update'
+    make a 'update' collector under 'App' '''
+    if name not in _collectors:
+        _collectors[name] = p3d.PStatCollector(name)
+    return _collectors[name]
+
+
+def enable(csv_file=None):
+    '''Starts recording to the ring buffer if PStats is not connected,
+    the records are written to csv_file (or the one set in 'profiling-csv') at exit.
+    Returns True if recording to the ring buffer'''
+    global _records
+    csv_file = csv_file or PROFILING_CSV.get_value()
+    if p3d.PStatClient.is_connected() or not csv_file:
+        return False
+    if _records is None:
+        _records = collections.deque(maxlen=BUFFER_SIZE.get_value())
+        atexit.register(dump_csv, csv_file)
+    return True
+
+
+def dump_csv(filename):
+    '''Writes the recorded times to a csv file (frame, name, start, duration in ms)'''
+    if _records is None:
+        return
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['frame', 'name', 'start', 'ms'])
+        for frame, name, start, duration in list(_records):
+            writer.writerow([frame, name, '{:.6f}'.format(start), '{:.4f}'.format(duration * 1000.0)])
+
+
+class timer:
+    '''Context manager that times a block of code, see the module docs'''
+    def __init__(self, name):
+        self.name = name
+        self.collector = collector(name)
+
+    def __enter__(self):
+        self.collector.start()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.collector.stop()
+        if _records is not None:
+            _records.append((p3d.ClockObject.get_global_clock().get_frame_count(),
+                             self.name, self.start, time.perf_counter() - self.start))
+        return False
+
+
+def timed(name):
+    '''Decorator that times each call of a function (or method), see the module docs'''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,62 @@
+'''
+A skybox shared by the samples.
+
+The box follows the camera with a CompassEffect - it takes the position of the camera
+(but not the rotation), and Panda3D applies that in the cull traversal,
+so there's no task moving the box around in Python every frame.
+
+The shader and the render state (background bin, no depth test or write)
+are made once, the first time they are needed, and shared by all the skyboxes.
+The shaders are in utilities/shaders, the box is models/box.egg.
+
+The skybox samples the cube map from the 'env_map' shader input, it can be set
+on the skybox or on any node above it (eg. on render, if the same map is used for reflections).
+'''
+import panda3d.core as p3d
+
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SHADER_DIR = os.path.join(ROOT, 'utilities', 'shaders')
+BOX_MODEL = os.path.join(ROOT, 'models', 'box.egg')
+
+_state = None
+
+
+def skybox_state():
+    '''Returns the RenderState used by all the skyboxes'''
+    global _state
+    if _state is None:
+        shader = p3d.Shader.load(p3d.Shader.SL_GLSL,
+                                 p3d.Filename.from_os_specific(os.path.join(SHADER_DIR, 'skybox_v.glsl')),
+                                 p3d.Filename.from_os_specific(os.path.join(SHADER_DIR, 'skybox_f.glsl')))
+        if shader is None:
+            raise IOError('Could not load the skybox shader from '+SHADER_DIR)
+        # set everything up on a dummy node, and keep its state
+        node = p3d.NodePath('sky_box')
+        node.set_shader(shader, 1)
+        node.set_shader_input('blur', 0.0)
+        node.set_bin('background', 100)
+        node.set_depth_test(False)
+        node.set_depth_write(False)
+        _state = node.get_state()
+    return _state
+
+
+def make_skybox(parent, camera, env_map=None, blur=0.0, scale=10.0):
+    '''Returns a skybox attached to parent (usually render) that follows the camera.
+    If env_map (a cube map Texture) is None, it's taken from a shader input
+    set higher up, blur is the mip level of the cube map to use'''
+    box = p3d.Loader.get_global_ptr().load_sync(p3d.Filename.from_os_specific(BOX_MODEL))
+    if box is None:
+        raise IOError('Could not load model: '+BOX_MODEL)
+    sky_box = parent.attach_new_node(box)
+    sky_box.set_state(skybox_state())
+    sky_box.set_scale(scale)
+    # keep the position of the camera, the rotation and scale are still relative to the parent
+    sky_box.set_effect(p3d.CompassEffect.make(camera, p3d.CompassEffect.P_pos))
+    if blur:
+        sky_box.set_shader_input('blur', blur)
+    if env_map is not None:
+        sky_box.set_shader_input('env_map', env_map)
+    return sky_box